@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Benchmark of state codecs used for user_states.state_data.
+Compares bytes written and encode/decode time per state save against
+the legacy plain json.dumps format. Runs offline on a synthetic session.
+"""
+
+import json
+import time
+
+from state_codec import CODECS, decode_state
+
+
+def build_sample_state(step_count: int = 12) -> dict:
+    """Build a session state resembling a Russian quest with appended branches."""
+    steps = []
+    for i in range(step_count):
+        steps.append({
+            "id": f"step_{i}",
+            "image": "Маленький дракон Драко стоит на опушке волшебного леса, вокруг светятся грибы",
+            "text": (
+                "Драко идёт по тропинке и видит большое дерево с дуплом. "
+                "Из дупла выглядывает любопытная белка и машет ему лапкой. "
+                "Она рассказывает, что в лесу спрятан волшебный жёлудь."
+            ),
+            "options": [
+                {"text": "Спросить белку, где искать жёлудь", "nextStepId": f"step_{i + 1}", "emoji": "🐿️"},
+                {"text": "Заглянуть в дупло", "nextStepId": f"ending_{i}", "emoji": "🌳"},
+            ] if i < step_count - 1 else []
+        })
+    return {
+        'quest_requirements': "Тема: приключения в лесу. Главный герой: маленький дракон.",
+        'current_quest': {"quest": {"title": "Драко и волшебный жёлудь", "startStepId": "step_0", "steps": steps}},
+        'current_step_id': "step_3",
+        'step_history': ["step_0", "step_1", "step_2", "step_3"],
+        'quest_started': True,
+        'user_language': 'ru'
+    }
+
+
+def time_it(func, iterations: int) -> float:
+    """Return the mean time per call in microseconds."""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main(iterations: int = 2000):
+    state = build_sample_state()
+
+    print(f"{'codec':<10}{'bytes':>10}{'ratio':>8}{'encode µs':>12}{'decode µs':>12}")
+
+    legacy = json.dumps(state)
+    legacy_size = len(legacy.encode('utf-8'))
+    encode_us = time_it(lambda: json.dumps(state), iterations)
+    decode_us = time_it(lambda: decode_state(legacy), iterations)
+    print(f"{'legacy':<10}{legacy_size:>10}{1.0:>8.2f}{encode_us:>12.1f}{decode_us:>12.1f}")
+
+    for name, codec in CODECS.items():
+        blob = codec.encode(state)
+        assert decode_state(blob) == state
+        encode_us = time_it(lambda: codec.encode(state), iterations)
+        decode_us = time_it(lambda: decode_state(blob), iterations)
+        ratio = len(blob) / legacy_size
+        print(f"{name:<10}{len(blob):>10}{ratio:>8.2f}{encode_us:>12.1f}{decode_us:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
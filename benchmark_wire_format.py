@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the compact quest wire format against JSON output.
+
+Offline, compares the output tokens of the same quests written as JSON (the way
+the generation prompt asks for it) and in the wire format, the generation time
+those tokens cost at a given decode speed, and parse time. Token counts use
+tiktoken when it is installed and a rough word/punctuation estimate otherwise.
+
+With --live N, also generates N quests in each format on the first generation
+backend and reports measured completion tokens, latency and parse success.
+
+Usage:
+    python benchmark_wire_format.py [--quests quests.jsonl] [--tokens-per-second 50]
+    python benchmark_wire_format.py --live 3 --requirements "space travel with a robot"
+"""
+
+import argparse
+import asyncio
+import json
+import re
+import time
+from typing import Callable, Dict, Any, List
+
+from benchmark_state_codec import build_sample_state
+from json_schemas import FULL_QUEST_SCHEMA
+from json_utils import extract_json_from_response
+from quest_wire import WireParser, format_quest, parse_quest
+
+
+def token_counter() -> Callable[[str], int]:
+    """Return a token counting function: tiktoken's if available, else an estimate."""
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding('o200k_base')
+        return lambda text: len(encoding.encode(text))
+    except ImportError:
+        # Words, single punctuation marks and quotes are roughly one token each
+        return lambda text: len(re.findall(r"\w+|[^\w\s]", text))
+
+
+def load_quests(path: str) -> List[Dict[str, Any]]:
+    """Load quests from a JSONL file with a "quest" object per line (bulk_generate.py output)."""
+    quests = []
+    with open(path, 'r', encoding='utf-8') as source:
+        for line in source:
+            if line.strip():
+                quests.append(json.loads(line)['quest'])
+    return quests
+
+
+def time_it(func, iterations: int) -> float:
+    """Return the mean time per call in microseconds."""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def stream_parse(text: str, chunk_size: int = 8):
+    """Parse the wire format in small chunks, as it arrives from a stream."""
+    parser = WireParser()
+    for i in range(0, len(text), chunk_size):
+        parser.feed(text[i:i + chunk_size])
+    return parser.close().quest()
+
+
+def offline(quests: List[Dict[str, Any]], tokens_per_second: float, iterations: int):
+    count_tokens = token_counter()
+    totals = {'json': [0, 0.0], 'wire': [0, 0.0]}
+    stream_us = 0.0
+    for quest_data in quests:
+        as_json = json.dumps(quest_data, ensure_ascii=False, indent=4)
+        as_wire = format_quest(quest_data)
+        assert parse_quest(as_wire) is not None
+        totals['json'][0] += count_tokens(as_json)
+        totals['wire'][0] += count_tokens(as_wire)
+        totals['json'][1] += time_it(lambda: extract_json_from_response(as_json, FULL_QUEST_SCHEMA), iterations)
+        totals['wire'][1] += time_it(lambda: parse_quest(as_wire), iterations)
+        stream_us += time_it(lambda: stream_parse(as_wire), iterations)
+
+    print(f"{len(quests)} quests, generation time at {tokens_per_second:.0f} tokens/s")
+    print(f"{'format':<8}{'tokens':>10}{'ratio':>8}{'gen s':>10}{'parse µs':>12}")
+    json_tokens = totals['json'][0]
+    for name, (tokens, parse_us) in totals.items():
+        print(f"{name:<8}{tokens / len(quests):>10.0f}{tokens / json_tokens:>8.2f}"
+              f"{tokens / len(quests) / tokens_per_second:>10.1f}{parse_us / len(quests):>12.1f}")
+    print(f"wire format parsed from 8-character stream chunks: {stream_us / len(quests):.1f} µs per quest")
+
+
+async def live(count: int, requirements: str, language: str):
+    """Generate quests in both formats on the first generation backend and measure them."""
+    from model_router import TASK_GENERATION
+    from prompts import get_quest_generation_prompt, get_quest_generation_wire_prompt
+    from quest_engine import QuestEngine, response_tokens
+
+    engine = QuestEngine()
+    backend = engine.router.candidates(TASK_GENERATION)[0]
+    client = engine._get_client(backend.base_url)
+    formats = {
+        'json': (get_quest_generation_prompt(requirements, language), engine._parse_quest),
+        'wire': (get_quest_generation_wire_prompt(requirements, language), engine._parse_quest_wire),
+    }
+    print(f"{count} quests per format on {backend.name}")
+    print(f"{'format':<8}{'tokens':>10}{'latency s':>12}{'valid':>8}")
+    for name, (prompt, parse) in formats.items():
+        tokens, latency, valid = 0, 0.0, 0
+        for _ in range(count):
+            start = time.monotonic()
+            response = await client.chat.completions.create(
+                model=backend.model,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.7, max_tokens=32768
+            )
+            latency += time.monotonic() - start
+            usage = getattr(response, 'usage', None)
+            tokens += getattr(usage, 'completion_tokens', None) or response_tokens(response)
+            valid += parse(response.choices[0].message.content) is not None
+        print(f"{name:<8}{tokens / count:>10.0f}{latency / count:>12.1f}{valid:>5}/{count}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare quest output tokens and parse time: wire format vs JSON")
+    parser.add_argument('--quests', help="JSONL file of quests (default: a synthetic Russian quest)")
+    parser.add_argument('--tokens-per-second', type=float, default=50, help="Decode speed for generation time")
+    parser.add_argument('--iterations', type=int, default=200, help="Parse timing iterations per quest")
+    parser.add_argument('--live', type=int, default=0, help="Also generate this many quests per format")
+    parser.add_argument('--requirements', default="Приключения маленького дракона в волшебном лесу",
+                        help="Requirements for --live generation")
+    parser.add_argument('--language', default='ru', choices=['ru', 'en'], help="Language for --live generation")
+    args = parser.parse_args()
+
+    quests = load_quests(args.quests) if args.quests else [build_sample_state()['current_quest']]
+    offline(quests, args.tokens_per_second, args.iterations)
+    if args.live > 0:
+        asyncio.run(live(args.live, args.requirements, args.language))
+
+
+if __name__ == "__main__":
+    main()
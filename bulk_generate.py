@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+Offline bulk quest generation from a JSONL file of requirements.
+
+Each input line is a JSON object with "requirements" and optionally "id"
+(a hash of the requirements by default), "language" ('ru' or 'en'; detected
+from the text when missing) and "theme" (one of the quest pool's themes).
+Quests are generated with bounded concurrency; validated quests go to an
+output JSONL file and/or straight into the session store, where the bot adds
+them to its warm quest pool on start. Completed ids are appended to a
+checkpoint file, so an interrupted run resumes where it stopped and failed
+records are retried on the next run.
+
+With --store, every record needs a pool theme: its "theme", or the single
+theme its requirements name (as the bot matches them). Records without one
+are only written to the output JSONL.
+
+Run it with --store only while the bot is stopped: the bot writes the same
+database. The store is opened with a private journal, so the bot's
+crash-recovery journal is never replayed or removed by this tool.
+
+Usage:
+    python bulk_generate.py requests.jsonl --output quests.jsonl --concurrency 4
+    python bulk_generate.py requests.jsonl --store
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import Counter
+from typing import Dict, Any, Iterator, List, Optional, Set, Tuple
+
+from config import STATE_CODEC, STATE_SHARDS
+from quest_library import quest_id_for
+from quest_pool import POOL_THEMES, QuestPool
+from retry_policy import CircuitOpenError
+from state_codec import get_codec
+from utils import detect_language
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Completed records between progress reports
+PROGRESS_EVERY = 10
+# Times a record waits for open circuit breakers before it is counted as failed
+MAX_CIRCUIT_WAITS = 10
+
+
+def read_records(path: str) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Stream (record id, record) pairs from a JSONL file; see record_id for the default id."""
+    with open(path, 'r', encoding='utf-8') as source:
+        for line_number, line in enumerate(source, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                logger.warning(f"Skipping invalid JSON on line {line_number}: {e}")
+                continue
+            if not isinstance(record, dict) or not str(record.get('requirements', '')).strip():
+                logger.warning(f"Skipping line {line_number}: no requirements")
+                continue
+            yield record_id(record), record
+
+
+def record_id(record: Dict[str, Any]) -> str:
+    """
+    Return the record's checkpoint id: its "id", or a hash of its requirements and language.
+
+    Unlike a line number, the hash stays with the record when the input file is edited or reordered.
+    """
+    if 'id' in record:
+        return str(record['id'])
+    key = f"{record.get('language') or ''}\n{str(record['requirements']).strip()}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+def record_language(record: Dict[str, Any]) -> str:
+    """Return the record's language, detecting it from the requirements when missing."""
+    language = record.get('language') or detect_language(record['requirements'])
+    return language if language in ('ru', 'en') else 'ru'
+
+
+def record_theme(record: Dict[str, Any], language: str) -> Optional[str]:
+    """Return the quest pool theme of a record, or None if it has no single pooled theme."""
+    if record.get('theme') in POOL_THEMES:
+        return record['theme']
+    theme = QuestPool().match_theme(record['requirements'], language)
+    return theme if theme in POOL_THEMES else None
+
+
+def read_checkpoint(path: str) -> Set[str]:
+    """Return the ids of records completed by earlier runs."""
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'r', encoding='utf-8') as checkpoint:
+        return {line.rstrip('\n') for line in checkpoint if line.strip()}
+
+
+class BulkStats:
+    """Throughput, latency and failure statistics of a bulk run."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+        self.failures: Counter = Counter()
+        self.latencies: List[float] = []
+
+    def report(self) -> str:
+        elapsed = time.monotonic() - self.started
+        done = self.succeeded + self.failed
+        latencies = sorted(self.latencies)
+        mean = sum(latencies) / len(latencies) if latencies else 0.0
+        p95 = latencies[int(0.95 * (len(latencies) - 1))] if latencies else 0.0
+        failures = ', '.join(f"{reason}: {count}" for reason, count in self.failures.most_common()) or 'none'
+        return (
+            f"{self.succeeded} generated, {self.failed} failed, {self.skipped} skipped (checkpointed) "
+            f"in {elapsed:.0f}s; {self.succeeded / elapsed * 60 if elapsed > 0 else 0:.1f} quests/min, "
+            f"success rate {self.succeeded / done if done else 0:.0%}, "
+            f"latency mean {mean:.1f}s p95 {p95:.1f}s; failures: {failures}"
+        )
+
+
+class BulkGenerator:
+    """Run generate_quest over many records with a fixed number of workers."""
+
+    def __init__(self, engine, concurrency: int, output_path: Optional[str], checkpoint_path: str, store=None):
+        self.engine = engine
+        self.concurrency = concurrency
+        self.output_path = output_path
+        self.checkpoint_path = checkpoint_path
+        self.store = store
+        self.stats = BulkStats()
+
+    async def generate(self, requirements: str, language: str) -> Tuple[Optional[Dict[str, Any]], str]:
+        """Generate one quest; returns the quest (or None) and a failure reason."""
+        for _ in range(MAX_CIRCUIT_WAITS):
+            try:
+                quest_data = await self.engine.generate_quest(requirements, language)
+                return quest_data, '' if quest_data else 'invalid_or_exhausted'
+            except CircuitOpenError as e:
+                # Backends are cooling down: wait instead of burning through the input
+                logger.warning(f"{e}; waiting")
+                await asyncio.sleep(max(e.retry_in, 1.0))
+            except Exception as e:
+                return None, type(e).__name__
+        return None, 'circuit_open'
+
+    def write_result(self, record_id: str, record: Dict[str, Any], language: str, theme: Optional[str],
+                     quest_data: Dict[str, Any]):
+        """Write a validated quest to the outputs, then checkpoint its record."""
+        if self.output_path:
+            with open(self.output_path, 'a', encoding='utf-8') as output:
+                output.write(json.dumps({
+                    'id': record_id,
+                    'requirements': record['requirements'],
+                    'language': language,
+                    'theme': theme,
+                    'quest': quest_data,
+                }, ensure_ascii=False) + '\n')
+        if self.store is not None and theme is not None:
+            self.store.save_pooled_quest(quest_id_for(quest_data), quest_data, language, theme)
+        with open(self.checkpoint_path, 'a', encoding='utf-8') as checkpoint:
+            checkpoint.write(record_id + '\n')
+
+    async def worker(self, queue: asyncio.Queue):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            record_id, record = item
+            language = record_language(record)
+            theme = record_theme(record, language)
+            if theme is None and not self.output_path:
+                # Stored quests are only served from the pool, so there is nowhere to put this one
+                self.stats.failed += 1
+                self.stats.failures['no_pool_theme'] += 1
+                logger.warning(f"Record {record_id} skipped: no pool theme (give \"theme\" or --output)")
+                continue
+            start = time.monotonic()
+            quest_data, reason = await self.generate(record['requirements'], language)
+            self.stats.latencies.append(time.monotonic() - start)
+            if quest_data:
+                self.write_result(record_id, record, language, theme, quest_data)
+                self.stats.succeeded += 1
+            else:
+                self.stats.failed += 1
+                self.stats.failures[reason] += 1
+                logger.warning(f"Record {record_id} failed: {reason}")
+            if (self.stats.succeeded + self.stats.failed) % PROGRESS_EVERY == 0:
+                logger.info(f"Progress: {self.stats.report()}")
+
+    async def run(self, input_path: str):
+        """Stream the input through the workers, skipping checkpointed records."""
+        completed = read_checkpoint(self.checkpoint_path)
+        # A small queue keeps memory flat however large the input is
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [asyncio.create_task(self.worker(queue)) for _ in range(self.concurrency)]
+        try:
+            for record_id, record in read_records(input_path):
+                if record_id in completed:
+                    self.stats.skipped += 1
+                    continue
+                await queue.put((record_id, record))
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate quests in bulk from a JSONL file of requirements")
+    parser.add_argument('input', help="JSONL file with one {\"requirements\": ...} object per line")
+    parser.add_argument('--output', help="JSONL file to append generated quests to")
+    parser.add_argument('--store', action='store_true',
+                        help="Save generated quests into the session store for the bot's quest pool "
+                             "(stop the bot first)")
+    parser.add_argument('--db', default='kidquest_bot.db', help="Session store database (with --store)")
+    parser.add_argument('--concurrency', type=int, default=4, help="Quests generated at the same time (default: 4)")
+    parser.add_argument('--checkpoint', help="Checkpoint file (default: <output or input>.checkpoint)")
+    args = parser.parse_args()
+
+    if not args.output and not args.store:
+        parser.error("give --output, --store or both")
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    checkpoint_path = args.checkpoint or f"{args.output or args.input}.checkpoint"
+
+    store = None
+    if args.store:
+        from session_store import SessionStore
+        # Quests are written directly; a private journal leaves the bot's session journal alone
+        store = SessionStore(args.db, get_codec(STATE_CODEC), flush_interval=0,
+                             journal_path=f"{args.db}.bulk.journal", shards=STATE_SHARDS)
+
+    from quest_engine import QuestEngine
+    generator = BulkGenerator(QuestEngine(), args.concurrency, args.output, checkpoint_path, store)
+    try:
+        asyncio.run(generator.run(args.input))
+    except KeyboardInterrupt:
+        logger.info("Interrupted; rerun the same command to resume")
+    finally:
+        if store is not None:
+            store.close()
+        logger.info(f"Done: {generator.stats.report()}")
+
+
+if __name__ == '__main__':
+    main()
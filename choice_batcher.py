@@ -0,0 +1,127 @@
+"""
+Micro-batching of choice-matching requests across users
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Dict, Any, Deque, List, Optional, Callable, Awaitable
+
+logger = logging.getLogger(__name__)
+
+
+class ChoiceJob:
+    """A pending choice-matching request waiting to be batched."""
+
+    __slots__ = ('user_choice', 'options', 'deadline', 'future', 'enqueued_at')
+
+    def __init__(self, user_choice: str, options: List[Dict[str, Any]], deadline: float):
+        self.user_choice = user_choice
+        self.options = options
+        self.deadline = deadline
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+
+
+class ChoiceBatcher:
+    """
+    Collect choice-matching jobs from many users over a short window and
+    resolve them with one upstream request per batch.
+
+    Jobs are batched per language, since the prompt is language-specific.
+    A batch is flushed when the window expires or the batch is full.
+    """
+
+    def __init__(self, match_batch: Callable[[str, List[ChoiceJob]], Awaitable[List[Optional[str]]]],
+                 window: float = 0.05, max_batch_size: int = 8):
+        self.match_batch = match_batch
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.pending: Dict[str, List[ChoiceJob]] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._running = set()
+
+        # Statistics
+        self.batches = 0
+        self.jobs = 0
+        self.occupancy: Deque[int] = deque(maxlen=500)
+        self.added_latency: Deque[float] = deque(maxlen=500)
+
+    async def submit(self, user_choice: str, options: List[Dict[str, Any]], language: str, deadline: float) -> Optional[str]:
+        """
+        Queue a choice for matching and wait for its batch to be resolved.
+
+        Args:
+            user_choice (str): The user's free-text choice
+            options (List[Dict[str, Any]]): Options of the current step
+            language (str): User language code
+            deadline (float): time.monotonic() deadline for the match
+
+        Returns:
+            Optional[str]: nextStepId of the matched option, or None if nothing matched
+
+        Raises:
+            Exception: The error of the batch's model call if it failed
+        """
+        job = ChoiceJob(user_choice, options, deadline)
+        batch = self.pending.setdefault(language, [])
+        batch.append(job)
+
+        if len(batch) >= self.max_batch_size:
+            self._flush(language)
+        elif len(batch) == 1:
+            self._timers[language] = asyncio.get_running_loop().call_later(self.window, self._flush, language)
+
+        return await job.future
+
+    def _flush(self, language: str):
+        """Send the pending batch for a language."""
+        timer = self._timers.pop(language, None)
+        if timer is not None:
+            timer.cancel()
+
+        # Jobs whose handlers were cancelled while waiting are dropped
+        jobs = [job for job in self.pending.pop(language, []) if not job.future.done()]
+        if not jobs:
+            return
+
+        task = asyncio.create_task(self._run_batch(language, jobs))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _run_batch(self, language: str, jobs: List[ChoiceJob]):
+        """Resolve a batch and fan the answers out to the waiting handlers."""
+        now = time.monotonic()
+        self.batches += 1
+        self.jobs += len(jobs)
+        self.occupancy.append(len(jobs))
+        for job in jobs:
+            self.added_latency.append(now - job.enqueued_at)
+
+        try:
+            results = await self.match_batch(language, jobs)
+        except Exception as e:
+            # Every waiting handler sees the failure, which is not the same as matching no option
+            logger.error(f"Error matching batch of {len(jobs)} choices: {str(e)}")
+            for job in jobs:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            return
+
+        for job, result in zip(jobs, results):
+            if not job.future.done():
+                job.future.set_result(result)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return batch occupancy and added latency statistics."""
+        occupancy = list(self.occupancy)
+        latencies = sorted(self.added_latency)
+        return {
+            'batches': self.batches,
+            'jobs': self.jobs,
+            'mean_occupancy': sum(occupancy) / len(occupancy) if occupancy else 0.0,
+            'max_batch_size': self.max_batch_size,
+            'added_latency_mean': sum(latencies) / len(latencies) if latencies else 0.0,
+            'added_latency_p95': latencies[int(0.95 * (len(latencies) - 1))] if latencies else 0.0,
+        }
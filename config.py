@@ -11,3 +11,118 @@ TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN', '')
 OPENROUTER_API_KEY = os.getenv('OPENROUTER_API_KEY', '')
 OPENROUTER_BASE_URL = os.getenv('BASE_URL', "https://openrouter.ai/api/v1")
 MODEL_NAME = os.getenv('MODEL_NAME',"qwen/qwen3-4b:free")
+
+# Per-task model routing: comma-separated lists of "model" or "model@base_url",
+# in priority order. Empty lists fall back to MODEL_NAME at OPENROUTER_BASE_URL.
+GENERATION_MODELS = os.getenv('GENERATION_MODELS', '')
+BRANCH_MODELS = os.getenv('BRANCH_MODELS', '')
+CHOICE_MODELS = os.getenv('CHOICE_MODELS', '')
+
+# Per-call deadlines (seconds) for each task type, covering all retries
+GENERATION_TIMEOUT = float(os.getenv('GENERATION_TIMEOUT', '180'))
+BRANCH_TIMEOUT = float(os.getenv('BRANCH_TIMEOUT', '90'))
+CHOICE_TIMEOUT = float(os.getenv('CHOICE_TIMEOUT', '15'))
+# Retry policy: attempts per call and jittered exponential backoff bounds (seconds)
+RETRY_MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS', '3'))
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', '0.5'))
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', '10'))
+# Circuit breaker per backend: consecutive failures before opening, and seconds it stays open
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', '3'))
+BREAKER_RESET_TIMEOUT = float(os.getenv('BREAKER_RESET_TIMEOUT', '30'))
+# Fire a duplicate request when the primary passes its p95 latency
+HEDGE_REQUESTS = os.getenv('HEDGE_REQUESTS', '0') == '1'
+# Constrain quest and branch answers to their JSON schemas via response_format where the backend supports it
+STRUCTURED_OUTPUT = os.getenv('STRUCTURED_OUTPUT', '1') == '1'
+# Comma-separated models asked for quests and branch steps in the compact line format instead of JSON ('*' for all)
+WIRE_FORMAT_MODELS = {model.strip() for model in os.getenv('WIRE_FORMAT_MODELS', '').split(',') if model.strip()}
+# Generate a quest as a validated graph skeleton first, then write its steps with concurrent calls
+QUEST_SKELETON_FIRST = os.getenv('QUEST_SKELETON_FIRST', '0') == '1'
+# Most steps written at the same time in skeleton-first generation
+QUEST_SKELETON_CONCURRENCY = int(os.getenv('QUEST_SKELETON_CONCURRENCY', '6'))
+# Race several quest generations and keep the first valid one; the count adapts to the recent failure rate
+GENERATION_RACE = os.getenv('GENERATION_RACE', '0') == '1'
+# Most generations raced at once
+GENERATION_RACE_MAX_K = int(os.getenv('GENERATION_RACE_MAX_K', '3'))
+# Acceptable chance that every raced generation fails validation
+GENERATION_RACE_TARGET_FAILURE = float(os.getenv('GENERATION_RACE_TARGET_FAILURE', '0.05'))
+
+# Micro-batch choice matching across users into one upstream request
+CHOICE_BATCHING = os.getenv('CHOICE_BATCHING', '0') == '1'
+# How long the first choice in a batch waits for others, in milliseconds
+CHOICE_BATCH_WINDOW_MS = float(os.getenv('CHOICE_BATCH_WINDOW_MS', '50'))
+# Maximum number of choices per batch; a full batch is sent immediately
+CHOICE_BATCH_SIZE = int(os.getenv('CHOICE_BATCH_SIZE', '8'))
+
+# Resolve choices with a local character n-gram similarity index before calling the model
+OPTION_INDEX_ENABLED = os.getenv('OPTION_INDEX_ENABLED', '1') == '1'
+# Minimum cosine score and margin over the runner-up option for a local match
+OPTION_INDEX_MIN_SCORE = float(os.getenv('OPTION_INDEX_MIN_SCORE', '0.35'))
+OPTION_INDEX_MIN_MARGIN = float(os.getenv('OPTION_INDEX_MIN_MARGIN', '0.15'))
+
+# Stream new branch text into the chat via throttled message edits
+STREAM_BRANCHES = os.getenv('STREAM_BRANCHES', '1') == '1'
+# Minimum seconds between edits of the streamed message
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.0'))
+# Number of generated branches remembered for reuse when the same off-script choice is made again (0 disables)
+BRANCH_MEMO_SIZE = int(os.getenv('BRANCH_MEMO_SIZE', '5000'))
+# Token budget of the rolling story summary sent with branch prompts
+STORY_SUMMARY_TOKENS = int(os.getenv('STORY_SUMMARY_TOKENS', '300'))
+
+# Session Storage Configuration
+# Codec used for new state_data writes: 'zlib' (compact JSON + zlib) or 'json' (compact UTF-8 JSON)
+STATE_CODEC = os.getenv('STATE_CODEC', 'zlib')
+# Seconds between batched writes of changed sessions (0 writes every save immediately)
+STATE_FLUSH_INTERVAL = float(os.getenv('STATE_FLUSH_INTERVAL', '5'))
+# Append-only journal used to recover unflushed sessions after a crash
+STATE_JOURNAL_PATH = os.getenv('STATE_JOURNAL_PATH', 'kidquest_bot.journal')
+# Number of SQLite files sessions are sharded across by user id (change it with reshard_sessions.py)
+STATE_SHARDS = int(os.getenv('STATE_SHARDS', '1'))
+# Load all stored sessions into memory in the background after polling starts
+WARM_UP_STATES = os.getenv('WARM_UP_STATES', '1') == '1'
+
+# Warm Quest Pool Configuration
+QUEST_POOL_ENABLED = os.getenv('QUEST_POOL_ENABLED', '1') == '1'
+# Number of ready quests kept per language and theme
+QUEST_POOL_SIZE = int(os.getenv('QUEST_POOL_SIZE', '2'))
+# Maximum number of background quest generations per hour
+QUEST_POOL_HOURLY_BUDGET = int(os.getenv('QUEST_POOL_HOURLY_BUDGET', '10'))
+# Seconds without user activity before the pool is refilled
+QUEST_POOL_IDLE_SECONDS = float(os.getenv('QUEST_POOL_IDLE_SECONDS', '30'))
+# Requirements longer than this many words always get a freshly generated quest
+QUEST_POOL_MAX_WORDS = int(os.getenv('QUEST_POOL_MAX_WORDS', '12'))
+
+# Per-User Quota Configuration
+# Limit each user's model calls with a token bucket charged by operation cost
+QUOTA_ENABLED = os.getenv('QUOTA_ENABLED', '1') == '1'
+# Bucket size (the burst a user may spend at once) and refill per minute, in cost units
+QUOTA_CAPACITY = float(os.getenv('QUOTA_CAPACITY', '40'))
+QUOTA_REFILL_PER_MINUTE = float(os.getenv('QUOTA_REFILL_PER_MINUTE', '4'))
+# Cost of each operation: quest generation, branch generation, free-text choice matching
+QUOTA_COST_GENERATION = float(os.getenv('QUOTA_COST_GENERATION', '10'))
+QUOTA_COST_BRANCH = float(os.getenv('QUOTA_COST_BRANCH', '4'))
+QUOTA_COST_CHOICE = float(os.getenv('QUOTA_COST_CHOICE', '1'))
+
+# Outbound Message Queue Configuration
+# Maximum Bot API sends per second across all chats
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', '30'))
+# Minimum seconds between messages (including edits) to one chat
+TELEGRAM_CHAT_INTERVAL = float(os.getenv('TELEGRAM_CHAT_INTERVAL', '1.0'))
+
+# Instrumentation Configuration
+# Comma-separated Telegram user ids allowed to use the /stats command
+ADMIN_USER_IDS = {int(user_id) for user_id in os.getenv('ADMIN_USER_IDS', '').split(',') if user_id.strip()}
+# Trace allocations with tracemalloc and include growth diffs in /stats (adds overhead)
+TRACEMALLOC_ENABLED = os.getenv('TRACEMALLOC_ENABLED', '0') == '1'
+# Seconds between session-size reports in the log (0 disables them)
+MEMORY_REPORT_INTERVAL = float(os.getenv('MEMORY_REPORT_INTERVAL', '0'))
+# Fraction of handler calls traced per phase; percentiles are shown in /stats (0 disables tracing)
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0.05'))
+# JSON-lines file sampled traces are appended to (empty keeps them in memory only)
+TRACE_EXPORT_PATH = os.getenv('TRACE_EXPORT_PATH', '')
+
+# LLM Cassette Configuration
+# 'record' saves LLM request/response pairs to the cassette, 'replay' serves them without network access
+LLM_CASSETTE_MODE = os.getenv('LLM_CASSETTE_MODE', '')
+LLM_CASSETTE_PATH = os.getenv('LLM_CASSETTE_PATH', 'llm_cassette.jsonl')
+# Multiplier for recorded latency when replaying (0 replays instantly, 1 at the recorded pace)
+LLM_CASSETTE_LATENCY_SCALE = float(os.getenv('LLM_CASSETTE_LATENCY_SCALE', '0'))
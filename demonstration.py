@@ -5,7 +5,7 @@ This shows the core functionality without requiring external API calls.
 """
 
 import json
-from quest_engine import QuestEngine
+from quest_engine import QuestEngine, ChoiceMatchError
 
 async def demonstrate_quest_generation():
     """Demonstrate quest generation with sample requirements."""
@@ -93,7 +93,11 @@ async def demonstrate_choice_processing():
     print(f"User choice: {user_choice}")
     
     # Process the choice
-    next_step_id = await engine.process_choice(sample_step, user_choice, [sample_step])
+    try:
+        next_step_id = await engine.process_choice(sample_step, user_choice, [sample_step])
+    except ChoiceMatchError as e:
+        print(f"❌ Choice matching failed: {e}")
+        return
     
     if next_step_id:
         print(f"✅ Matched to next step ID: {next_step_id}")
@@ -0,0 +1,76 @@
+"""
+Adaptive best-of-k racing for quest generation
+"""
+
+import math
+from collections import deque
+from typing import Dict, Any
+
+
+class RaceController:
+    """
+    Choose how many concurrent generations to race, from the recent validation failure rate.
+
+    With a failure rate f, all of k candidates fail with probability f**k, so k is
+    the smallest count that brings that below the target. The rate is smoothed
+    (one failure and one success are assumed up front), so racing starts wide
+    and narrows as validated generations come in.
+    """
+
+    def __init__(self, max_k: int = 3, target_failure: float = 0.05, window: int = 50):
+        self.max_k = max(1, max_k)
+        self.target_failure = target_failure
+        # Recent outcomes of completed generations: True if the quest parsed and validated
+        self.outcomes: deque = deque(maxlen=window)
+        self.races = 0
+        self.candidates_started = 0
+        self.candidates_cancelled = 0
+        self.races_won = 0
+        self.winner_tokens = 0
+        self.wasted_tokens = 0
+
+    def record_outcome(self, valid: bool):
+        """Record whether a completed generation passed parsing and graph validation."""
+        self.outcomes.append(valid)
+
+    def failure_rate(self) -> float:
+        failures = sum(1 for valid in self.outcomes if not valid)
+        return (failures + 1) / (len(self.outcomes) + 2)
+
+    def choose_k(self) -> int:
+        """Return the number of generations to start for the next quest."""
+        rate = self.failure_rate()
+        if rate <= self.target_failure:
+            return 1
+        k = math.ceil(math.log(self.target_failure) / math.log(rate))
+        return max(1, min(self.max_k, k))
+
+    def record_race(self, k: int, won: bool, winner_tokens: int, wasted_tokens: int, cancelled: int):
+        """
+        Account for one race.
+
+        Args:
+            k (int): Candidates started
+            won (bool): Whether a candidate produced a valid quest
+            winner_tokens (int): Tokens reported for the winning candidate
+            wasted_tokens (int): Tokens reported for completed candidates that lost or were invalid
+            cancelled (int): Candidates cancelled before they finished (their tokens are not reported)
+        """
+        self.races += 1
+        self.candidates_started += k
+        self.candidates_cancelled += cancelled
+        self.races_won += 1 if won else 0
+        self.winner_tokens += winner_tokens
+        self.wasted_tokens += wasted_tokens
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'races': self.races,
+            'races_won': self.races_won,
+            'mean_k': self.candidates_started / self.races if self.races else 0.0,
+            'candidates_cancelled': self.candidates_cancelled,
+            'failure_rate': self.failure_rate(),
+            'next_k': self.choose_k(),
+            'winner_tokens': self.winner_tokens,
+            'wasted_tokens': self.wasted_tokens,
+        }
@@ -65,4 +65,64 @@ NEW_STEP_SCHEMA: Dict[str, Any] = {
         }
     },
     "required": ["id", "image", "text", "options"]
-}
\ No newline at end of file
+}
+
+# Quest skeleton schema: the graph with one-line beats, before any prose is written
+QUEST_SKELETON_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "skeleton": {
+            "type": "object",
+            "properties": {
+                "title": {"type": "string"},
+                "startStepId": {"type": "string"},
+                "steps": {
+                    "type": "array",
+                    "minItems": 1,
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "id": {"type": "string"},
+                            "beat": {"type": "string"},
+                            "options": {
+                                "type": "array",
+                                "items": {
+                                    "type": "object",
+                                    "properties": {
+                                        "beat": {"type": "string"},
+                                        "nextStepId": {"type": "string"}
+                                    },
+                                    "required": ["beat", "nextStepId"]
+                                }
+                            }
+                        },
+                        "required": ["id", "beat"]
+                    }
+                }
+            },
+            "required": ["title", "startStepId", "steps"]
+        }
+    },
+    "required": ["skeleton"]
+}
+
+# Prose of one skeleton step; options are in the skeleton's order
+STEP_FILL_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "image": {"type": "string"},
+        "text": {"type": "string"},
+        "options": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "text": {"type": "string"},
+                    "emoji": {"type": "string"}
+                },
+                "required": ["text"]
+            }
+        }
+    },
+    "required": ["image", "text", "options"]
+}
@@ -6,9 +6,6 @@ import json
 import logging
 from typing import Dict, Any, Optional
 
-import jsonschema
-from jsonschema import ValidationError
-
 logger = logging.getLogger(__name__)
 
 def extract_json_from_response(content: str, schema: Optional[Dict] = None) -> Optional[Dict[str, Any]]:
@@ -46,6 +43,9 @@ def extract_json_from_response(content: str, schema: Optional[Dict] = None) -> O
     
     # Validate against schema if provided
     if schema is not None:
+        # jsonschema is imported lazily to keep it off the startup path
+        import jsonschema
+        from jsonschema import ValidationError
         try:
             jsonschema.validate(parsed_json, schema)
         except ValidationError as e:
@@ -78,4 +78,108 @@ def extract_choice_result(content: str) -> Optional[str]:
         return result
     except Exception as e:
         logger.error(f"Error parsing process_choice response: {str(e)}")
-        return None
\ No newline at end of file
+        return None
+
+# Decoded values of single-character JSON escape sequences
+_JSON_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+
+class JsonFieldStreamer:
+    """
+    Incrementally extract a top-level string field from a JSON object that
+    arrives in chunks (e.g. streamed model output), before the JSON is complete.
+
+    Only keys of the outermost object are matched, so nested fields with the
+    same name (such as option texts) are ignored.
+    """
+
+    def __init__(self, field: str):
+        self.field = field
+        self.done = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = None  # None, '' after a backslash, or collected \\u hex digits
+        self._string_chars = []
+        self._last_key = None
+        self._expecting_value = False
+        self._capturing = False
+        self._value_chars = []
+
+    @property
+    def value(self) -> str:
+        """The part of the field's value decoded so far."""
+        text = ''.join(self._value_chars)
+        return text.encode('utf-16', 'surrogatepass').decode('utf-16', 'replace')
+
+    def feed(self, chunk: str) -> str:
+        """
+        Consume the next chunk of raw JSON text.
+
+        Args:
+            chunk (str): Next piece of the streamed response
+
+        Returns:
+            str: The field's value decoded so far
+        """
+        for char in chunk:
+            if self.done:
+                break
+            if self._in_string:
+                self._consume_string_char(char)
+            else:
+                self._consume_structural_char(char)
+        return self.value
+
+    def _append(self, char: str):
+        self._string_chars.append(char)
+        if self._capturing:
+            self._value_chars.append(char)
+
+    def _consume_string_char(self, char: str):
+        if self._escape is not None:
+            if self._escape == '' and char != 'u':
+                self._append(_JSON_ESCAPES.get(char, char))
+                self._escape = None
+            elif self._escape == '':
+                self._escape = 'u'
+            else:
+                self._escape += char
+                if len(self._escape) == 5:
+                    try:
+                        self._append(chr(int(self._escape[1:], 16)))
+                    except ValueError:
+                        pass
+                    self._escape = None
+        elif char == '\\':
+            self._escape = ''
+        elif char == '"':
+            self._in_string = False
+            if self._capturing:
+                self._capturing = False
+                self.done = True
+            elif self._depth == 1:
+                self._last_key = ''.join(self._string_chars)
+        else:
+            self._append(char)
+
+    def _consume_structural_char(self, char: str):
+        if char == '"':
+            self._in_string = True
+            self._string_chars = []
+            if self._expecting_value:
+                self._capturing = True
+                self._expecting_value = False
+        elif char == ':':
+            self._expecting_value = self._depth == 1 and self._last_key == self.field
+            self._last_key = None
+        elif char in '{[':
+            self._depth += 1
+            self._expecting_value = False
+        elif char in '}]':
+            self._depth -= 1
+        elif char == ',':
+            self._last_key = None
+            self._expecting_value = False
+        elif not char.isspace():
+            # Non-string value (number, literal) for the awaited key
+            self._expecting_value = False
@@ -0,0 +1,223 @@
+"""
+Record/replay cassettes for LLM traffic at the QuestEngine client boundary
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from types import SimpleNamespace
+from typing import Dict, Any, List, Optional
+
+logger = logging.getLogger(__name__)
+
+MODE_RECORD = 'record'
+MODE_REPLAY = 'replay'
+
+
+class CassetteMissError(Exception):
+    """Raised in replay mode for a request that is not in the cassette."""
+
+    # Reported as a client error, so the engine neither retries it nor trips a breaker
+    status_code = 404
+
+    def __init__(self, key: str, model: str):
+        super().__init__(f"No recorded response for model {model} (request {key[:12]})")
+        self.key = key
+
+
+def request_key(base_url: str, model: str, messages: List[Dict[str, Any]], params: Dict[str, Any]) -> str:
+    """Hash a request's endpoint, model, messages and parameters into a stable cassette key."""
+    payload = json.dumps(
+        {'base_url': base_url, 'model': model, 'messages': messages, 'params': params},
+        ensure_ascii=False, sort_keys=True, default=str
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _usage_dict(usage) -> Optional[Dict[str, int]]:
+    if usage is None:
+        return None
+    return {
+        'prompt_tokens': getattr(usage, 'prompt_tokens', 0) or 0,
+        'completion_tokens': getattr(usage, 'completion_tokens', 0) or 0,
+    }
+
+
+def _make_response(content: str, usage: Optional[Dict[str, int]]):
+    """Build an object shaped like a chat completion response."""
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=content), finish_reason='stop')],
+        usage=SimpleNamespace(**usage) if usage else None,
+    )
+
+
+def _make_chunk(delta: str):
+    """Build an object shaped like a streamed chat completion chunk."""
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=delta))])
+
+
+class Cassette:
+    """
+    Request/response pairs stored as JSON lines.
+
+    Each record holds the request key, model, the response content (or the
+    streamed chunks with their offsets) and the recorded latency. Identical
+    requests recorded several times are replayed in recording order; the last
+    recording is repeated once they run out.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.records: Dict[str, List[Dict[str, Any]]] = {}
+        self._positions: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.recorded = 0
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path, 'r', encoding='utf-8') as cassette:
+            for line in cassette:
+                line = line.strip()
+                if line:
+                    record = json.loads(line)
+                    self.records.setdefault(record['key'], []).append(record)
+        logger.info(f"Loaded {sum(len(records) for records in self.records.values())} recorded LLM responses from {self.path}")
+
+    def append(self, record: Dict[str, Any]):
+        """Add a record and append it to the cassette file."""
+        self.records.setdefault(record['key'], []).append(record)
+        with open(self.path, 'a', encoding='utf-8') as cassette:
+            cassette.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.recorded += 1
+
+    def next_record(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return the next recorded response for a request key, or None."""
+        records = self.records.get(key)
+        if not records:
+            self.misses += 1
+            return None
+        position = self._positions.get(key, 0)
+        self._positions[key] = position + 1
+        self.hits += 1
+        return records[min(position, len(records) - 1)]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'requests': len(self.records),
+            'hits': self.hits,
+            'misses': self.misses,
+            'recorded': self.recorded,
+        }
+
+
+class _RecordingStream:
+    """Pass a live stream through while recording its chunks and their timing."""
+
+    def __init__(self, stream, cassette: Cassette, record: Dict[str, Any], start: float):
+        self._stream = stream
+        self._cassette = cassette
+        self._record = record
+        self._start = start
+        self._chunks: List[List[Any]] = []
+        self._finished = False
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        async for chunk in self._stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                self._chunks.append([time.monotonic() - self._start, chunk.choices[0].delta.content])
+            yield chunk
+        self._finished = True
+
+    async def close(self):
+        await self._stream.close()
+        # Only complete streams are worth replaying
+        if self._finished:
+            self._record['chunks'] = self._chunks
+            self._record['latency'] = time.monotonic() - self._start
+            self._cassette.append(self._record)
+
+
+class _ReplayStream:
+    """Replay recorded chunks, optionally at their recorded pace."""
+
+    def __init__(self, chunks: List[List[Any]], latency_scale: float):
+        self._chunks = chunks
+        self._latency_scale = latency_scale
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        elapsed = 0.0
+        for offset, delta in self._chunks:
+            if self._latency_scale > 0 and offset > elapsed:
+                await asyncio.sleep((offset - elapsed) * self._latency_scale)
+                elapsed = offset
+            yield _make_chunk(delta)
+
+    async def close(self):
+        pass
+
+
+class _Completions:
+    def __init__(self, client: 'CassetteClient'):
+        self._client = client
+
+    async def create(self, model: str, messages: List[Dict[str, Any]], **params):
+        return await self._client.create(model, messages, params)
+
+
+class CassetteClient:
+    """
+    Stand-in for an AsyncOpenAI client that records or replays chat completions.
+
+    In record mode requests go to the real client and successful responses are
+    appended to the cassette; in replay mode responses come only from the
+    cassette, with the recorded latency scaled by latency_scale (0 for none).
+    """
+
+    def __init__(self, base_url: str, mode: str, cassette: Cassette, real_client=None, latency_scale: float = 0.0):
+        self.base_url = base_url
+        self.mode = mode
+        self.cassette = cassette
+        self.real_client = real_client
+        self.latency_scale = latency_scale
+        self.chat = SimpleNamespace(completions=_Completions(self))
+
+    async def create(self, model: str, messages: List[Dict[str, Any]], params: Dict[str, Any]):
+        key = request_key(self.base_url, model, messages, params)
+        if self.mode == MODE_REPLAY:
+            return await self._replay(key, model, params)
+
+        start = time.monotonic()
+        response = await self.real_client.chat.completions.create(model=model, messages=messages, **params)
+        record = {'key': key, 'model': model, 'stream': bool(params.get('stream'))}
+        if params.get('stream'):
+            return _RecordingStream(response, self.cassette, record, start)
+        record['content'] = response.choices[0].message.content
+        record['usage'] = _usage_dict(getattr(response, 'usage', None))
+        record['latency'] = time.monotonic() - start
+        self.cassette.append(record)
+        return response
+
+    async def _replay(self, key: str, model: str, params: Dict[str, Any]):
+        record = self.cassette.next_record(key)
+        if record is None:
+            raise CassetteMissError(key, model)
+        if params.get('stream'):
+            return _ReplayStream(record.get('chunks', []), self.latency_scale)
+        if self.latency_scale > 0:
+            await asyncio.sleep(record.get('latency', 0.0) * self.latency_scale)
+        return _make_response(record.get('content'), record.get('usage'))
+
+    async def close(self):
+        if self.real_client is not None:
+            await self.real_client.close()
@@ -3,9 +3,11 @@
 KidQuest Telegram Bot - Main Entry Point
 """
 
-import asyncio
+# Imported first so that the startup probe measures from process start
+import startup_probe
+
 import logging
-from telegram_bot import bot
+from telegram_bot import KidQuestBot
 
 # Configure logging
 logging.basicConfig(
@@ -16,8 +18,10 @@ logging.basicConfig(
 def main():
     """Start the bot."""
     print("Starting KidQuestBot...")
+    startup_probe.mark('imports')
     try:
         # Run the bot
+        bot = KidQuestBot()
         bot.run()
     except KeyboardInterrupt:
         print("\nBot stopped by user")
@@ -0,0 +1,124 @@
+"""
+Memory and session-size instrumentation for live sessions
+"""
+
+import json
+import logging
+import resource
+import sys
+import tracemalloc
+from typing import Dict, Any, List, Optional
+
+from state_codec import StateCodec
+
+logger = logging.getLogger(__name__)
+
+# Snapshot the previous tracemalloc diff is taken against
+_previous_snapshot: Optional[tracemalloc.Snapshot] = None
+
+
+def _percentile(sorted_values: List[int], fraction: float) -> int:
+    if not sorted_values:
+        return 0
+    return sorted_values[int(fraction * (len(sorted_values) - 1))]
+
+
+def session_size_report(user_states: Dict[int, Dict[str, Any]], codec: StateCodec, top_n: int = 5) -> Dict[str, Any]:
+    """
+    Measure the serialized size of every in-memory session.
+
+    Args:
+        user_states (Dict[int, Dict[str, Any]]): In-memory sessions by user id
+        codec (StateCodec): Codec the session store writes with
+        top_n (int): Number of largest sessions to list
+
+    Returns:
+        Dict[str, Any]: Session count, size totals and percentiles (JSON and stored
+        bytes), and the largest sessions with their branch step counts
+    """
+    sizes = []
+    for user_id, state in list(user_states.items()):
+        json_bytes = len(json.dumps(state, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+        stored_bytes = len(codec.encode(state))
+        sizes.append((user_id, json_bytes, stored_bytes, len(state.get('quest_branches') or [])))
+
+    json_sizes = sorted(size[1] for size in sizes)
+    stored_sizes = sorted(size[2] for size in sizes)
+    largest = sorted(sizes, key=lambda size: size[1], reverse=True)[:top_n]
+    return {
+        'sessions': len(sizes),
+        'json_bytes_total': sum(json_sizes),
+        'stored_bytes_total': sum(stored_sizes),
+        'json_bytes_p50': _percentile(json_sizes, 0.5),
+        'json_bytes_p90': _percentile(json_sizes, 0.9),
+        'json_bytes_p99': _percentile(json_sizes, 0.99),
+        'json_bytes_max': json_sizes[-1] if json_sizes else 0,
+        'stored_bytes_p50': _percentile(stored_sizes, 0.5),
+        'stored_bytes_max': stored_sizes[-1] if stored_sizes else 0,
+        'largest': [
+            {'user_id': user_id, 'json_bytes': json_bytes, 'stored_bytes': stored_bytes, 'branch_steps': branch_steps}
+            for user_id, json_bytes, stored_bytes, branch_steps in largest
+        ],
+    }
+
+
+def peak_rss_bytes() -> int:
+    """Return the peak resident set size of the process."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def start_tracemalloc(frames: int = 1):
+    """Start tracing allocations and take the baseline snapshot for later diffs."""
+    global _previous_snapshot
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+    _previous_snapshot = tracemalloc.take_snapshot()
+
+
+def tracemalloc_diff(limit: int = 10) -> List[str]:
+    """
+    Diff a new tracemalloc snapshot against the previous one.
+
+    Args:
+        limit (int): Number of source lines with the largest growth to return
+
+    Returns:
+        List[str]: Formatted statistics, or an empty list if tracing is off
+    """
+    global _previous_snapshot
+    if not tracemalloc.is_tracing():
+        return []
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+    if _previous_snapshot is None:
+        stats = snapshot.statistics('lineno')
+    else:
+        stats = snapshot.compare_to(_previous_snapshot, 'lineno')
+    _previous_snapshot = snapshot
+    return [str(stat) for stat in stats[:limit]]
+
+
+def format_report(report: Dict[str, Any], traced: List[str]) -> str:
+    """Render a session-size report and tracemalloc diff as a chat message."""
+    lines = [
+        f"Sessions: {report['sessions']}",
+        f"Peak RSS: {peak_rss_bytes() / 1048576:.1f} MiB",
+        f"State JSON total: {report['json_bytes_total'] / 1024:.1f} KiB "
+        f"(stored {report['stored_bytes_total'] / 1024:.1f} KiB)",
+        f"State JSON p50/p90/p99/max: {report['json_bytes_p50']}/{report['json_bytes_p90']}/"
+        f"{report['json_bytes_p99']}/{report['json_bytes_max']} B",
+        f"Stored p50/max: {report['stored_bytes_p50']}/{report['stored_bytes_max']} B",
+    ]
+    if report['largest']:
+        lines.append("Largest sessions:")
+        for session in report['largest']:
+            lines.append(f"  {session['user_id']}: {session['json_bytes']} B JSON, "
+                         f"{session['stored_bytes']} B stored, {session['branch_steps']} branch steps")
+    if traced:
+        lines.append("Allocation growth since last report:")
+        lines.extend(f"  {line}" for line in traced)
+    return "\n".join(lines)
@@ -0,0 +1,158 @@
+"""
+Per-task model routing with latency- and error-aware backend selection
+"""
+
+import logging
+from collections import deque
+from typing import Dict, Any, Deque, List, Optional, Tuple
+
+from retry_policy import CircuitBreaker, CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+# Task types routed to separate model lists
+TASK_GENERATION = 'generation'
+TASK_BRANCH = 'branch'
+TASK_CHOICE = 'choice'
+
+# Smoothing factor for latency and error moving averages
+EWMA_ALPHA = 0.3
+# Latency samples needed before a backend's p95 is trusted for hedging
+MIN_P95_SAMPLES = 20
+
+
+def parse_model_list(value: str, default_model: str, default_base_url: str) -> List[Tuple[str, str]]:
+    """
+    Parse a comma-separated model list.
+
+    Each entry is either ``model`` or ``model@base_url``; entries without a
+    base URL use the default endpoint.
+
+    Args:
+        value (str): Raw configuration value
+        default_model (str): Model used when the list is empty
+        default_base_url (str): Endpoint used for entries without one
+
+    Returns:
+        List[Tuple[str, str]]: (model, base_url) pairs in priority order
+    """
+    routes = []
+    for entry in (value or '').split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        model, _, base_url = entry.partition('@')
+        routes.append((model.strip(), base_url.strip() or default_base_url))
+    if not routes:
+        routes.append((default_model, default_base_url))
+    return routes
+
+
+class Backend:
+    """A model served from one endpoint, with its health statistics."""
+
+    def __init__(self, model: str, base_url: str, breaker: CircuitBreaker):
+        self.model = model
+        self.base_url = base_url
+        self.breaker = breaker
+        self.latency_ewma: Optional[float] = None
+        self.error_ewma = 0.0
+        self.successes = 0
+        self.failures = 0
+        self.latencies: Deque[float] = deque(maxlen=200)
+        # Whether the backend accepts response_format JSON schemas (None until first tried)
+        self.structured_output: Optional[bool] = None
+
+    @property
+    def name(self) -> str:
+        return f"{self.model}@{self.base_url}"
+
+    def latency_p95(self) -> Optional[float]:
+        """Return the p95 of recent successful call latencies, if enough samples exist."""
+        if len(self.latencies) < MIN_P95_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+    def score(self, default_latency: float) -> float:
+        """Lower is healthier: expected latency inflated by the recent error rate."""
+        latency = self.latency_ewma if self.latency_ewma is not None else default_latency
+        return latency * (1.0 + 4.0 * self.error_ewma)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'latency_ewma': self.latency_ewma,
+            'latency_p95': self.latency_p95(),
+            'error_rate': self.error_ewma,
+            'successes': self.successes,
+            'failures': self.failures,
+            'structured_output': self.structured_output,
+            'breaker': self.breaker.stats(),
+        }
+
+
+class ModelRouter:
+    """
+    Route each task type to the healthiest of its configured backends.
+
+    Backends with the same model and endpoint are shared between tasks so
+    their statistics accumulate together.
+    """
+
+    def __init__(self, routes: Dict[str, List[Tuple[str, str]]],
+                 failure_threshold: int = 3, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.backends: Dict[Tuple[str, str], Backend] = {}
+        self.routes: Dict[str, List[Backend]] = {}
+        for task, entries in routes.items():
+            self.routes[task] = [self._get_backend(model, base_url) for model, base_url in entries]
+
+    def _get_backend(self, model: str, base_url: str) -> Backend:
+        key = (model, base_url)
+        if key not in self.backends:
+            self.backends[key] = Backend(model, base_url, CircuitBreaker(self.failure_threshold, self.reset_timeout))
+        return self.backends[key]
+
+    def candidates(self, task: str) -> List[Backend]:
+        """
+        Return the task's available backends ordered from healthiest to least healthy.
+
+        Backends whose circuit breaker is open are left out. Untried backends are
+        scored like the best known one, so configuration order decides between them.
+
+        Raises:
+            CircuitOpenError: If every backend for the task has an open breaker
+        """
+        backends = [b for b in self.routes[task] if b.breaker.is_available()]
+        if not backends:
+            raise CircuitOpenError(task, min(b.breaker.retry_in() for b in self.routes[task]))
+        known = [b.score(0.0) for b in backends if b.latency_ewma is not None]
+        default_latency = min(known) if known else 0.0
+        return sorted(backends, key=lambda b: b.score(default_latency))
+
+    def record_success(self, backend: Backend, latency: float):
+        """Update a backend's statistics after a successful call."""
+        backend.successes += 1
+        backend.latencies.append(latency)
+        if backend.latency_ewma is None:
+            backend.latency_ewma = latency
+        else:
+            backend.latency_ewma = EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * backend.latency_ewma
+        backend.error_ewma = (1 - EWMA_ALPHA) * backend.error_ewma
+        backend.breaker.record_success()
+
+    def record_failure(self, backend: Backend, error: Exception, latency: float):
+        """Update a backend's statistics and circuit breaker after a failed call."""
+        backend.failures += 1
+        backend.error_ewma = EWMA_ALPHA + (1 - EWMA_ALPHA) * backend.error_ewma
+        if backend.latency_ewma is not None:
+            # Count the time wasted on the failed call as a latency sample
+            backend.latency_ewma = EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * backend.latency_ewma
+
+        backend.breaker.record_failure(error)
+        logger.warning(f"Backend {backend.name} failed ({type(error).__name__}), circuit {backend.breaker.state}")
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Return health statistics per backend."""
+        return {backend.name: backend.stats() for backend in self.backends.values()}
@@ -0,0 +1,110 @@
+"""
+Local similarity index for matching free-text choices to step options
+"""
+
+import logging
+import re
+import zlib
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Dimension of the hashed character n-gram space
+VECTOR_DIM = 2048
+# Character n-gram sizes used as features
+NGRAM_SIZES = (2, 3, 4)
+
+
+def _ngram_hashes(text: str) -> List[int]:
+    """Hash the character n-grams of a normalized, space-padded text."""
+    normalized = ' ' + re.sub(r'\W+', ' ', text.lower()).strip() + ' '
+    hashes = []
+    for n in NGRAM_SIZES:
+        for i in range(len(normalized) - n + 1):
+            hashes.append(zlib.crc32(normalized[i:i + n].encode('utf-8')) % VECTOR_DIM)
+    return hashes
+
+
+def vectorize(texts: List[str]) -> np.ndarray:
+    """
+    Vectorize texts as L2-normalized hashed character n-gram counts.
+
+    Args:
+        texts (List[str]): Texts to vectorize
+
+    Returns:
+        np.ndarray: Matrix of shape (len(texts), VECTOR_DIM)
+    """
+    rows = []
+    cols = []
+    for row, text in enumerate(texts):
+        hashes = _ngram_hashes(text)
+        rows.extend([row] * len(hashes))
+        cols.extend(hashes)
+
+    matrix = np.zeros((len(texts), VECTOR_DIM), dtype=np.float32)
+    np.add.at(matrix, (np.asarray(rows, dtype=np.intp), np.asarray(cols, dtype=np.intp)), 1.0)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+    return matrix
+
+
+class OptionIndex:
+    """
+    Cache of option vectors with cosine matching of user choices.
+
+    Vectors are cached by the tuple of a step's option texts, so a step shared
+    by many sessions (or re-loaded from the database) is vectorized once.
+    """
+
+    def __init__(self, max_entries: int = 20000):
+        self.max_entries = max_entries
+        self._vectors: "OrderedDict[Tuple[str, ...], np.ndarray]" = OrderedDict()
+
+    def _option_vectors(self, options: List[Dict[str, Any]]) -> np.ndarray:
+        key = tuple(option['text'] for option in options)
+        vectors = self._vectors.get(key)
+        if vectors is None:
+            vectors = vectorize(list(key))
+            self._vectors[key] = vectors
+            if len(self._vectors) > self.max_entries:
+                self._vectors.popitem(last=False)
+        else:
+            self._vectors.move_to_end(key)
+        return vectors
+
+    def index_quest(self, quest_data: Dict[str, Any]):
+        """Vectorize the options of every step of a quest ahead of choice time."""
+        for step in quest_data.get('quest', {}).get('steps', []):
+            self.index_step(step)
+
+    def index_step(self, step: Dict[str, Any]):
+        """Vectorize the options of one step (e.g. a newly added branch)."""
+        if step.get('options'):
+            self._option_vectors(step['options'])
+
+    def best_match(self, user_choice: str, options: List[Dict[str, Any]]) -> Optional[Tuple[int, float, float]]:
+        """
+        Score a choice against all options of a step in one vectorized operation.
+
+        Args:
+            user_choice (str): The user's free-text choice
+            options (List[Dict[str, Any]]): Options of the current step
+
+        Returns:
+            Optional[Tuple[int, float, float]]: (option index, cosine score, margin over
+            the runner-up), or None if there are no options
+        """
+        if not options:
+            return None
+
+        scores = self._option_vectors(options) @ vectorize([user_choice])[0]
+        best = int(np.argmax(scores))
+        if len(scores) > 1:
+            runner_up = float(np.partition(scores, -2)[-2])
+        else:
+            runner_up = 0.0
+        return best, float(scores[best]), float(scores[best]) - runner_up
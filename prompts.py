@@ -120,11 +120,15 @@ If no option fits, return "None".
 """
 
 
-def get_new_branch_prompt(user_choice: str, current_step_text: str, language: str = 'ru') -> str:
-    """Generate prompt for creating a new quest branch when no suitable option is found."""
+def get_new_branch_prompt(user_choice: str, current_step_text: str, language: str = 'ru', story_so_far: str = '') -> str:
+    """
+    Generate prompt for creating a new quest branch when no suitable option is found.
+    story_so_far is the session's capped story summary, so the prompt size stays bounded.
+    """
     if language == 'en':
+        story = f"Story so far (step → choice):\n{story_so_far}\n\n" if story_so_far else ""
         return f"""
-User selected: "{user_choice}"
+{story}User selected: "{user_choice}"
 
 Current step:
 {current_step_text}
@@ -155,8 +159,9 @@ Important:
 - Each step should contain 2-3 choice options
 """
     else:  # Default to Russian
+        story = f"История до этого момента (шаг → выбор):\n{story_so_far}\n\n" if story_so_far else ""
         return f"""
-Пользователь выбрал: "{user_choice}"
+{story}Пользователь выбрал: "{user_choice}"
 
 Текущий шаг:
 {current_step_text}
@@ -185,4 +190,270 @@ Important:
 - Используй только русский язык
 - Сделай сценарий дружелюбным и мотивирующим для детей
 - Каждый шаг должен содержать 2-3 варианта выбора
-"""
\ No newline at end of file
+"""
+
+def get_batch_choice_matching_prompt(requests_text: str, language: str = 'ru') -> str:
+    """Generate prompt for matching several users' choices with their options in one request."""
+    if language == 'en':
+        return f"""
+Below are several independent requests. Each request has the user's answer and numbered choice options.
+
+{requests_text}
+
+For each request, determine which choice option best matches the user's answer.
+Return only a JSON object that maps each request number to the number of the matching option,
+or to 0 if no option fits, for example: {{"1": 2, "2": 0}}
+"""
+    else:  # Default to Russian
+        return f"""
+Ниже несколько независимых запросов. В каждом есть ответ пользователя и пронумерованные варианты выбора.
+
+{requests_text}
+
+Для каждого запроса определи, какой вариант выбора наиболее соответствует ответу пользователя.
+Верни только JSON-объект, в котором номеру каждого запроса соответствует номер подходящего варианта,
+или 0, если ни один вариант не подходит, например: {{"1": 2, "2": 0}}
+"""
+
+
+def get_quest_skeleton_prompt(requirements: str, language: str = 'ru') -> str:
+    """Generate prompt for the graph skeleton of a quest: step ids, edges and one-line beats, no prose."""
+    if language == 'en':
+        return f"""
+Plan a text-based quest for children (ages 5-7) based on the following requirements:
+
+{requirements}
+
+Do not write the story yet. Return only its plan: 3-5 main steps with 2-3 choice options each,
+no cycles, a single start step and several positive, educational endings (steps without options).
+Describe each step and each choice in one short line.
+
+Response must be in JSON format with the following structure:
+{{
+    "skeleton": {{
+        "title": "Quest title",
+        "startStepId": "step_1",
+        "steps": [
+            {{
+                "id": "step_1",
+                "beat": "What happens in this step, in one line",
+                "options": [
+                    {{"beat": "What the child chooses, in one line", "nextStepId": "step_2a"}}
+                ]
+            }}
+        ]
+    }}
+}}
+
+Return the response strictly in valid JSON format, without extra text, comments or explanations.
+Use only English language.
+"""
+    else:  # Default to Russian
+        return f"""
+Составь план текстового квеста для детей (возраст 5-7 лет) на основе следующих требований:
+
+{requirements}
+
+Не пиши саму историю. Верни только её план: 3-5 основных шагов с 2-3 вариантами выбора в каждом,
+без циклов, с одним начальным шагом и несколькими позитивными, познавательными концовками (шагами без вариантов).
+Опиши каждый шаг и каждый выбор одной короткой строкой.
+
+Ответ должен быть в формате JSON со следующей структурой:
+{{
+    "skeleton": {{
+        "title": "Название квеста",
+        "startStepId": "step_1",
+        "steps": [
+            {{
+                "id": "step_1",
+                "beat": "Что происходит на этом шаге, одной строкой",
+                "options": [
+                    {{"beat": "Что выбирает ребёнок, одной строкой", "nextStepId": "step_2a"}}
+                ]
+            }}
+        ]
+    }}
+}}
+
+Верни ответ строго в виде валидного JSON, без лишнего текста, комментариев или пояснений.
+Используй только русский язык.
+"""
+
+
+def get_step_fill_prompt(requirements: str, title: str, story_so_far: str, step_beat: str,
+                         option_beats: list, language: str = 'ru') -> str:
+    """Generate prompt for writing the text, image and option labels of one skeleton step."""
+    options_text = "\n".join(f"{i}. {beat}" for i, beat in enumerate(option_beats, 1))
+    if language == 'en':
+        story = f"Story so far (step → choice):\n{story_so_far}\n\n" if story_so_far else ""
+        choices = (f"Choices, in this order:\n{options_text}\n\n" if option_beats
+                   else "This is an ending: return an empty options list.\n\n")
+        return f"""
+Quest for children (ages 5-7): "{title}"
+Requirements: {requirements}
+
+{story}Write this step of the quest: {step_beat}
+
+{choices}Response must be in JSON format with the following structure:
+{{
+    "image": "Image description for the step",
+    "text": "Scenario text for the step",
+    "options": [
+        {{"text": "Choice option 1", "emoji": "😀"}}
+    ]
+}}
+
+Return exactly one option per choice above, in the same order.
+Return the response strictly in valid JSON format, without extra text, comments or explanations.
+Use only English language and keep the text friendly and motivating for children.
+"""
+    else:  # Default to Russian
+        story = f"История до этого момента (шаг → выбор):\n{story_so_far}\n\n" if story_so_far else ""
+        choices = (f"Варианты выбора, в этом порядке:\n{options_text}\n\n" if option_beats
+                   else "Это концовка: верни пустой список вариантов.\n\n")
+        return f"""
+Квест для детей (возраст 5-7 лет): "{title}"
+Требования: {requirements}
+
+{story}Напиши этот шаг квеста: {step_beat}
+
+{choices}Ответ должен быть в формате JSON со следующей структурой:
+{{
+    "image": "Описание изображения для шага",
+    "text": "Текст сценария шага",
+    "options": [
+        {{"text": "Вариант выбора 1", "emoji": "😀"}}
+    ]
+}}
+
+Верни ровно один вариант на каждый выбор выше, в том же порядке.
+Верни ответ строго в виде валидного JSON, без лишнего текста, комментариев или пояснений.
+Используй только русский язык, текст должен быть дружелюбным и мотивирующим для детей.
+"""
+
+
+def get_quest_generation_wire_prompt(requirements: str, language: str = 'ru') -> str:
+    """Generate prompt for creating a new quest in the compact line-oriented wire format (see quest_wire)."""
+    if language == 'en':
+        return f"""
+Create a text-based quest for children (ages 5-7) based on the following requirements:
+
+{requirements}
+
+The quest should be:
+- Simple and understandable for young children
+- Educational but fun
+- Contain 3-5 main steps with choice options
+- Include interesting characters (animals, magic, nature)
+- Have multiple endings
+
+Write it in this line format, without JSON:
+T Quest title
+# step_1
+~ Image description for step
+Scenario text for step
+> step_2a 😀 Choice option 1
+> step_2b 🌲 Choice option 2
+# step_2a
+...
+
+"T" is the title, "#" starts a step (the first step is the start), "~" is the image description,
+">" is a choice: the id of the step it leads to, an emoji and the choice text. Ending steps have no choices.
+Every step id used in a choice must have its own "#" block. Return only the quest, without extra text.
+
+Important:
+- Use only English language
+- Make the scenario friendly and motivating for children
+- Each step should contain 2-3 choice options
+- Endings must be positive and educational
+"""
+    else:  # Default to Russian
+        return f"""
+Создай текстовый квест для детей (возраст 5-7 лет) на основе следующих требований:
+
+{requirements}
+
+Квест должен быть:
+- Простым и понятным для маленьких детей
+- Образовательным, но веселым
+- Содержать 3-5 основных шагов с вариантами выбора
+- Иметь интересные образы (животные, магия, природа)
+- Включать несколько концовок
+
+Запиши его в таком построчном формате, без JSON:
+T Название квеста
+# step_1
+~ Описание изображения для шага
+Текст сценария шага
+> step_2a 😀 Вариант выбора 1
+> step_2b 🌲 Вариант выбора 2
+# step_2a
+...
+
+"T" - название, "#" начинает шаг (первый шаг - начальный), "~" - описание изображения,
+">" - вариант выбора: id шага, к которому он ведёт, эмодзи и текст варианта. У концовок нет вариантов.
+Для каждого id шага из вариантов должен быть свой блок "#". Верни только квест, без лишнего текста.
+
+Важно:
+- Используй только русский язык
+- Сделай сценарий дружелюбным и мотивирующим для детей
+- Каждый шаг должен содержать 2-3 варианта выбора
+- Концовки должны быть позитивными и образовательными
+"""
+
+
+def get_new_branch_wire_prompt(user_choice: str, current_step_text: str, language: str = 'ru',
+                               story_so_far: str = '') -> str:
+    """Generate prompt for creating a new quest branch in the compact line-oriented wire format."""
+    if language == 'en':
+        story = f"Story so far (step → choice):\n{story_so_far}\n\n" if story_so_far else ""
+        return f"""
+{story}User selected: "{user_choice}"
+
+Current step:
+{current_step_text}
+
+Create a new quest step that corresponds to the user's choice.
+The step should be a logical continuation of the story and contain 2-3 choice options.
+
+Write it in this line format, without JSON:
+# step_new_1
+~ Image description for new step
+New step scenario text
+> step_new_2a 😀 Choice option 1
+> step_new_2b 🌲 Choice option 2
+
+"~" is the image description, ">" is a choice: the id of the next step, an emoji and the choice text.
+Return only the step, without extra text.
+
+Important:
+- Use only English language
+- Make the scenario friendly and motivating for children
+- Each step should contain 2-3 choice options
+"""
+    else:  # Default to Russian
+        story = f"История до этого момента (шаг → выбор):\n{story_so_far}\n\n" if story_so_far else ""
+        return f"""
+{story}Пользователь выбрал: "{user_choice}"
+
+Текущий шаг:
+{current_step_text}
+
+Создай новый шаг квеста, который соответствует выбору пользователя.
+Шаг должен быть логичным продолжением истории и содержать 2-3 варианта выбора.
+
+Запиши его в таком построчном формате, без JSON:
+# step_new_1
+~ Описание изображения для нового шага
+Текст сценария нового шага
+> step_new_2a 😀 Вариант выбора 1
+> step_new_2b 🌲 Вариант выбора 2
+
+"~" - описание изображения, ">" - вариант выбора: id следующего шага, эмодзи и текст варианта.
+Верни только шаг, без лишнего текста.
+
+Важно:
+- Используй только русский язык
+- Сделай сценарий дружелюбным и мотивирующим для детей
+- Каждый шаг должен содержать 2-3 варианта выбора
+"""
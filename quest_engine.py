@@ -1,143 +1,683 @@
+import asyncio
+import hashlib
 import json
 import logging
+import re
 import time
-from typing import Dict, List, Optional, Any
-from openai import OpenAI
-from config import OPENROUTER_API_KEY, OPENROUTER_BASE_URL, MODEL_NAME
+from collections import OrderedDict
+from typing import Dict, List, Optional, Any, Callable, Awaitable, Tuple, Union
+from config import (
+    OPENROUTER_API_KEY, OPENROUTER_BASE_URL, MODEL_NAME,
+    GENERATION_MODELS, BRANCH_MODELS, CHOICE_MODELS,
+    GENERATION_TIMEOUT, BRANCH_TIMEOUT, CHOICE_TIMEOUT, HEDGE_REQUESTS,
+    CHOICE_BATCHING, CHOICE_BATCH_WINDOW_MS, CHOICE_BATCH_SIZE,
+    OPTION_INDEX_ENABLED, OPTION_INDEX_MIN_SCORE, OPTION_INDEX_MIN_MARGIN,
+    RETRY_MAX_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY,
+    BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT,
+    LLM_CASSETTE_MODE, LLM_CASSETTE_PATH, LLM_CASSETTE_LATENCY_SCALE,
+    BRANCH_MEMO_SIZE, STRUCTURED_OUTPUT, WIRE_FORMAT_MODELS, QUEST_SKELETON_FIRST, QUEST_SKELETON_CONCURRENCY, GENERATION_RACE, GENERATION_RACE_MAX_K, GENERATION_RACE_TARGET_FAILURE
+)
 
 # Import our refactored components - using relative imports from the same directory
-from json_schemas import FULL_QUEST_SCHEMA, NEW_STEP_SCHEMA
+from json_schemas import FULL_QUEST_SCHEMA, NEW_STEP_SCHEMA, QUEST_SKELETON_SCHEMA, STEP_FILL_SCHEMA
 from prompts import (
     get_quest_generation_prompt,
+    get_quest_generation_wire_prompt,
+    get_quest_skeleton_prompt,
+    get_step_fill_prompt,
     get_choice_matching_prompt,
-    get_new_branch_prompt
+    get_batch_choice_matching_prompt,
+    get_new_branch_prompt,
+    get_new_branch_wire_prompt
 )
-from json_utils import extract_json_from_response, extract_choice_result
+from json_utils import extract_json_from_response, extract_choice_result, JsonFieldStreamer
 from quest_validation import is_valid_quest_graph
+from model_router import ModelRouter, parse_model_list, TASK_GENERATION, TASK_BRANCH, TASK_CHOICE
+from choice_batcher import ChoiceBatcher, ChoiceJob
+from retry_policy import RetryPolicy, CircuitOpenError
+from option_index import OptionIndex
+from llm_cassette import Cassette, CassetteClient, MODE_RECORD, MODE_REPLAY
+from generation_race import RaceController
+from structured_output import response_format, is_unsupported_error, ParseStats
+from quest_library import freeze, thaw
+from quest_wire import WireParser, parse_quest as parse_wire_quest, parse_step as parse_wire_step
+import tracing
 
 logger = logging.getLogger(__name__)
 
+# Default per-call budgets (seconds) used when the caller passes no deadline
+DEFAULT_TIMEOUTS = {
+    TASK_GENERATION: GENERATION_TIMEOUT,
+    TASK_BRANCH: BRANCH_TIMEOUT,
+    TASK_CHOICE: CHOICE_TIMEOUT,
+}
+
+
+def make_deadline(task: str, deadline: Optional[float] = None) -> float:
+    """Return the given absolute deadline, or the task's default budget from now."""
+    if deadline is not None:
+        return deadline
+    return time.monotonic() + DEFAULT_TIMEOUTS[task]
+
+
+def normalize_choice(user_choice: str) -> str:
+    """Lowercase a free-text choice and collapse punctuation and whitespace."""
+    return ' '.join(re.sub(r'\W+', ' ', user_choice.lower()).split())
+
+
+def response_tokens(response) -> int:
+    """Return the total tokens a completion response reports, or 0 if it has no usage."""
+    usage = getattr(response, 'usage', None)
+    if usage is None:
+        return 0
+    total = getattr(usage, 'total_tokens', None)
+    if total is None:
+        total = (getattr(usage, 'prompt_tokens', 0) or 0) + (getattr(usage, 'completion_tokens', 0) or 0)
+    return total or 0
+
+
+def skeleton_paths(skeleton: Dict[str, Any]) -> Dict[str, str]:
+    """
+    Describe how each step of a skeleton is reached from the start.
+
+    Returns:
+        Dict[str, str]: For each reachable step id, the beats and choices on a
+        shortest path to it, one "step beat → choice beat" line per step
+    """
+    steps = {step['id']: step for step in skeleton['steps']}
+    paths = {skeleton['startStepId']: []}
+    queue = [skeleton['startStepId']]
+    for step_id in queue:
+        step = steps[step_id]
+        for option in step.get('options', []):
+            next_id = option['nextStepId']
+            if next_id not in paths:
+                paths[next_id] = paths[step_id] + [f"{step['beat']} → {option['beat']}"]
+                queue.append(next_id)
+    return {step_id: "\n".join(path) for step_id, path in paths.items()}
+
+
+def branch_step_id(step_id: str, user_choice: str) -> str:
+    """
+    Allocate the id of a branch created for a choice at a step.
+
+    The id is derived from the step id and the normalized choice, so it is
+    unique per branch point and the same branch gets the same id in every session.
+    """
+    digest = hashlib.sha1(f"{step_id}\n{normalize_choice(user_choice)}".encode('utf-8')).hexdigest()
+    return f"branch_{digest[:12]}"
+
+
+class ChoiceMatchError(Exception):
+    """Raised when a choice could not be matched by the model at all, as opposed to matching no option."""
+
+
 class QuestEngine:
     def __init__(self):
-        # Initialize with real API configuration using OpenAI client
-        self.client = OpenAI(
-            api_key=OPENROUTER_API_KEY,
-            base_url=OPENROUTER_BASE_URL
+        # Route each task type to its own list of models and endpoints
+        self.router = ModelRouter({
+            TASK_GENERATION: parse_model_list(GENERATION_MODELS, MODEL_NAME, OPENROUTER_BASE_URL),
+            TASK_BRANCH: parse_model_list(BRANCH_MODELS, MODEL_NAME, OPENROUTER_BASE_URL),
+            TASK_CHOICE: parse_model_list(CHOICE_MODELS, MODEL_NAME, OPENROUTER_BASE_URL),
+        }, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT)
+        # Shared retry policy: error classification, Retry-After and jittered backoff
+        self.retry_policy = RetryPolicy(RETRY_MAX_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY)
+        # One async OpenAI client per endpoint, so that LLM calls do not block the bot's event loop
+        self.clients: Dict[str, Any] = {}
+        # Optional micro-batching of choice-matching requests across users
+        self.choice_batcher = ChoiceBatcher(
+            self._match_choice_batch,
+            window=CHOICE_BATCH_WINDOW_MS / 1000,
+            max_batch_size=CHOICE_BATCH_SIZE
+        ) if CHOICE_BATCHING else None
+        # Local n-gram similarity index that resolves most choices without a model call
+        self.option_index = OptionIndex() if OPTION_INDEX_ENABLED else None
+        # Optional record/replay of LLM traffic for offline, reproducible runs
+        self.cassette = Cassette(LLM_CASSETTE_PATH) if LLM_CASSETTE_MODE in (MODE_RECORD, MODE_REPLAY) else None
+        # Generated branches (frozen) by (quest id, step id, normalized choice), reused for repeated off-script choices
+        self.branch_memo: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
+        self.branch_memo_hits = 0
+        # Recent validation failure rate, adaptive race width and token accounting for generation
+        self.race = RaceController(max_k=GENERATION_RACE_MAX_K, target_failure=GENERATION_RACE_TARGET_FAILURE)
+        # Parse-failure and retry rates with and without schema-constrained output
+        self.parse_stats = ParseStats()
+        
+    def index_quest(self, quest_data: Dict[str, Any]):
+        """Precompute option vectors for a newly loaded quest."""
+        if self.option_index is not None:
+            self.option_index.index_quest(quest_data)
+
+    def index_step(self, step: Dict[str, Any]):
+        """Precompute option vectors for a newly added branch step."""
+        if self.option_index is not None:
+            self.option_index.index_step(step)
+
+    def find_branch(self, quest_id: Optional[str], current_step: Dict[str, Any], user_choice: str) -> Optional[Dict[str, Any]]:
+        """Return a session's own copy of a branch already generated for this choice at this step, if any."""
+        if not quest_id or BRANCH_MEMO_SIZE <= 0:
+            return None
+        key = (quest_id, current_step['id'], normalize_choice(user_choice))
+        branch = self.branch_memo.get(key)
+        if branch is not None:
+            self.branch_memo.move_to_end(key)
+            self.branch_memo_hits += 1
+            return thaw(branch)
+        return None
+
+    def _finish_branch(self, quest_id: Optional[str], current_step: Dict[str, Any], user_choice: str,
+                       new_step: Dict[str, Any]) -> Dict[str, Any]:
+        """Give a generated branch its allocated id and remember it for the quest."""
+        generated_id = new_step['id']
+        new_step['id'] = branch_step_id(current_step['id'], user_choice)
+        # Keep options that loop back to the step pointing at it under its new id
+        for option in new_step.get('options', []):
+            if option.get('nextStepId') == generated_id:
+                option['nextStepId'] = new_step['id']
+        
+        if quest_id and BRANCH_MEMO_SIZE > 0:
+            # Sessions may change their steps, so the memo keeps its own read-only copy
+            self.branch_memo[(quest_id, current_step['id'], normalize_choice(user_choice))] = freeze(new_step)
+            if len(self.branch_memo) > BRANCH_MEMO_SIZE:
+                self.branch_memo.popitem(last=False)
+        return new_step
+
+    def _get_client(self, base_url: str):
+        """Return the OpenAI client for an endpoint, creating it on first use."""
+        if base_url not in self.clients:
+            client = None
+            if LLM_CASSETTE_MODE != MODE_REPLAY:
+                # openai is imported lazily to keep it off the startup path
+                from openai import AsyncOpenAI
+                client = AsyncOpenAI(
+                    api_key=OPENROUTER_API_KEY,
+                    base_url=base_url,
+                    # Retries are handled by the engine's retry policy and circuit breakers
+                    max_retries=0
+                )
+            if self.cassette is not None:
+                client = CassetteClient(base_url, LLM_CASSETTE_MODE, self.cassette, client, LLM_CASSETTE_LATENCY_SCALE)
+            self.clients[base_url] = client
+        return self.clients[base_url]
+    
+    def _structured_params(self, backend, params: Dict[str, Any],
+                           schema: Optional[Tuple[str, Dict[str, Any]]]) -> Dict[str, Any]:
+        """Add a JSON schema constraint to the call parameters unless the backend is known to reject it."""
+        if schema is None or not STRUCTURED_OUTPUT or backend.structured_output is False:
+            return params
+        return dict(params, response_format=response_format(*schema))
+
+    def _uses_wire_format(self, backend) -> bool:
+        """Whether a backend's model is asked for the compact wire format instead of JSON."""
+        return backend.model in WIRE_FORMAT_MODELS or '*' in WIRE_FORMAT_MODELS
+
+    async def _request(self, backend, prompt: str, deadline: float, params: Dict[str, Any]):
+        """Send one chat completion request to a backend, bounded by the deadline."""
+        return await asyncio.wait_for(
+            self._get_client(backend.base_url).chat.completions.create(
+                model=backend.model,
+                messages=[
+                    {"role": "user", "content": prompt}
+                ],
+                **params
+            ),
+            timeout=max(deadline - time.monotonic(), 0)
         )
-        self.model_name = MODEL_NAME
+
+    async def _attempt(self, backend, prompt: str, deadline: float, parse: Callable[[str], Any], params: Dict[str, Any],
+                       usage: Optional[List[int]] = None, schema: Optional[Tuple[str, Dict[str, Any]]] = None,
+                       wire: Optional[Tuple[str, Callable[[str], Any]]] = None) -> Any:
+        """
+        Make one call to a backend, bounded by the deadline, and parse the answer.
+        Cancellation (deadline passed, hedge lost, request abandoned) cancels the HTTP request.
+        Reported token usage is appended to the usage list, if given. With a (name, schema)
+        pair the answer is constrained to the schema where the backend supports it; with a
+        (prompt, parse) wire pair, backends configured for the wire format use those instead.
+        """
+        if not backend.breaker.allow():
+            raise CircuitOpenError(backend.name, backend.breaker.retry_in())
+        if wire is not None and self._uses_wire_format(backend):
+            request_prompt, request_parse = wire
+            request_params = params
+            mode = 'wire'
+        else:
+            request_prompt, request_parse = prompt, parse
+            request_params = self._structured_params(backend, params, schema)
+            mode = 'constrained' if request_params is not params else 'free'
+        start = time.monotonic()
+        try:
+            try:
+                response = await self._request(backend, request_prompt, deadline, request_params)
+            except Exception as e:
+                if mode != 'constrained' or not is_unsupported_error(e):
+                    raise
+                # Not a backend failure: remember that it rejects structured output and ask again
+                # without it, under the breaker permission (or half-open probe) already claimed
+                logger.info(f"Backend {backend.name} does not support structured output: {e}")
+                backend.structured_output = False
+                mode = 'free'
+                response = await self._request(backend, request_prompt, deadline, params)
+        except asyncio.CancelledError:
+            # The call was abandoned, not judged: let the next call probe a half-open backend
+            backend.breaker.release_probe()
+            raise
+        except Exception as e:
+            self.router.record_failure(backend, e, time.monotonic() - start)
+            raise
+        self.router.record_success(backend, time.monotonic() - start)
+        if mode == 'constrained':
+            backend.structured_output = True
+        if usage is not None:
+            usage.append(response_tokens(response))
+        result = request_parse(response.choices[0].message.content)
+        if schema is not None:
+            self.parse_stats.record_answer(schema[0], mode, result is not None)
+        return result
+
+    async def _complete(self, task: str, prompt: str, deadline: float,
+                        parse: Optional[Callable[[str], Any]] = None, usage: Optional[List[int]] = None,
+                        schema: Optional[Tuple[str, Dict[str, Any]]] = None,
+                        wire: Optional[Tuple[str, Callable[[str], Any]]] = None, **params) -> Any:
+        """
+        Run a chat completion for the given task type on the healthiest backend,
+        failing over to the next backend when one errors out, times out or is rate-limited.
+
+        With hedging enabled, a duplicate request is fired on the next backend once the
+        primary passes its p95 latency; the first valid (parsed, non-None) answer wins
+        and the other request is cancelled. Backends configured for the compact wire
+        format get the wire (prompt, parse) pair, if one is given, instead of the JSON prompt.
+
+        Returns:
+            Any: The parsed answer, or None if a backend answered but the answer was invalid
+        """
+        parse = parse or (lambda content: content)
+        candidates = self.router.candidates(task)
+        next_index = 0
+        pending = set()
+        primary = None
+        primary_start = 0.0
+        hedged = False
+        invalid = False
+        last_error: Optional[Exception] = None
+
+        try:
+            while True:
+                if not pending:
+                    if invalid or next_index >= len(candidates):
+                        break
+                    if deadline - time.monotonic() <= 0:
+                        raise asyncio.TimeoutError(f"Deadline exceeded for {task} call")
+                    primary = candidates[next_index]
+                    next_index += 1
+                    primary_start = time.monotonic()
+                    hedged = False
+                    pending.add(asyncio.create_task(self._attempt(primary, prompt, deadline, parse, params, usage, schema, wire)))
+
+                hedge_wait = None
+                if HEDGE_REQUESTS and not hedged:
+                    p95 = primary.latency_p95()
+                    if p95 is not None:
+                        hedge_wait = max(p95 - (time.monotonic() - primary_start), 0)
+
+                done, pending = await asyncio.wait(pending, timeout=hedge_wait, return_when=asyncio.FIRST_COMPLETED)
+                for finished in done:
+                    if finished.exception() is not None:
+                        last_error = finished.exception()
+                    elif finished.result() is not None:
+                        return finished.result()
+                    else:
+                        invalid = True
+
+                if not done and hedge_wait is not None:
+                    # Primary is slower than its p95: fire a hedged duplicate
+                    backup = candidates[next_index] if next_index < len(candidates) else primary
+                    if backup is not primary:
+                        next_index += 1
+                    logger.info(f"Hedging {task} request on {backup.name} after {time.monotonic() - primary_start:.1f}s")
+                    pending.add(asyncio.create_task(self._attempt(backup, prompt, deadline, parse, params, usage, schema, wire)))
+                    hedged = True
+        finally:
+            for leftover in pending:
+                leftover.cancel()
+
+        if invalid:
+            return None
+        raise last_error or asyncio.TimeoutError(f"No backend answered the {task} call")
+
+    def _parse_quest(self, content: str) -> Optional[Dict[str, Any]]:
+        """Parse a generated quest and check that it forms a valid quest graph."""
+        return self._validate_quest(extract_json_from_response(str(content), FULL_QUEST_SCHEMA))
+
+    def _parse_quest_wire(self, content: str) -> Optional[Dict[str, Any]]:
+        """Parse a quest generated in the wire format and check that it forms a valid quest graph."""
+        return self._validate_quest(parse_wire_quest(str(content)))
+
+    def _validate_quest(self, result: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        # Validate that the quest forms a valid acyclic directed graph
+        # with one input and multiple outputs
+        with tracing.span('validation'):
+            valid = result is None or is_valid_quest_graph(result)
+        if not valid:
+            logger.warning("Generated quest failed validation checks")
+            return None
+        return result
+
+    def _parse_skeleton(self, content: str) -> Optional[Dict[str, Any]]:
+        """Parse a quest skeleton and check that its graph is a valid quest graph."""
+        result = extract_json_from_response(str(content), QUEST_SKELETON_SCHEMA)
+        if result is None:
+            return None
+        skeleton = result['skeleton']
+        graph = {'quest': {
+            'startStepId': skeleton['startStepId'],
+            'steps': [
+                {'id': step['id'], 'options': [{'nextStepId': option['nextStepId']} for option in step.get('options', [])]}
+                for step in skeleton['steps']
+            ],
+        }}
+        with tracing.span('validation'):
+            valid = (len({step['id'] for step in skeleton['steps']}) == len(skeleton['steps'])
+                     and is_valid_quest_graph(graph))
+        if not valid:
+            logger.warning("Generated quest skeleton failed validation checks")
+            return None
+        return skeleton
+
+    def _parse_step_fill(self, content: str, option_count: int) -> Optional[Dict[str, Any]]:
+        """Parse the prose of a skeleton step; it must label every skeleton option."""
+        result = extract_json_from_response(str(content), STEP_FILL_SCHEMA)
+        if result is None or len(result['options']) != option_count:
+            return None
+        return result
+
+    async def _fill_step(self, requirements: str, user_language: str, skeleton: Dict[str, Any],
+                         step: Dict[str, Any], story_so_far: str, deadline: float,
+                         semaphore: asyncio.Semaphore) -> Optional[Dict[str, Any]]:
+        """Write the text, image and option labels of one skeleton step."""
+        options = step.get('options', [])
+        prompt = get_step_fill_prompt(requirements, skeleton['title'], story_so_far, step['beat'],
+                                      [option['beat'] for option in options], user_language)
+        async with semaphore:
+            fill = await self._complete(TASK_BRANCH, prompt, deadline,
+                                        parse=lambda content: self._parse_step_fill(content, len(options)),
+                                        schema=('step_fill', STEP_FILL_SCHEMA),
+                                        temperature=0.7, max_tokens=2048)
+        if fill is None:
+            return None
+        return {
+            'id': step['id'],
+            'image': fill['image'],
+            'text': fill['text'],
+            'options': [
+                {'text': label['text'], 'nextStepId': option['nextStepId'], 'emoji': label.get('emoji', '')}
+                for label, option in zip(fill['options'], options)
+            ],
+        }
+
+    async def _generate_from_skeleton(self, requirements: str, user_language: str,
+                                      deadline: float) -> Optional[Dict[str, Any]]:
+        """
+        Generate a quest in two phases: a small validated graph skeleton, then the
+        prose of every step written by concurrent calls.
+
+        Returns:
+            Optional[Dict[str, Any]]: The assembled quest, or None if the skeleton
+            or any step came back invalid, or a step could not be written
+        """
+        prompt = get_quest_skeleton_prompt(requirements, user_language)
+        with tracing.span('llm_skeleton'):
+            skeleton = await self._complete(TASK_GENERATION, prompt, deadline, parse=self._parse_skeleton,
+                                            schema=('quest_skeleton', QUEST_SKELETON_SCHEMA),
+                                            temperature=0.7, max_tokens=4096)
+        if skeleton is None:
+            return None
         
-    async def generate_quest(self, requirements: str, user_language: str = 'ru') -> Optional[Dict[str, Any]]:
+        paths = skeleton_paths(skeleton)
+        semaphore = asyncio.Semaphore(QUEST_SKELETON_CONCURRENCY)
+        tasks = [
+            asyncio.create_task(self._fill_step(requirements, user_language, skeleton, step,
+                                                paths.get(step['id'], ''), deadline, semaphore))
+            for step in skeleton['steps']
+        ]
+        pending = set(tasks)
+        try:
+            with tracing.span('llm_fill_steps'):
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    # One failed step fails the quest: stop writing the others at once
+                    errors = [finished.exception() for finished in done if finished.exception() is not None]
+                    if errors:
+                        logger.warning(f"Filling a quest skeleton step failed: {errors[0]}")
+                        return None
+                    if any(finished.result() is None for finished in done):
+                        logger.warning("Filling a quest skeleton step failed validation")
+                        return None
+        finally:
+            for task in pending:
+                task.cancel()
+        steps = [task.result() for task in tasks]
+        return {'quest': {'title': skeleton['title'], 'startStepId': skeleton['startStepId'], 'steps': steps}}
+
+    def _parse_new_step(self, content: str) -> Optional[Dict[str, Any]]:
+        """Parse a generated branch step."""
+        return extract_json_from_response(str(content), NEW_STEP_SCHEMA)
+
+    def _parse_new_step_wire(self, content: str) -> Optional[Dict[str, Any]]:
+        """Parse a branch step generated in the wire format."""
+        return parse_wire_step(str(content))
+        
+    async def generate_quest(self, requirements: str, user_language: str = 'ru', deadline: Optional[float] = None) -> Optional[Dict[str, Any]]:
         """
         Generate a quest scenario using LLM based on user requirements.
-        This uses the OpenRouter API with qwen/qwen3-4b:free model.
+        This uses the OpenRouter models configured for the generation route.
+        The deadline (a time.monotonic() value) bounds all attempts together.
         """
-        max_retries = 3
-        retry_delay = 1  # seconds
+        deadline = make_deadline(TASK_GENERATION, deadline)
+        self.parse_stats.record_request('quest')
         
-        for attempt in range(max_retries):
+        for attempt in range(self.retry_policy.max_attempts):
+            error = None
             try:
-                # Prepare the prompt for generating quest
-                prompt = get_quest_generation_prompt(requirements, user_language)
-                
-                # Make the API call using OpenAI client
-                response = self.client.chat.completions.create(
-                    model=self.model_name,
-                    messages=[
-                        {"role": "user", "content": prompt}
-                    ],
-                    temperature=0.7,
-                    max_tokens=32768
-                )
-                
+                if QUEST_SKELETON_FIRST:
+                    # Plan the graph first, then write every step concurrently
+                    result = await self._generate_from_skeleton(requirements, user_language, deadline)
+                    if result is not None:
+                        return result
+                    logger.warning(f"Skeleton-first generation failed (attempt {attempt + 1}), "
+                                   f"falling back to a single completion")
                 
-                # Extract the generated quest from the response
-                content = response.choices[0].message.content
-                result = extract_json_from_response(str(content), FULL_QUEST_SCHEMA)
+                # Prepare the prompt for generating quest, and its compact variant for wire-format models
+                prompt = get_quest_generation_prompt(requirements, user_language)
+                wire = (get_quest_generation_wire_prompt(requirements, user_language), self._parse_quest_wire)
                 
-                # Validate that the quest forms a valid acyclic directed graph
-                # with one input and multiple outputs
-                if result is not None and not is_valid_quest_graph(result):
-                    logger.warning("Generated quest failed validation checks")
-                    if attempt < max_retries - 1:
-                        logger.warning(f"Quest validation failed (attempt {attempt + 1}). Retrying in {retry_delay} seconds...")
-                        time.sleep(retry_delay)
-                        continue
-                    else:
-                        logger.error("Failed quest validation after all retries")
-                        return None
+                # Make the API call on the generation route; the answer is parsed
+                # and graph-validated so that hedged and raced requests compete for a valid quest
+                k = self.race.choose_k() if GENERATION_RACE else 1
+                if k > 1:
+                    result = await self._race_generation(prompt, wire, deadline, k)
+                else:
+                    result = await self._complete(TASK_GENERATION, prompt, deadline, parse=self._parse_quest,
+                                                  schema=('quest', FULL_QUEST_SCHEMA), wire=wire,
+                                                  temperature=0.7, max_tokens=32768)
+                    self.race.record_outcome(result is not None)
                 
-                # If extraction was successful, return the result
+                # If extraction and validation were successful, return the result
                 if result is not None:
                     return result
-                # If we get here, JSON extraction failed - retry if not last attempt
-                if attempt < max_retries - 1:
-                    logger.warning(f"JSON extraction failed for quest generation (attempt {attempt + 1}). Retrying in {retry_delay} seconds...")
-                    time.sleep(retry_delay)
-                    continue
-                else:
-                    logger.error("Failed to extract valid JSON after all retries")
-                    return None
-
+                logger.warning(f"Quest extraction or validation failed (attempt {attempt + 1})")
+            except CircuitOpenError:
+                # Every generation backend is down: fail fast instead of retrying
+                raise
             except Exception as e:
-                # If there's an exception during API call or processing, retry if not last attempt
-                if attempt < max_retries - 1:
-                    logger.warning(f"Error generating quest (attempt {attempt + 1}): {str(e)}. Retrying in {retry_delay} seconds...")
-                    time.sleep(retry_delay)
-                    continue
-                else:
-                    logger.error(f"Error generating quest after all retries: {str(e)}")
-                    return None
+                error = e
+                logger.warning(f"Error generating quest (attempt {attempt + 1}): {str(e)}")
+            
+            # Retry only if the policy considers the failure retryable within the deadline
+            delay = self.retry_policy.next_delay(attempt, error, deadline)
+            if delay is None:
+                logger.error(f"Failed to generate a valid quest after {attempt + 1} attempts")
+                return None
+            logger.info(f"Retrying quest generation in {delay:.1f} seconds...")
+            self.parse_stats.record_retry('quest')
+            await asyncio.sleep(delay)
+        return None
     
-    async def process_choice(self, current_step: Dict[str, Any], user_choice: str, all_steps: List[Dict], user_language: str = 'ru') -> Optional[str]:
+    async def _race_generation(self, prompt: str, wire: Tuple[str, Callable[[str], Any]], deadline: float,
+                               k: int) -> Optional[Dict[str, Any]]:
         """
-        Process user's choice and find the best matching option using LLM.
-        Uses OpenRouter API to determine the most appropriate next step.
+        Start k generations at once; the first that parses and validates wins and the rest are cancelled.
+
+        Returns:
+            Optional[Dict[str, Any]]: The winning quest, or None if every candidate was invalid
         """
+        usages: Dict[asyncio.Task, List[int]] = {}
+        for _ in range(k):
+            usage: List[int] = []
+            task = asyncio.create_task(self._complete(TASK_GENERATION, prompt, deadline, parse=self._parse_quest,
+                                                      usage=usage, schema=('quest', FULL_QUEST_SCHEMA), wire=wire,
+                                                      temperature=0.7, max_tokens=32768))
+            usages[task] = usage
+        pending = set(usages)
+        winner = None
+        invalid = False
+        last_error: Optional[Exception] = None
         try:
-            # First check for exact match with options before calling OpenAI
-            for option in current_step.get('options', []):
-                if user_choice.lower() == option['text'].lower():
-                    return option['nextStepId']
-            
-            # If no exact match, look for matching step ID in options using substring matching
-            for option in current_step.get('options', []):
-                if user_choice.lower() in option['text'].lower():
-                    return option['nextStepId']
-                    
-            # Prepare prompt for matching user choice with options (only called when no direct match)
-            options_text = "\n".join([f"{i+1}. {opt['text']}" for i, opt in enumerate(current_step.get('options', []))])
-            
-            # Generate the prompt
-            prompt = get_choice_matching_prompt(user_choice, options_text, user_language)
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for finished in done:
+                    if finished.exception() is not None:
+                        last_error = finished.exception()
+                    elif finished.result() is not None:
+                        self.race.record_outcome(True)
+                        if winner is None:
+                            winner = finished
+                    else:
+                        self.race.record_outcome(False)
+                        invalid = True
+        finally:
+            for leftover in pending:
+                leftover.cancel()
 
-            # Make the API call using OpenAI client
-            response = self.client.chat.completions.create(
-                model=self.model_name,
-                messages=[
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=100
-            )
+        winner_tokens = sum(usages[winner]) if winner is not None else 0
+        wasted_tokens = sum(sum(usage) for task, usage in usages.items() if task is not winner)
+        self.race.record_race(k, winner is not None, winner_tokens, wasted_tokens, len(pending))
+        logger.info(f"Generation race of {k}: {'won' if winner is not None else 'lost'}, "
+                    f"{len(pending)} cancelled, {winner_tokens} winner tokens, {wasted_tokens} extra tokens")
+        if winner is not None:
+            return winner.result()
+        if invalid:
+            return None
+        raise last_error or asyncio.TimeoutError("No backend answered the generation race")
 
-            # Extract the result from the response
-            content = response.choices[0].message.content
-            
-            # Get matched option text
-            matched_option_text = extract_choice_result(str(content))
-            
-            if not matched_option_text:
-                return None
+    def match_choice_locally(self, current_step: Dict[str, Any], user_choice: str) -> Optional[str]:
+        """
+        Match a choice with the step's options without a model call: exact text,
+        substring, then a confident match in the local similarity index.
+
+        Returns:
+            Optional[str]: The matched option's nextStepId, or None if the model is needed
+        """
+        # First check for exact match with options before calling OpenAI
+        for option in current_step.get('options', []):
+            if user_choice.lower() == option['text'].lower():
+                return option['nextStepId']
+        
+        # If no exact match, look for matching step ID in options using substring matching
+        for option in current_step.get('options', []):
+            if user_choice.lower() in option['text'].lower():
+                return option['nextStepId']
                 
-            # Find matching step ID in options
-            for option in current_step.get('options', []):
-                if matched_option_text == option['text'].lower() or matched_option_text in option['text'].lower():
-                    return option['nextStepId']
+        # Then try the local similarity index, accepting only confident matches
+        options = current_step.get('options', [])
+        if self.option_index is not None:
+            match = self.option_index.best_match(user_choice, options)
+            if match is not None:
+                index, score, margin = match
+                if score >= OPTION_INDEX_MIN_SCORE and margin >= OPTION_INDEX_MIN_MARGIN:
+                    return options[index]['nextStepId']
+        return None
+
+    async def process_choice(self, current_step: Dict[str, Any], user_choice: str, all_steps: List[Dict], user_language: str = 'ru', deadline: Optional[float] = None) -> Optional[str]:
+        """
+        Process user's choice and find the best matching option using LLM.
+        Uses OpenRouter API to determine the most appropriate next step.
+        Returns None if no option matches; raises ChoiceMatchError if the model call failed.
+        """
+        try:
+            next_step_id = self.match_choice_locally(current_step, user_choice)
+            if next_step_id is not None:
+                return next_step_id
+            options = current_step.get('options', [])
             
-            return None
+            # Only call the model when there is no confident local match; batch the call
+            # with other users' choices when batching is enabled
+            deadline = make_deadline(TASK_CHOICE, deadline)
+            if self.choice_batcher is not None:
+                return await self.choice_batcher.submit(user_choice, options, user_language, deadline)
+            return await self._match_choice_single(user_choice, options, user_language, deadline)
 
         except Exception as e:
             logger.error(f"Error processing choice: {str(e)}")
+            raise ChoiceMatchError(str(e)) from e
+    
+    async def _match_choice_single(self, user_choice: str, options: List[Dict[str, Any]], user_language: str, deadline: float) -> Optional[str]:
+        """Match one user choice with its options using a dedicated LLM request."""
+        # Prepare prompt for matching user choice with options
+        options_text = "\n".join([f"{i+1}. {opt['text']}" for i, opt in enumerate(options)])
+        
+        # Generate the prompt
+        prompt = get_choice_matching_prompt(user_choice, options_text, user_language)
+
+        # Make the API call on the fast choice-matching route
+        content = await self._complete(TASK_CHOICE, prompt, deadline, max_tokens=100)
+        
+        # Get matched option text
+        matched_option_text = extract_choice_result(str(content))
+        
+        if not matched_option_text:
             return None
+            
+        # Find matching step ID in options
+        for option in options:
+            if matched_option_text == option['text'].lower() or matched_option_text in option['text'].lower():
+                return option['nextStepId']
+        
+        return None
+
+    async def _match_choice_batch(self, user_language: str, jobs: List[ChoiceJob]) -> List[Optional[str]]:
+        """
+        Match a batch of users' choices with one structured LLM request.
+        Falls back to individual requests if the batched answer cannot be parsed.
+        """
+        deadline = min(job.deadline for job in jobs)
+        if len(jobs) == 1:
+            job = jobs[0]
+            return [await self._match_choice_single(job.user_choice, job.options, user_language, deadline)]
+        
+        requests_text = "\n\n".join(
+            f"{n}. \"{job.user_choice}\"\n" + "\n".join(f"   {i+1}. {opt['text']}" for i, opt in enumerate(job.options))
+            for n, job in enumerate(jobs, 1)
+        )
+        prompt = get_batch_choice_matching_prompt(requests_text, user_language)
+        content = await self._complete(TASK_CHOICE, prompt, deadline, max_tokens=20 + 10 * len(jobs))
+        answers = extract_json_from_response(str(content))
+        
+        if not isinstance(answers, dict):
+            logger.warning(f"Batched choice matching answer could not be parsed, matching {len(jobs)} choices individually")
+            return await asyncio.gather(*(
+                self._match_choice_single(job.user_choice, job.options, user_language, deadline) for job in jobs
+            ))
+        
+        results = []
+        for n, job in enumerate(jobs, 1):
+            try:
+                option_number = int(answers.get(str(n), 0))
+            except (TypeError, ValueError):
+                option_number = 0
+            if 1 <= option_number <= len(job.options):
+                results.append(job.options[option_number - 1]['nextStepId'])
+            else:
+                results.append(None)
+        return results
     
     def is_quest_finished(self, current_step: Dict[str, Any], all_steps: List[Dict]) -> bool:
         """
@@ -156,52 +696,143 @@ class QuestEngine:
                 
         return False
     
-    async def create_new_branch(self, current_step: Dict[str, Any], user_choice: str, all_steps: List[Dict], user_language: str = 'ru') -> Optional[Dict]:
+    async def create_new_branch(self, current_step: Dict[str, Any], user_choice: str, all_steps: List[Dict], user_language: str = 'ru',
+                                deadline: Optional[float] = None, quest_id: Optional[str] = None,
+                                story_so_far: str = '') -> Optional[Dict]:
         """
         Create a new branch in the quest when no suitable option is found.
         Uses OpenRouter API to generate appropriate content for the new step.
+        The step gets an engine-allocated id; with a quest_id the branch is
+        memoized and returned again for the same choice at the same step.
+        story_so_far (the session's capped story summary) gives the model context.
         """
-        max_retries = 3
-        retry_delay = 1  # seconds
+        memoized = self.find_branch(quest_id, current_step, user_choice)
+        if memoized is not None:
+            return memoized
+        deadline = make_deadline(TASK_BRANCH, deadline)
+        self.parse_stats.record_request('quest_step')
         
-        for attempt in range(max_retries):
+        for attempt in range(self.retry_policy.max_attempts):
+            error = None
             try:
                 # Prepare prompt for creating new branch
-                prompt = get_new_branch_prompt(user_choice, current_step.get('text', 'No text'), user_language)
-
-                # Make the API call using OpenAI client
-                response = self.client.chat.completions.create(
-                    model=self.model_name,
-                    messages=[
-                        {"role": "user", "content": prompt}
-                    ],
-                    temperature=0.7,
-                    max_tokens=16384
-                )
+                prompt = get_new_branch_prompt(user_choice, current_step.get('text', 'No text'), user_language, story_so_far)
+                wire = (get_new_branch_wire_prompt(user_choice, current_step.get('text', 'No text'), user_language,
+                                                   story_so_far),
+                        self._parse_new_step_wire)
 
-                # Extract the generated step from the response
-                content = response.choices[0].message.content
-                result = extract_json_from_response(str(content), NEW_STEP_SCHEMA)
+                # Make the API call on the branch creation route
+                result = await self._complete(TASK_BRANCH, prompt, deadline, parse=self._parse_new_step,
+                                              schema=('quest_step', NEW_STEP_SCHEMA), wire=wire,
+                                              temperature=0.7, max_tokens=16384)
                 
                 # If extraction was successful, return the result
                 if result is not None:
-                    return result
-                
-                # If we get here, JSON extraction failed - retry if not last attempt
-                if attempt < max_retries - 1:
-                    logger.warning(f"JSON extraction failed for new branch creation (attempt {attempt + 1}). Retrying in {retry_delay} seconds...")
-                    time.sleep(retry_delay)
-                    continue
-                else:
-                    logger.error("Failed to extract valid JSON after all retries for new branch creation")
-                    return None
-
+                    return self._finish_branch(quest_id, current_step, user_choice, result)
+                logger.warning(f"JSON extraction failed for new branch creation (attempt {attempt + 1})")
+            except CircuitOpenError:
+                # Every branch backend is down: fail fast instead of retrying
+                raise
             except Exception as e:
-                # If there's an exception during API call or processing, retry if not last attempt
-                if attempt < max_retries - 1:
-                    logger.warning(f"Error creating new branch (attempt {attempt + 1}): {str(e)}. Retrying in {retry_delay} seconds...")
-                    time.sleep(retry_delay)
+                error = e
+                logger.warning(f"Error creating new branch (attempt {attempt + 1}): {str(e)}")
+            
+            # Retry only if the policy considers the failure retryable within the deadline
+            delay = self.retry_policy.next_delay(attempt, error, deadline)
+            if delay is None:
+                logger.error(f"Failed to create a new branch after {attempt + 1} attempts")
+                return None
+            logger.info(f"Retrying new branch creation in {delay:.1f} seconds...")
+            self.parse_stats.record_retry('quest_step')
+            await asyncio.sleep(delay)
+        return None
+
+    async def create_new_branch_streaming(self, current_step: Dict[str, Any], user_choice: str, all_steps: List[Dict], user_language: str = 'ru',
+                                          deadline: Optional[float] = None,
+                                          on_text: Optional[Callable[[str], Awaitable[None]]] = None,
+                                          quest_id: Optional[str] = None, story_so_far: str = '') -> Optional[Dict]:
+        """
+        Create a new branch while streaming the step's text as it is generated.
+
+        on_text is awaited with the step text decoded so far each time it grows.
+        If streaming fails or yields an invalid step, falls back to create_new_branch
+        with the remaining deadline.
+        """
+        memoized = self.find_branch(quest_id, current_step, user_choice)
+        if memoized is not None:
+            return memoized
+        deadline = make_deadline(TASK_BRANCH, deadline)
+        backend = self.router.candidates(TASK_BRANCH)[0]
+        if not backend.breaker.allow():
+            return await self.create_new_branch(current_step, user_choice, all_steps, user_language, deadline=deadline,
+                                                quest_id=quest_id, story_so_far=story_so_far)
+        
+        params = {'temperature': 0.7, 'max_tokens': 16384}
+        if self._uses_wire_format(backend):
+            prompt = get_new_branch_wire_prompt(user_choice, current_step.get('text', 'No text'), user_language,
+                                                story_so_far)
+            streamer, parse, mode = WireParser(), self._parse_new_step_wire, 'wire'
+        else:
+            prompt = get_new_branch_prompt(user_choice, current_step.get('text', 'No text'), user_language, story_so_far)
+            params = self._structured_params(backend, params, ('quest_step', NEW_STEP_SCHEMA))
+            streamer, parse = JsonFieldStreamer('text'), self._parse_new_step
+            mode = 'constrained' if 'response_format' in params else 'free'
+        start = time.monotonic()
+        try:
+            content = await asyncio.wait_for(
+                self._stream_completion(backend, prompt, streamer, on_text, **params),
+                timeout=max(deadline - start, 0)
+            )
+            self.router.record_success(backend, time.monotonic() - start)
+            if mode == 'constrained':
+                backend.structured_output = True
+            result = parse(content)
+            self.parse_stats.record_answer('quest_step', mode, result is not None)
+            if result is not None:
+                return self._finish_branch(quest_id, current_step, user_choice, result)
+            logger.warning("Streamed branch failed JSON extraction, falling back to regular branch creation")
+        except asyncio.CancelledError:
+            # The call was abandoned, not judged: let the next call probe a half-open backend
+            backend.breaker.release_probe()
+            raise
+        except Exception as e:
+            if mode == 'constrained' and is_unsupported_error(e):
+                # The fallback below asks again without the schema constraint, claiming the probe anew
+                backend.structured_output = False
+                backend.breaker.release_probe()
+            else:
+                self.router.record_failure(backend, e, time.monotonic() - start)
+            logger.warning(f"Error streaming new branch: {str(e)}. Falling back to regular branch creation")
+        
+        return await self.create_new_branch(current_step, user_choice, all_steps, user_language, deadline=deadline,
+                                            quest_id=quest_id, story_so_far=story_so_far)
+
+    async def _stream_completion(self, backend, prompt: str, streamer: Union[JsonFieldStreamer, WireParser],
+                                 on_text: Optional[Callable[[str], Awaitable[None]]], **params) -> str:
+        """Stream a completion from a backend, reporting the extracted field as it grows."""
+        stream = await self._get_client(backend.base_url).chat.completions.create(
+            model=backend.model,
+            messages=[
+                {"role": "user", "content": prompt}
+            ],
+            stream=True,
+            **params
+        )
+        chunks = []
+        streamed_text = ''
+        try:
+            async for chunk in stream:
+                if not chunk.choices:
                     continue
-                else:
-                    logger.error(f"Error creating new branch after all retries: {str(e)}")
-                    return None
\ No newline at end of file
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                chunks.append(delta)
+                text = streamer.feed(delta)
+                if on_text is not None and text != streamed_text:
+                    streamed_text = text
+                    await on_text(text)
+        finally:
+            # Release the connection, also when the stream is cancelled midway
+            await stream.close()
+        return ''.join(chunks)
@@ -0,0 +1,191 @@
+"""
+Interned, read-only quests shared by sessions, with per-session branch overlays
+"""
+
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+from types import MappingProxyType
+from typing import Dict, Any, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def freeze(value: Any) -> Any:
+    """Recursively turn dicts into read-only mappings and lists into tuples."""
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def thaw(value: Any) -> Any:
+    """Return a plain, mutable (JSON-serializable) copy of a frozen value."""
+    if isinstance(value, MappingProxyType):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(item) for item in value]
+    return value
+
+
+def quest_id_for(quest_data: Dict[str, Any]) -> str:
+    """Content hash identifying a quest, so identical quests are stored once."""
+    payload = json.dumps(quest_data, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:20]
+
+
+class InternedQuest:
+    """A frozen quest with its steps indexed by id."""
+
+    __slots__ = ('quest_id', 'quest', 'steps', 'steps_by_id', 'start_step_id')
+
+    def __init__(self, quest_id: str, quest_data: Dict[str, Any]):
+        self.quest_id = quest_id
+        self.quest = freeze(quest_data)
+        self.steps = self.quest['quest']['steps']
+        self.start_step_id = self.quest['quest']['startStepId']
+        self.steps_by_id = {}
+        for step in self.steps:
+            # Keep the first step for duplicate ids, as lookups by scan would
+            self.steps_by_id.setdefault(step['id'], step)
+
+
+class SessionQuest:
+    """
+    One session's view of a quest: the shared, read-only base quest plus the
+    steps this session branched off into. Base steps come first, so step
+    indexes stay stable as branches are appended.
+    """
+
+    __slots__ = ('base', 'branches')
+
+    def __init__(self, base: InternedQuest, branches: List[Dict[str, Any]]):
+        self.base = base
+        self.branches = branches
+
+    @property
+    def steps(self) -> List[Dict[str, Any]]:
+        return list(self.base.steps) + self.branches
+
+    @property
+    def start_step_id(self) -> str:
+        return self.base.start_step_id
+
+    def get_step(self, step_id: str) -> Optional[Dict[str, Any]]:
+        """Find a step by id in the base quest or the session's branches."""
+        step = self.base.steps_by_id.get(step_id)
+        if step is not None:
+            return step
+        for branch in self.branches:
+            if branch['id'] == step_id:
+                return branch
+        return None
+
+    def step_index(self, step_id: str) -> Optional[int]:
+        """Return the position of a step in steps, or None."""
+        for index, step in enumerate(self.base.steps):
+            if step['id'] == step_id:
+                return index
+        for index, step in enumerate(self.branches):
+            if step['id'] == step_id:
+                return len(self.base.steps) + index
+        return None
+
+    def step_at(self, index: int) -> Optional[Dict[str, Any]]:
+        """Return the step at a position in steps, or None."""
+        if 0 <= index < len(self.base.steps):
+            return self.base.steps[index]
+        index -= len(self.base.steps)
+        if 0 <= index < len(self.branches):
+            return self.branches[index]
+        return None
+
+
+class QuestLibrary:
+    """
+    Intern quests by content so that sessions playing the same quest share one
+    frozen copy. Sessions store only the quest id and their own branch steps;
+    base quests are persisted once through save_quest and reloaded through
+    load_quest after they fall out of the in-memory LRU.
+    """
+
+    def __init__(self, load_quest: Callable[[str], Optional[Dict[str, Any]]],
+                 save_quest: Callable[[str, Dict[str, Any]], None], max_entries: int = 1000):
+        self.load_quest = load_quest
+        self.save_quest = save_quest
+        self.max_entries = max_entries
+        self._quests: "OrderedDict[str, InternedQuest]" = OrderedDict()
+
+        # Statistics
+        self.interned = 0
+        self.shared = 0
+        self.loads = 0
+
+    def _cache(self, interned: InternedQuest):
+        self._quests[interned.quest_id] = interned
+        if len(self._quests) > self.max_entries:
+            self._quests.popitem(last=False)
+
+    def intern(self, quest_data: Dict[str, Any]) -> InternedQuest:
+        """
+        Return the shared copy of a quest, storing it first if it is new.
+
+        Args:
+            quest_data (Dict[str, Any]): Quest in the FULL_QUEST_SCHEMA format
+
+        Returns:
+            InternedQuest: The frozen quest shared by every session playing it
+        """
+        quest_id = quest_id_for(quest_data)
+        interned = self.get(quest_id)
+        if interned is not None:
+            self.shared += 1
+            return interned
+        self.save_quest(quest_id, quest_data)
+        interned = InternedQuest(quest_id, quest_data)
+        self._cache(interned)
+        self.interned += 1
+        return interned
+
+    def get(self, quest_id: str) -> Optional[InternedQuest]:
+        """Return an interned quest by id, loading it from storage if needed."""
+        interned = self._quests.get(quest_id)
+        if interned is not None:
+            self._quests.move_to_end(quest_id)
+            return interned
+        quest_data = self.load_quest(quest_id)
+        if not quest_data:
+            return None
+        self.loads += 1
+        interned = InternedQuest(quest_id, quest_data)
+        self._cache(interned)
+        return interned
+
+    def session_quest(self, state: Dict[str, Any]) -> Optional[SessionQuest]:
+        """Return the quest view of a session state, or None if it has no quest."""
+        quest_id = state.get('quest_id')
+        if not quest_id:
+            return None
+        base = self.get(quest_id)
+        if base is None:
+            logger.error(f"Quest {quest_id} is missing from the quest library")
+            return None
+        return SessionQuest(base, state.get('quest_branches') or [])
+
+    def migrate_state(self, state: Dict[str, Any]) -> Dict[str, Any]:
+        """Move a legacy embedded current_quest into the library (in place)."""
+        if 'current_quest' in state:
+            quest_data = state.pop('current_quest')
+            state['quest_id'] = self.intern(quest_data).quest_id if quest_data else None
+            state['quest_branches'] = []
+        return state
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'cached': len(self._quests),
+            'interned': self.interned,
+            'shared': self.shared,
+            'loads': self.loads,
+        }
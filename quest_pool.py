@@ -0,0 +1,294 @@
+"""
+Warm pool of pre-generated quests for popular themes
+"""
+
+import asyncio
+import logging
+import re
+import time
+from collections import deque
+from typing import Dict, Any, Callable, Deque, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Popular themes kept warm in the pool. Keywords are lowercase words matched
+# against whole words of the user's requirements; a trailing '*' marks a stem
+# that also matches its inflected forms. Requirements are the texts sent to
+# the quest generator when refilling.
+POOL_THEMES: Dict[str, Dict[str, Dict[str, Any]]] = {
+    'forest': {
+        'keywords': {
+            'ru': ['лес*', 'белк*', 'белочк*', 'ёжик*', 'ежик*'],
+            'en': ['forest', 'forests', 'squirrel', 'squirrels', 'hedgehog', 'hedgehogs', 'woods'],
+        },
+        'requirements': {
+            'ru': "Тема: приключения в лесу. Главный герой: любопытная белка. Образовательный элемент: изучение лесных животных и растений.",
+            'en': "Theme: adventures in the forest. Main character: a curious squirrel. Educational element: learning about forest animals and plants.",
+        },
+    },
+    'space': {
+        'keywords': {
+            'ru': ['космо*', 'космич*', 'ракет*', 'планет*', 'звёзд*', 'звезд*'],
+            'en': ['space', 'rocket', 'rockets', 'planet', 'planets', 'star', 'stars'],
+        },
+        'requirements': {
+            'ru': "Тема: космическое путешествие. Главный герой: робот-исследователь. Образовательный элемент: планеты Солнечной системы.",
+            'en': "Theme: space travel. Main character: a robot explorer. Educational element: the planets of the Solar System.",
+        },
+    },
+    'sea': {
+        'keywords': {
+            'ru': ['море', 'моря', 'морю', 'морем', 'морях', 'морск*', 'подводн*', 'океан*', 'рыб*'],
+            'en': ['sea', 'seas', 'underwater', 'ocean', 'oceans', 'fish', 'fishes'],
+        },
+        'requirements': {
+            'ru': "Тема: подводная жизнь. Главный герой: маленькая рыбка. Образовательный элемент: обитатели моря.",
+            'en': "Theme: underwater life. Main character: a little fish. Educational element: sea creatures.",
+        },
+    },
+    'dragon': {
+        'keywords': {
+            'ru': ['дракон*', 'волшеб*', 'магия', 'магии'],
+            'en': ['dragon', 'dragons', 'magic', 'magical', 'fairy', 'fairies'],
+        },
+        'requirements': {
+            'ru': "Тема: волшебная страна. Главный герой: маленький дракон. Образовательный элемент: цвета и формы.",
+            'en': "Theme: a magic land. Main character: a little dragon. Educational element: colours and shapes.",
+        },
+    },
+}
+
+# Words that carry no content of their own: requirements made only of these
+# (and at most one theme's keywords) may be answered with a pooled quest.
+# Matched like theme keywords.
+FILLER_WORDS: Dict[str, list] = {
+    'ru': ['а', 'и', 'в', 'во', 'на', 'о', 'об', 'про', 'с', 'со', 'для', 'по', 'к', 'у', 'мне', 'нам', 'я', 'мы',
+           'хочу', 'хотим', 'давай', 'сделай', 'придумай', 'создай', 'напиши', 'расскажи', 'квест*', 'истори*',
+           'сказк*', 'приключени*', 'игр*', 'какой', 'какую', 'какое', 'что', 'нибудь', 'любой', 'любую', 'любое',
+           'все', 'всё', 'равно', 'не', 'знаю', 'сам', 'сама', 'выбери', 'тем*', 'дет*', 'ребён*', 'ребен*',
+           'маленьк*', 'интересн*', 'весёл*', 'весел*', 'нов*', 'привет', 'пожалуйста'],
+    'en': ['a', 'an', 'the', 'about', 'with', 'and', 'of', 'in', 'on', 'at', 'to', 'for', 'me', 'my', 'us', 'i',
+           'we', 'want', 'let', 'lets', 's', 'make', 'create', 'write', 'tell', 'quest', 'quests', 'story',
+           'stories', 'tale', 'tales', 'adventure', 'adventures', 'game', 'some', 'something', 'any', 'anything',
+           'whatever', 'don', 't', 'know', 'you', 'choose', 'theme', 'kid', 'kids', 'child', 'children',
+           'little', 'fun', 'funny', 'new', 'random', 'hi', 'hello', 'please'],
+}
+
+POOL_LANGUAGES = ('ru', 'en')
+
+# Stems match words at most this many characters longer than the stem
+MAX_STEM_ENDING = 4
+
+
+def keyword_matches(word: str, keyword: str) -> bool:
+    """Match a word against a keyword: a whole word, or a stem ending in '*' and its inflections."""
+    if keyword.endswith('*'):
+        stem = keyword[:-1]
+        return word.startswith(stem) and len(word) - len(stem) <= MAX_STEM_ENDING
+    return word == keyword
+
+
+class QuestPool:
+    """
+    Pool of validated quests per (language, theme), refilled in the background
+    while the bot is idle and within an hourly LLM generation budget.
+    """
+
+    def __init__(self, target_size: int = 2, hourly_budget: int = 10,
+                 idle_seconds: float = 30.0, max_words: int = 12,
+                 check_interval: float = 5.0):
+        self.target_size = target_size
+        self.hourly_budget = hourly_budget
+        self.idle_seconds = idle_seconds
+        self.max_words = max_words
+        self.check_interval = check_interval
+
+        self.pools: Dict[Tuple[str, str], Deque[Dict[str, Any]]] = {
+            (language, theme): deque()
+            for language in POOL_LANGUAGES
+            for theme in POOL_THEMES
+        }
+        self.last_activity = time.monotonic()
+        self._generations: Deque[float] = deque()
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.fallbacks = 0
+        self.refill_failures = 0
+        self.refill_latencies: Deque[float] = deque(maxlen=500)
+
+    def add(self, language: str, theme: str, quest_data: Dict[str, Any]) -> bool:
+        """
+        Add a ready quest to a pool, e.g. one pre-built offline by bulk_generate.py.
+
+        Returns:
+            bool: False if the language and theme are not pooled
+        """
+        pool = self.pools.get((language, theme))
+        if pool is None:
+            return False
+        pool.append(quest_data)
+        return True
+
+    def note_activity(self):
+        """Record user activity; refills only run after an idle period."""
+        self.last_activity = time.monotonic()
+
+    def match_theme(self, requirements: str, language: str) -> Optional[str]:
+        """
+        Decide which pooled theme, if any, can answer the given requirements.
+
+        Args:
+            requirements (str): User's free-text requirements
+            language (str): User language code
+
+        Returns:
+            Optional[str]: Theme key, '*' for vague requirements that accept any theme,
+            or None if the requirements ask for more than a pooled quest offers
+        """
+        words = re.findall(r'\w+', (requirements or '').lower())
+        if len(words) > self.max_words:
+            return None
+
+        filler = FILLER_WORDS.get(language, [])
+        themes = set()
+        for word in words:
+            if any(keyword_matches(word, keyword) for keyword in filler):
+                continue
+            theme = next((theme for theme, theme_data in POOL_THEMES.items()
+                          if any(keyword_matches(word, keyword) for keyword in theme_data['keywords'].get(language, []))),
+                         None)
+            if theme is None:
+                # Anything beyond a theme (a name, a subject, a second character) needs a generated quest
+                return None
+            themes.add(theme)
+
+        if not themes:
+            return '*'
+        return themes.pop() if len(themes) == 1 else None
+
+    def take(self, requirements: str, language: str) -> Optional[Dict[str, Any]]:
+        """
+        Take a pooled quest matching the requirements, if one is available.
+
+        Args:
+            requirements (str): User's free-text requirements
+            language (str): User language code
+
+        Returns:
+            Optional[Dict[str, Any]]: A validated quest, or None on a pool miss
+        """
+        theme = self.match_theme(requirements, language)
+        if theme is None:
+            self.bypassed += 1
+            return None
+
+        if theme == '*':
+            candidates = sorted(
+                (key for key in self.pools if key[0] == language and self.pools[key]),
+                key=lambda key: len(self.pools[key]),
+                reverse=True
+            )
+        else:
+            candidates = [(language, theme)] if self.pools.get((language, theme)) else []
+
+        if not candidates:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return self.pools[candidates[0]].popleft()
+
+    def take_any(self, language: str) -> Optional[Dict[str, Any]]:
+        """
+        Take any pooled quest in the given language, regardless of requirements.
+        Used as a fallback when quest generation is unavailable.
+        """
+        candidates = [key for key in self.pools if key[0] == language and self.pools[key]]
+        if not candidates:
+            return None
+        self.fallbacks += 1
+        return self.pools[max(candidates, key=lambda key: len(self.pools[key]))].popleft()
+
+    def _budget_available(self) -> bool:
+        """Check the sliding one-hour generation budget."""
+        now = time.monotonic()
+        while self._generations and now - self._generations[0] > 3600:
+            self._generations.popleft()
+        return len(self._generations) < self.hourly_budget
+
+    def _next_key_to_refill(self) -> Optional[Tuple[str, str]]:
+        """Pick the emptiest pool that is below its target size."""
+        below_target = [key for key, pool in self.pools.items() if len(pool) < self.target_size]
+        if not below_target:
+            return None
+        return min(below_target, key=lambda key: len(self.pools[key]))
+
+    async def refill_once(self, quest_engine) -> bool:
+        """
+        Generate one quest for the emptiest pool if the budget allows.
+
+        Returns:
+            bool: True if a generation was attempted
+        """
+        key = self._next_key_to_refill()
+        if key is None or not self._budget_available():
+            return False
+
+        language, theme = key
+        requirements = POOL_THEMES[theme]['requirements'][language]
+        self._generations.append(time.monotonic())
+
+        start = time.perf_counter()
+        quest_data = await quest_engine.generate_quest(requirements, language)
+        latency = time.perf_counter() - start
+
+        if quest_data is None:
+            self.refill_failures += 1
+            logger.warning(f"Quest pool refill failed for {key} after {latency:.1f}s")
+            return True
+
+        self.refill_latencies.append(latency)
+        self.pools[key].append(quest_data)
+        logger.info(f"Quest pool refilled {key} in {latency:.1f}s ({len(self.pools[key])}/{self.target_size})")
+        return True
+
+    async def run(self, get_quest_engine: Callable[[], Any]):
+        """
+        Background worker: refill pools during idle periods until cancelled.
+        The engine is obtained from get_quest_engine only when a refill is due,
+        so starting the worker does not load the LLM client.
+        """
+        logger.info("Quest pool worker started")
+        while True:
+            try:
+                idle_for = time.monotonic() - self.last_activity
+                if idle_for >= self.idle_seconds:
+                    if await self.refill_once(get_quest_engine()):
+                        continue
+                await asyncio.sleep(self.check_interval)
+            except asyncio.CancelledError:
+                logger.info("Quest pool worker stopped")
+                raise
+            except Exception as e:
+                logger.error(f"Error in quest pool worker: {e}")
+                await asyncio.sleep(self.check_interval)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return pool hit rate, sizes and refill latency statistics."""
+        lookups = self.hits + self.misses
+        latencies = sorted(self.refill_latencies)
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'bypassed': self.bypassed,
+            'fallbacks': self.fallbacks,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'pooled': {f"{language}/{theme}": len(pool) for (language, theme), pool in self.pools.items()},
+            'refills': len(latencies),
+            'refill_failures': self.refill_failures,
+            'refill_latency_mean': sum(latencies) / len(latencies) if latencies else 0.0,
+            'refill_latency_p95': latencies[int(0.95 * (len(latencies) - 1))] if latencies else 0.0,
+        }
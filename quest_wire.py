@@ -0,0 +1,176 @@
+"""
+Compact line-oriented wire format for generated quests and branch steps
+
+A quest in the wire format:
+
+    T Drako and the magic acorn
+    # step_1
+    ~ A little dragon at the edge of a glowing forest
+    Drako walks down the path and sees a big hollow tree.
+    > step_2a 🐿️ Ask the squirrel
+    > step_2b 🌳 Look into the hollow
+    # step_2a
+    ...
+
+"T" gives the title, "#" starts a step (the first step is the start step),
+"~" is the step's image description and ">" an option: the next step id, an
+optional emoji and the option text. Any other line is part of the step's
+text. A branch step is a single step block without a title. The format
+spends far fewer output tokens than the equivalent JSON, which repeats
+quoted keys, braces and escapes for every step and option.
+"""
+
+from typing import Dict, Any, List, Optional
+
+MARK_TITLE = 'T '
+MARK_STEP = '# '
+MARK_IMAGE = '~ '
+MARK_OPTION = '> '
+MARKERS = (MARK_STEP, MARK_IMAGE, MARK_OPTION)
+
+
+def is_complete_step(step: Dict[str, Any]) -> bool:
+    """Whether a parsed step has text and every one of its options has a label."""
+    return bool(step['text'].strip()) and all(option['text'] for option in step['options'])
+
+
+def _is_emoji(token: str) -> bool:
+    return not any(char.isalnum() for char in token)
+
+
+def parse_option(line: str) -> Optional[Dict[str, str]]:
+    """Parse the body of an option line: "<next step id> [emoji] <text>"."""
+    parts = line.split(None, 1)
+    if not parts:
+        return None
+    option = {'text': '', 'nextStepId': parts[0], 'emoji': ''}
+    rest = parts[1] if len(parts) > 1 else ''
+    head = rest.split(None, 1)
+    if head and _is_emoji(head[0]):
+        option['emoji'] = head[0]
+        rest = head[1] if len(head) > 1 else ''
+    option['text'] = rest.strip()
+    return option
+
+
+class WireParser:
+    """
+    Incremental parser of the wire format, fed with chunks of streamed model output.
+
+    feed() returns the text of the step being written so far, like
+    json_utils.JsonFieldStreamer, so it can drive progressive message edits.
+    """
+
+    def __init__(self):
+        self.title: Optional[str] = None
+        self.steps: List[Dict[str, Any]] = []
+        self._text_lines: List[List[str]] = []
+        self._buffer = ''
+
+    def feed(self, chunk: str) -> str:
+        """
+        Consume the next chunk of streamed output.
+
+        Args:
+            chunk (str): Next piece of the streamed response
+
+        Returns:
+            str: Text of the current step decoded so far
+        """
+        self._buffer += chunk
+        if '\n' in self._buffer:
+            *lines, self._buffer = self._buffer.split('\n')
+            for line in lines:
+                self._consume_line(line)
+        return self.current_text()
+
+    def close(self) -> 'WireParser':
+        """Consume the last, unterminated line."""
+        if self._buffer:
+            self._consume_line(self._buffer)
+            self._buffer = ''
+        return self
+
+    def current_text(self) -> str:
+        """Text of the step being written, including a partial text line."""
+        if not self.steps:
+            return ''
+        lines = self._text_lines[-1]
+        partial = self._buffer.strip()
+        if len(partial) >= 2 and not partial.startswith(MARKERS) and not partial.startswith('```'):
+            lines = lines + [partial]
+        return '\n'.join(lines)
+
+    def _consume_line(self, line: str):
+        line = line.strip()
+        if not line or line.startswith('```'):
+            return
+        if line.startswith(MARK_STEP):
+            step_id = line[len(MARK_STEP):].strip()
+            if step_id:
+                self.steps.append({'id': step_id, 'image': '', 'text': '', 'options': []})
+                self._text_lines.append([])
+        elif not self.steps:
+            # Only the title may come before the first step
+            if line.startswith(MARK_TITLE) and self.title is None:
+                self.title = line[len(MARK_TITLE):].strip()
+        elif line.startswith(MARK_IMAGE):
+            self.steps[-1]['image'] = line[len(MARK_IMAGE):].strip()
+        elif line.startswith(MARK_OPTION):
+            option = parse_option(line[len(MARK_OPTION):])
+            if option is not None:
+                self.steps[-1]['options'].append(option)
+        else:
+            self._text_lines[-1].append(line)
+            self.steps[-1]['text'] = '\n'.join(self._text_lines[-1])
+
+    def quest(self) -> Optional[Dict[str, Any]]:
+        """Return the parsed quest in the engine's quest structure, or None if it is incomplete."""
+        if not self.title or not self.steps or not all(is_complete_step(step) for step in self.steps):
+            return None
+        return {'quest': {'title': self.title, 'startStepId': self.steps[0]['id'], 'steps': self.steps}}
+
+    def step(self) -> Optional[Dict[str, Any]]:
+        """
+        Return the first parsed step (a branch answer), or None if there is none
+        or it is incomplete: a branch must continue the quest, so it needs options.
+        """
+        if not self.steps:
+            return None
+        step = self.steps[0]
+        if not step['options'] or not is_complete_step(step):
+            return None
+        return step
+
+
+def _parse(content: str) -> WireParser:
+    parser = WireParser()
+    parser.feed(content or '')
+    return parser.close()
+
+
+def parse_quest(content: str) -> Optional[Dict[str, Any]]:
+    """Parse a complete quest in the wire format."""
+    return _parse(content).quest()
+
+
+def parse_step(content: str) -> Optional[Dict[str, Any]]:
+    """Parse a complete branch step in the wire format."""
+    return _parse(content).step()
+
+
+def format_quest(quest_data: Dict[str, Any]) -> str:
+    """Render a quest in the wire format, e.g. to compare its size with JSON."""
+    quest = quest_data['quest']
+    lines = [f"{MARK_TITLE}{quest['title']}"]
+    # The start step goes first
+    steps = sorted(quest['steps'], key=lambda step: step['id'] != quest['startStepId'])
+    for step in steps:
+        lines.append(f"{MARK_STEP}{step['id']}")
+        if step.get('image'):
+            lines.append(f"{MARK_IMAGE}{step['image']}")
+        lines.extend(line for line in step.get('text', '').split('\n') if line.strip())
+        for option in step.get('options', []):
+            emoji = f" {option['emoji']}" if option.get('emoji') else ''
+            lines.append(f"{MARK_OPTION}{option['nextStepId']}{emoji} {option['text']}")
+    return '\n'.join(lines) + '\n'
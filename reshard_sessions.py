@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Reshard the SQLite session store to a different number of shards.
+
+Run it with the bot stopped, then start the bot with STATE_SHARDS set to the
+new count. Unflushed sessions in the journal are recovered into the old
+layout first; stored rows are copied as they are, without re-encoding. The old
+files are kept under a .pre-reshard suffix until every new shard is in place.
+
+Usage: python reshard_sessions.py --from 1 --to 4 [--db kidquest_bot.db]
+"""
+
+import argparse
+import logging
+import os
+import sys
+
+from config import STATE_CODEC, STATE_JOURNAL_PATH
+from session_store import SessionStore, shard_paths
+from state_codec import get_codec
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Suffix of shard files while they are being built
+BUILD_SUFFIX = '.resharding'
+# Suffix of the old shard files until the new ones are in place
+BACKUP_SUFFIX = '.pre-reshard'
+# Rows copied per transaction
+COPY_BATCH_SIZE = 1000
+
+
+def reshard(db_path: str, old_shards: int, new_shards: int, journal_path: str) -> int:
+    """
+    Copy every session and shared quest into a new shard layout, then swap the files in.
+
+    Returns:
+        int: Number of sessions copied
+    """
+    old_paths = shard_paths(db_path, old_shards)
+    missing = [path for path in old_paths if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError(f"Shard files not found: {', '.join(missing)}")
+
+    codec = get_codec(STATE_CODEC)
+    source = SessionStore(db_path, codec, flush_interval=0, journal_path=journal_path, shards=old_shards)
+
+    # Build the new layout under temporary names, so old and new file names may overlap
+    new_paths = shard_paths(db_path, new_shards)
+    build_db_path = db_path + BUILD_SUFFIX
+    for path in shard_paths(build_db_path, new_shards):
+        for leftover in (path, f"{path}-wal", f"{path}-shm"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    target = SessionStore(build_db_path, codec, flush_interval=0, journal_path=build_db_path + '.journal',
+                          shards=new_shards)
+
+    copied = 0
+    batch = {}
+    for user_id, blob in source.iter_rows():
+        batch[user_id] = blob
+        if len(batch) >= COPY_BATCH_SIZE:
+            target.import_rows(batch)
+            copied += len(batch)
+            batch = {}
+    if batch:
+        target.import_rows(batch)
+        copied += len(batch)
+    target.write_quest_rows(list(source.iter_quest_rows()))
+    target.write_pooled_quest_rows(list(source.iter_pooled_quest_rows()))
+
+    source.close()
+    target.close()
+
+    # Swap: move the old files aside, move the new shards into place, and only then
+    # delete the old files, so that a failure midway always leaves a usable store
+    backups = []
+    for path in old_paths:
+        for old_file in (path, f"{path}-wal", f"{path}-shm"):
+            if os.path.exists(old_file):
+                os.replace(old_file, old_file + BACKUP_SUFFIX)
+                backups.append(old_file)
+    try:
+        for build_path, new_path in zip(shard_paths(build_db_path, new_shards), new_paths):
+            os.replace(build_path, new_path)
+            for extra in ('-wal', '-shm'):
+                if os.path.exists(build_path + extra):
+                    os.remove(build_path + extra)
+    except Exception:
+        # Put the old files back; their layout marker keeps the store on the old shard count
+        for old_file in backups:
+            os.replace(old_file + BACKUP_SUFFIX, old_file)
+        raise
+    for old_file in backups:
+        os.remove(old_file + BACKUP_SUFFIX)
+    return copied
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reshard the KidQuestBot session store")
+    parser.add_argument('--db', default='kidquest_bot.db', help="Database path (default: kidquest_bot.db)")
+    parser.add_argument('--from', dest='old_shards', type=int, required=True, help="Current shard count")
+    parser.add_argument('--to', dest='new_shards', type=int, required=True, help="New shard count")
+    parser.add_argument('--journal', default=STATE_JOURNAL_PATH, help="Session journal path")
+    args = parser.parse_args()
+
+    if args.old_shards < 1 or args.new_shards < 1:
+        parser.error("shard counts must be at least 1")
+    if args.old_shards == args.new_shards:
+        logger.info("Shard count unchanged, nothing to do")
+        return
+
+    try:
+        copied = reshard(args.db, args.old_shards, args.new_shards, args.journal)
+    except Exception as e:
+        logger.error(f"Resharding failed: {e}")
+        sys.exit(1)
+    logger.info(f"Resharded {copied} sessions from {args.old_shards} to {args.new_shards} shards; "
+                f"set STATE_SHARDS={args.new_shards}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+"""
+Shared retry policy and per-backend circuit breakers for LLM calls
+"""
+
+import asyncio
+import logging
+import random
+import time
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+# Error classes
+ERROR_RATE_LIMIT = 'rate_limit'
+ERROR_SERVER = 'server'
+ERROR_TIMEOUT = 'timeout'
+ERROR_CLIENT = 'client'
+ERROR_CIRCUIT_OPEN = 'circuit_open'
+ERROR_PARSE = 'parse'
+
+# Error classes worth retrying, possibly on another backend
+RETRYABLE_ERRORS = {ERROR_RATE_LIMIT, ERROR_SERVER, ERROR_TIMEOUT, ERROR_PARSE}
+
+
+class CircuitOpenError(Exception):
+    """Raised when every backend for a task has an open circuit breaker."""
+
+    def __init__(self, task: str, retry_in: float):
+        super().__init__(f"All backends for {task} are unavailable, retry in {retry_in:.0f}s")
+        self.task = task
+        self.retry_in = retry_in
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """Read the Retry-After header (in seconds) from an API error, if present."""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    value = headers.get('retry-after')
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_error(error: Optional[Exception]) -> str:
+    """
+    Classify an LLM call failure.
+
+    Args:
+        error (Optional[Exception]): The raised error, or None for an answer
+            that could not be parsed or validated
+
+    Returns:
+        str: One of the ERROR_* classes
+    """
+    if error is None:
+        return ERROR_PARSE
+    if isinstance(error, CircuitOpenError):
+        return ERROR_CIRCUIT_OPEN
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError)) or type(error).__name__ == 'APITimeoutError':
+        return ERROR_TIMEOUT
+
+    status_code = getattr(error, 'status_code', None)
+    if status_code == 429:
+        return ERROR_RATE_LIMIT
+    if status_code is not None and status_code >= 500:
+        return ERROR_SERVER
+    if status_code is not None:
+        return ERROR_CLIENT
+    # Connection errors and anything unexpected from the transport
+    return ERROR_SERVER
+
+
+class RetryPolicy:
+    """
+    Decide whether and when to retry a failed LLM call.
+
+    Parse failures are retried at once (a new sample is likely to succeed),
+    rate limits honour Retry-After, and server errors and timeouts back off
+    exponentially with full jitter. Client errors and open circuits are not retried.
+    """
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.5, max_delay: float = 10.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def next_delay(self, attempt: int, error: Optional[Exception], deadline: float) -> Optional[float]:
+        """
+        Return the delay before the next attempt, or None to give up.
+
+        Args:
+            attempt (int): Zero-based index of the attempt that just failed
+            error (Optional[Exception]): The error, or None for an invalid answer
+            deadline (float): time.monotonic() deadline for the whole call
+
+        Returns:
+            Optional[float]: Seconds to wait before retrying, or None
+        """
+        if attempt + 1 >= self.max_attempts:
+            return None
+
+        kind = classify_error(error)
+        if kind not in RETRYABLE_ERRORS:
+            return None
+
+        if kind == ERROR_PARSE:
+            delay = 0.0
+        else:
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+            if kind == ERROR_RATE_LIMIT:
+                retry_after = get_retry_after(error)
+                if retry_after is not None:
+                    delay = max(delay, retry_after)
+
+        if time.monotonic() + delay >= deadline:
+            return None
+        return delay
+
+
+class CircuitBreaker:
+    """
+    Per-backend circuit breaker.
+
+    Opens after consecutive failures (or immediately on a rate limit, for the
+    Retry-After period), rejects calls while open, then lets a single probe
+    call through (half-open) and closes again on its success.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.trips = 0
+        self._probe_in_flight = False
+
+    def is_available(self) -> bool:
+        """Check, without claiming anything, whether a call could be made now."""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return time.monotonic() >= self.open_until
+        return not self._probe_in_flight
+
+    def allow(self) -> bool:
+        """Check whether a call may be made now (claims the probe when half-open)."""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() >= self.open_until:
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+        if self.state == self.HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def retry_in(self) -> float:
+        """Seconds until the breaker lets a probe call through."""
+        if self.state == self.CLOSED:
+            return 0.0
+        return max(self.open_until - time.monotonic(), 0.0)
+
+    def release_probe(self):
+        """Give back a half-open probe whose call ended without a verdict (e.g. it was cancelled)."""
+        self._probe_in_flight = False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self, error: Exception):
+        kind = classify_error(error)
+        if kind == ERROR_CLIENT:
+            # Bad requests say nothing about the backend's health
+            self._probe_in_flight = False
+            return
+
+        self.consecutive_failures += 1
+        if kind == ERROR_RATE_LIMIT:
+            self._open(get_retry_after(error) or self.reset_timeout)
+        elif self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self._open(self.reset_timeout)
+
+    def _open(self, duration: float):
+        if self.state != self.OPEN:
+            self.trips += 1
+        self.state = self.OPEN
+        self.open_until = time.monotonic() + duration
+        self._probe_in_flight = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'state': self.state,
+            'consecutive_failures': self.consecutive_failures,
+            'trips': self.trips,
+            'retry_in': self.retry_in(),
+        }
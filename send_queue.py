@@ -0,0 +1,260 @@
+"""
+Outbound Telegram message dispatcher with global and per-chat flood control
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Dict, Any, Deque, List
+
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Telegram's maximum message length
+MAX_MESSAGE_LENGTH = 4096
+# Separator used when coalescing back-to-back messages to the same chat
+COALESCE_SEPARATOR = "\n\n"
+
+
+def split_text(text: str, limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """
+    Split text into chunks of at most limit characters, preferring line breaks.
+
+    Args:
+        text (str): Message text
+        limit (int): Maximum chunk length
+
+    Returns:
+        List[str]: Non-empty chunks in order
+    """
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit)
+        if cut <= 0:
+            cut = text.rfind(' ', 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip('\n')
+    if text or not chunks:
+        chunks.append(text)
+    return chunks
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """Return a flood-wait duration in seconds (int or timedelta depending on the library version)."""
+    retry_after = error.retry_after
+    if hasattr(retry_after, 'total_seconds'):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class TokenBucket:
+    """Async token bucket limiting the global send rate."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class OutboundMessage:
+    """A queued send or edit, with the futures of every caller it answers."""
+
+    __slots__ = ('text', 'kwargs', 'message', 'coalesce', 'futures', 'enqueued_at')
+
+    def __init__(self, text: str, kwargs: Dict[str, Any], message=None, coalesce: bool = True):
+        self.text = text
+        self.kwargs = kwargs
+        # Message to edit; None for a new message
+        self.message = message
+        # False for a message that will be edited later, so no other text may be merged with it
+        self.coalesce = coalesce
+        self.futures = [asyncio.get_running_loop().create_future()]
+        self.enqueued_at = time.monotonic()
+
+
+class ChatQueue:
+    """Pending messages of one chat."""
+
+    __slots__ = ('items',)
+
+    def __init__(self):
+        self.items: Deque[OutboundMessage] = deque()
+
+
+class OutboundDispatcher:
+    """
+    Send messages through one queue per chat, paced per chat and limited by a
+    global token bucket. Flood-wait responses are retried after the requested
+    delay, long texts are split, and back-to-back plain messages to the same
+    chat are coalesced into one.
+    """
+
+    def __init__(self, global_rate: float = 30.0, chat_interval: float = 1.0, max_flood_retries: int = 3):
+        self.bucket = TokenBucket(global_rate, global_rate)
+        self.chat_interval = chat_interval
+        self.max_flood_retries = max_flood_retries
+        self.chats: Dict[int, ChatQueue] = {}
+        self._workers = set()
+
+        # Statistics
+        self.sent = 0
+        self.coalesced = 0
+        self.flood_waits = 0
+        self.max_queue_depth = 0
+        self.send_latencies: Deque[float] = deque(maxlen=1000)
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(queue.items) for queue in self.chats.values())
+
+    async def send(self, bot, chat_id: int, text: str, coalesce: bool = True, **kwargs):
+        """
+        Queue a new message to a chat and wait until it is sent.
+        Pass coalesce=False for a message that will be edited, e.g. a streaming placeholder.
+
+        Returns:
+            Message: The sent message (the last chunk for split texts)
+        """
+        return await self._enqueue(chat_id, OutboundMessage(text, dict(kwargs, _bot=bot, chat_id=chat_id),
+                                                            coalesce=coalesce))
+
+    async def edit(self, message, text: str, **kwargs):
+        """
+        Queue an edit of a sent message and wait until it is applied.
+        A still-queued edit of the same message is replaced by the newer text.
+        Text beyond one message is sent as new messages after the edited one.
+
+        Returns:
+            Message: The edited message, or the last new message for split texts
+        """
+        queue = self.chats.get(message.chat_id)
+        if queue is not None:
+            for item in queue.items:
+                if item.message is not None and item.message.message_id == message.message_id:
+                    item.text = text
+                    item.kwargs = kwargs
+                    future = asyncio.get_running_loop().create_future()
+                    item.futures.append(future)
+                    self.coalesced += 1
+                    return await future
+        return await self._enqueue(message.chat_id, OutboundMessage(text, kwargs, message=message))
+
+    async def _enqueue(self, chat_id: int, item: OutboundMessage):
+        queue = self.chats.get(chat_id)
+        if queue is None:
+            queue = self.chats[chat_id] = ChatQueue()
+            worker = asyncio.create_task(self._run_chat(chat_id, queue))
+            self._workers.add(worker)
+            worker.add_done_callback(self._workers.discard)
+        queue.items.append(item)
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        return await item.futures[0]
+
+    @staticmethod
+    def _is_plain(item: OutboundMessage) -> bool:
+        """A new message without a keyboard or other send options that may be merged with others."""
+        return item.message is None and item.coalesce and set(item.kwargs) == {'_bot', 'chat_id'}
+
+    def _coalesce(self, item: OutboundMessage, items: Deque[OutboundMessage]) -> OutboundMessage:
+        """Merge following plain messages into this one while they fit in one message."""
+        if not self._is_plain(item):
+            return item
+        while items:
+            following = items[0]
+            if not self._is_plain(following):
+                break
+            merged = item.text + COALESCE_SEPARATOR + following.text
+            if len(merged) > MAX_MESSAGE_LENGTH:
+                break
+            items.popleft()
+            item.text = merged
+            item.futures.extend(following.futures)
+            self.coalesced += 1
+        return item
+
+    async def _run_chat(self, chat_id: int, queue: ChatQueue):
+        """Deliver a chat's queued messages in order, one per chat interval, then exit."""
+        while queue.items:
+            item = self._coalesce(queue.items.popleft(), queue.items)
+            try:
+                result = await self._deliver(item)
+            except Exception as e:
+                for future in item.futures:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                self.send_latencies.append(time.monotonic() - item.enqueued_at)
+                for future in item.futures:
+                    if not future.done():
+                        future.set_result(result)
+            # Messages queued meanwhile wait out the interval (and may be coalesced)
+            await asyncio.sleep(self.chat_interval)
+        del self.chats[chat_id]
+
+    async def _deliver(self, item: OutboundMessage):
+        """Send or edit, splitting long texts and waiting out flood control."""
+        chunks = split_text(item.text)
+        kwargs = dict(item.kwargs)
+        if item.message is not None:
+            # The first chunk replaces the message's text, the rest follow as new messages
+            bot = item.message.get_bot()
+            chat_id = item.message.chat_id
+            first_kwargs = kwargs if len(chunks) == 1 else {}
+            result = await self._call(lambda: item.message.edit_text(chunks[0], **first_kwargs))
+            chunks = chunks[1:]
+        else:
+            bot = kwargs.pop('_bot')
+            chat_id = kwargs.pop('chat_id', None)
+            result = None
+        for index, chunk in enumerate(chunks):
+            # Keyboards and other options go with the last chunk
+            chunk_kwargs = kwargs if index == len(chunks) - 1 else {}
+            result = await self._call(lambda: bot.send_message(chat_id=chat_id, text=chunk, **chunk_kwargs))
+        return result
+
+    async def _call(self, request):
+        """Make one Bot API request under the global rate limit, retrying flood waits."""
+        for attempt in range(self.max_flood_retries + 1):
+            await self.bucket.acquire()
+            try:
+                result = await request()
+                self.sent += 1
+                return result
+            except RetryAfter as e:
+                if attempt == self.max_flood_retries:
+                    raise
+                self.flood_waits += 1
+                delay = retry_after_seconds(e)
+                logger.warning(f"Telegram flood control, retrying in {delay:.0f}s")
+                await asyncio.sleep(delay)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return queue depth, send latency and flood-control statistics."""
+        latencies = sorted(self.send_latencies)
+        return {
+            'queue_depth': self.queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+            'active_chats': len(self.chats),
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'flood_waits': self.flood_waits,
+            'send_latency_mean': sum(latencies) / len(latencies) if latencies else 0.0,
+            'send_latency_p95': latencies[int(0.95 * (len(latencies) - 1))] if latencies else 0.0,
+        }
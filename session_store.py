@@ -0,0 +1,504 @@
+"""
+Sharded SQLite session store with dirty tracking, write-behind and a crash-recovery journal
+"""
+
+import asyncio
+import logging
+import os
+import sqlite3
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Iterator, List, Tuple
+
+from state_codec import StateCodec, decode_state
+
+logger = logging.getLogger(__name__)
+
+# Journal record header: user_id (signed 64-bit) and blob length (unsigned 32-bit)
+_RECORD_HEADER = struct.Struct('<qI')
+# Packing of user ids for shard hashing
+_USER_ID = struct.Struct('<q')
+
+
+def shard_paths(db_path: str, shards: int) -> List[str]:
+    """
+    Return the database file of each shard.
+
+    A single shard is the database file itself, so an unsharded store keeps
+    its existing file; N shards live next to it as <name>.shard<i><ext>.
+    """
+    if shards <= 1:
+        return [db_path]
+    base, ext = os.path.splitext(db_path)
+    return [f"{base}.shard{index}{ext}" for index in range(shards)]
+
+
+def shard_index(user_id: int, shards: int) -> int:
+    """Map a user id to its shard with a stable hash."""
+    if shards <= 1:
+        return 0
+    return zlib.crc32(_USER_ID.pack(user_id)) % shards
+
+
+class Shard:
+    """One shard's SQLite file, with a write connection and a separate read connection."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.read_lock = threading.Lock()
+        self.conn = None
+        self.reader = None
+
+    def open(self):
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        # WAL lets this connection read the last committed rows while the writer commits,
+        # so reads on the event loop never wait for a flush transaction
+        self.reader = sqlite3.connect(self.path, check_same_thread=False)
+
+    def close(self):
+        for conn in (self.conn, self.reader):
+            if conn is not None:
+                conn.close()
+        self.conn = None
+        self.reader = None
+
+
+class ShardLayoutError(Exception):
+    """Raised when the configured shard count does not match the store's files."""
+
+
+class SessionStore:
+    """
+    Persist user states to SQLite, sharded by user id across one or more files.
+
+    Saves only mark a session dirty and append its encoded state to an
+    append-only journal; dirty sessions are written every flush interval and
+    at shutdown, in one batched transaction per shard, with the shards written
+    in parallel. When the store is first used the journal is replayed, so a
+    process crash loses no progress, and at most one flush interval of
+    progress can be lost if the host itself goes down.
+
+    Shared quests are kept in the first shard. The database is opened lazily
+    on first use, so creating a store does no I/O.
+    """
+
+    def __init__(self, db_path: str, codec: StateCodec, flush_interval: float = 5.0, journal_path: str = '',
+                 shards: int = 1):
+        self.db_path = db_path
+        self.codec = codec
+        self.flush_interval = flush_interval
+        self.journal_path = journal_path or f"{os.path.splitext(db_path)[0]}.journal"
+        self.shards = [Shard(path) for path in shard_paths(db_path, shards)]
+        self.dirty: Dict[int, bytes] = {}
+        # The batch being written by flush(), still served to readers until it commits
+        self.flushing: Dict[int, bytes] = {}
+        self._lock = threading.Lock()
+        # One flush at a time: a second one would replace the flushing journal the first still owns
+        self._flush_lock = threading.Lock()
+        self._journal = None
+        self._opened = False
+        self._open_lock = threading.Lock()
+        self._executor = None
+
+        # Statistics
+        self.marks = 0
+        self.flushes = 0
+        self.rows_written = 0
+
+    def _ensure_open(self):
+        """Open the shards, create the schema and replay the journal on first use."""
+        if self._opened:
+            return
+        with self._open_lock:
+            if not self._opened:
+                self.init_database()
+                self.recover()
+                self._opened = True
+
+    def _shard(self, user_id: int) -> Shard:
+        return self.shards[shard_index(user_id, len(self.shards))]
+
+    def check_layout(self):
+        """
+        Check that the configured shard count matches the store on disk.
+
+        The count is recorded in the first shard's meta table. Stores written
+        before the marker are checked for files of another layout instead.
+
+        Raises:
+            ShardLayoutError: If the files on disk belong to a different shard count
+        """
+        count = len(self.shards)
+        first = self.shards[0].path
+        stored = None
+        if os.path.exists(first):
+            conn = sqlite3.connect(first)
+            try:
+                if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'meta'").fetchone():
+                    row = conn.execute("SELECT value FROM meta WHERE key = 'shards'").fetchone()
+                    stored = int(row[0]) if row else None
+            finally:
+                conn.close()
+        if stored is not None:
+            if stored != count:
+                raise ShardLayoutError(f"{first} belongs to a store with {stored} shards, but {count} are configured; "
+                                       f"set STATE_SHARDS={stored} or run reshard_sessions.py")
+            return
+
+        existing = [shard.path for shard in self.shards if os.path.exists(shard.path)]
+        # The first file of the other layout, and the shard one past the configured count
+        foreign = shard_paths(self.db_path, 2)[0] if count == 1 else self.db_path
+        extra = shard_paths(self.db_path, count + 1)[count]
+        if 0 < len(existing) < count or os.path.exists(foreign) or os.path.exists(extra):
+            raise ShardLayoutError(f"Session store files next to {self.db_path} do not match {count} shards; "
+                                   f"set STATE_SHARDS to the existing count or run reshard_sessions.py")
+
+    def init_database(self):
+        """Check the shard layout, open every shard and create required tables."""
+        self.check_layout()
+        for shard in self.shards:
+            try:
+                shard.open()
+                with shard.lock, shard.conn:
+                    # Create users table to store user states
+                    shard.conn.execute('''
+                        CREATE TABLE IF NOT EXISTS user_states (
+                            user_id INTEGER PRIMARY KEY,
+                            state_data TEXT NOT NULL,
+                            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                        )
+                    ''')
+
+                    # Quests shared by sessions, stored once by content id
+                    shard.conn.execute('''
+                        CREATE TABLE IF NOT EXISTS quests (
+                            quest_id TEXT PRIMARY KEY,
+                            quest_data TEXT NOT NULL,
+                            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                        )
+                    ''')
+
+                    # Stored quests offered by the warm quest pool, by language and theme
+                    shard.conn.execute('''
+                        CREATE TABLE IF NOT EXISTS pooled_quests (
+                            quest_id TEXT PRIMARY KEY,
+                            language TEXT NOT NULL,
+                            theme TEXT NOT NULL
+                        )
+                    ''')
+            except Exception as e:
+                logger.error(f"Error initializing database {shard.path}: {e}")
+
+        # Record the layout, so that a different STATE_SHARDS is refused on the next start
+        shard = self.shards[0]
+        with shard.lock, shard.conn:
+            shard.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            shard.conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('shards', ?)", (str(len(self.shards)),))
+
+    def _write_shard(self, shard: Shard, rows: List[Tuple[int, bytes]]):
+        """Write encoded states to one shard in a single transaction."""
+        with shard.lock, shard.conn:
+            shard.conn.executemany('''
+                INSERT OR REPLACE INTO user_states
+                (user_id, state_data, updated_at)
+                VALUES (?, ?, CURRENT_TIMESTAMP)
+            ''', rows)
+
+    def _write_batch(self, batch: Dict[int, bytes]):
+        """Write encoded states, one transaction per shard, shards in parallel."""
+        by_shard: Dict[int, List[Tuple[int, bytes]]] = {}
+        for user_id, blob in batch.items():
+            by_shard.setdefault(shard_index(user_id, len(self.shards)), []).append((user_id, blob))
+
+        if len(by_shard) == 1:
+            index, rows = next(iter(by_shard.items()))
+            self._write_shard(self.shards[index], rows)
+        else:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=len(self.shards), thread_name_prefix='shard-writer')
+            futures = [self._executor.submit(self._write_shard, self.shards[index], rows)
+                       for index, rows in by_shard.items()]
+            # Propagate the first failure after every shard has finished
+            errors = [future.exception() for future in futures]
+            for error in errors:
+                if error is not None:
+                    raise error
+        self.rows_written += len(batch)
+
+    def import_rows(self, batch: Dict[int, bytes]):
+        """Write already encoded states directly to their shards (used when resharding)."""
+        self._ensure_open()
+        self._write_batch(batch)
+
+    def save(self, user_id: int, state_data: Dict[str, Any]):
+        """Save user state: write-behind when a flush interval is set, otherwise immediately."""
+        try:
+            self._ensure_open()
+            blob = self.codec.encode(state_data)
+            if self.flush_interval <= 0:
+                self._write_batch({user_id: blob})
+                return
+            with self._lock:
+                self.dirty[user_id] = blob
+                self._append_journal(user_id, blob)
+                self.marks += 1
+        except Exception as e:
+            logger.error(f"Error saving user state for user {user_id}: {e}")
+
+    def load(self, user_id: int) -> Dict[str, Any]:
+        """Load user state, preferring a dirty or still flushing copy over the stored row."""
+        try:
+            self._ensure_open()
+            with self._lock:
+                blob = self.dirty.get(user_id)
+                if blob is None:
+                    blob = self.flushing.get(user_id)
+            if blob is not None:
+                return decode_state(blob)
+
+            # Retrieve user state from its shard
+            shard = self._shard(user_id)
+            with shard.read_lock:
+                result = shard.reader.execute('SELECT state_data FROM user_states WHERE user_id = ?', (user_id,)).fetchone()
+
+            if result:
+                return decode_state(result[0])
+            else:
+                return {}
+        except Exception as e:
+            logger.error(f"Error loading user state for user {user_id}: {e}")
+            return {}
+
+    def iter_rows(self) -> Iterator[Tuple[int, bytes]]:
+        """Yield the stored (user_id, encoded state) rows of every shard."""
+        self._ensure_open()
+        for shard in self.shards:
+            with shard.read_lock:
+                rows = shard.reader.execute('SELECT user_id, state_data FROM user_states').fetchall()
+            yield from rows
+
+    def load_all(self) -> Dict[int, Dict[str, Any]]:
+        """Load all user states."""
+        states = {}
+        try:
+            for user_id, state_data in self.iter_rows():
+                states[user_id] = decode_state(state_data)
+
+            with self._lock:
+                dirty = dict(self.flushing)
+                dirty.update(self.dirty)
+            for user_id, blob in dirty.items():
+                states[user_id] = decode_state(blob)
+        except Exception as e:
+            logger.error(f"Error loading all user states: {e}")
+        return states
+
+    # Shared quests
+
+    def save_quest(self, quest_id: str, quest_data: Dict[str, Any]):
+        """Store a shared quest once; quests are immutable, so an existing row is kept."""
+        try:
+            self._ensure_open()
+            self.write_quest_rows([(quest_id, self.codec.encode(quest_data))])
+        except Exception as e:
+            logger.error(f"Error saving quest {quest_id}: {e}")
+
+    def write_quest_rows(self, rows: List[Tuple[str, bytes]]):
+        """Store encoded quests, keeping existing rows."""
+        self._ensure_open()
+        shard = self.shards[0]
+        with shard.lock, shard.conn:
+            shard.conn.executemany('INSERT OR IGNORE INTO quests (quest_id, quest_data) VALUES (?, ?)', rows)
+
+    def iter_quest_rows(self) -> Iterator[Tuple[str, bytes]]:
+        """Yield the stored (quest_id, encoded quest) rows."""
+        self._ensure_open()
+        shard = self.shards[0]
+        with shard.read_lock:
+            rows = shard.reader.execute('SELECT quest_id, quest_data FROM quests').fetchall()
+        yield from rows
+
+    def load_quest(self, quest_id: str) -> Dict[str, Any]:
+        """Load a shared quest by id."""
+        try:
+            self._ensure_open()
+            shard = self.shards[0]
+            with shard.read_lock:
+                result = shard.reader.execute('SELECT quest_data FROM quests WHERE quest_id = ?', (quest_id,)).fetchone()
+            return decode_state(result[0]) if result else {}
+        except Exception as e:
+            logger.error(f"Error loading quest {quest_id}: {e}")
+            return {}
+
+    def save_pooled_quest(self, quest_id: str, quest_data: Dict[str, Any], language: str, theme: str):
+        """Store a shared quest and offer it to the warm quest pool for a language and theme."""
+        self.save_quest(quest_id, quest_data)
+        self.write_pooled_quest_rows([(quest_id, language, theme)])
+
+    def write_pooled_quest_rows(self, rows: List[Tuple[str, str, str]]):
+        """Store (quest_id, language, theme) pool entries, keeping existing rows."""
+        self._ensure_open()
+        shard = self.shards[0]
+        with shard.lock, shard.conn:
+            shard.conn.executemany('INSERT OR IGNORE INTO pooled_quests (quest_id, language, theme) VALUES (?, ?, ?)',
+                                   rows)
+
+    def iter_pooled_quest_rows(self) -> Iterator[Tuple[str, str, str]]:
+        """Yield the stored (quest_id, language, theme) pool entries."""
+        self._ensure_open()
+        shard = self.shards[0]
+        with shard.read_lock:
+            rows = shard.reader.execute('SELECT quest_id, language, theme FROM pooled_quests').fetchall()
+        yield from rows
+
+    def load_pooled_quests(self) -> List[Tuple[str, str, Dict[str, Any]]]:
+        """Load the stored pool quests as (language, theme, quest) tuples."""
+        quests = []
+        try:
+            self._ensure_open()
+            shard = self.shards[0]
+            with shard.read_lock:
+                rows = shard.reader.execute('''
+                    SELECT pooled_quests.language, pooled_quests.theme, quests.quest_data
+                    FROM pooled_quests JOIN quests ON quests.quest_id = pooled_quests.quest_id
+                ''').fetchall()
+            for language, theme, blob in rows:
+                quests.append((language, theme, decode_state(blob)))
+        except Exception as e:
+            logger.error(f"Error loading pooled quests: {e}")
+        return quests
+
+    # Journal
+
+    def _append_journal(self, user_id: int, blob: bytes):
+        """Append an encoded state to the journal (caller holds the lock)."""
+        if self._journal is None:
+            self._journal = open(self.journal_path, 'ab')
+        self._journal.write(_RECORD_HEADER.pack(user_id, len(blob)) + blob)
+        self._journal.flush()
+
+    def _rotate_journal(self) -> str:
+        """Move the current journal aside for flushing (caller holds the lock)."""
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        flushing_path = f"{self.journal_path}.flushing"
+        if os.path.exists(self.journal_path):
+            os.replace(self.journal_path, flushing_path)
+        return flushing_path
+
+    def _read_journal(self, path: str) -> Iterator[Tuple[int, bytes]]:
+        """Read journal records, stopping at a truncated trailing record."""
+        with open(path, 'rb') as journal:
+            data = journal.read()
+        offset = 0
+        while offset + _RECORD_HEADER.size <= len(data):
+            user_id, length = _RECORD_HEADER.unpack_from(data, offset)
+            offset += _RECORD_HEADER.size
+            if offset + length > len(data):
+                logger.warning(f"Ignoring truncated journal record for user {user_id}")
+                break
+            yield user_id, data[offset:offset + length]
+            offset += length
+
+    def recover(self):
+        """Replay journals left by a crash into the database."""
+        batch: Dict[int, bytes] = {}
+        paths = [f"{self.journal_path}.flushing", self.journal_path]
+        try:
+            for path in paths:
+                if os.path.exists(path):
+                    for user_id, blob in self._read_journal(path):
+                        batch[user_id] = blob
+            if batch:
+                self._write_batch(batch)
+                logger.info(f"Recovered {len(batch)} user states from the journal")
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+        except Exception as e:
+            logger.error(f"Error recovering user states from the journal: {e}")
+
+    # Write-behind
+
+    def flush(self) -> int:
+        """
+        Write all dirty sessions, one transaction per shard, and discard the flushed journal.
+
+        Returns:
+            int: Number of sessions written
+        """
+        # Waits out a flush still running in the background worker's thread, e.g. when close() is called
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self) -> int:
+        """Write the dirty sessions (caller holds the flush lock)."""
+        with self._lock:
+            if not self.dirty:
+                return 0
+            batch, self.dirty = self.dirty, {}
+            self.flushing = batch
+            flushing_path = self._rotate_journal()
+
+        try:
+            self._write_batch(batch)
+            self.flushes += 1
+        except Exception as e:
+            logger.error(f"Error flushing {len(batch)} user states: {e}")
+            # Keep the sessions dirty unless they were saved again meanwhile
+            # (rewriting sessions that did reach their shard is harmless)
+            with self._lock:
+                for user_id, blob in batch.items():
+                    if user_id not in self.dirty:
+                        self.dirty[user_id] = blob
+                        self._append_journal(user_id, blob)
+            return 0
+        finally:
+            # Readers fall back to the shards only once the batch is committed (or dirty again)
+            with self._lock:
+                self.flushing = {}
+            if os.path.exists(flushing_path):
+                os.remove(flushing_path)
+        return len(batch)
+
+    async def run(self):
+        """Background worker: flush dirty sessions every flush interval until cancelled."""
+        if self.flush_interval <= 0:
+            return
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await asyncio.to_thread(self.flush)
+
+    def close(self):
+        """Flush remaining dirty sessions, close the journal and the shard connections."""
+        self.flush()
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            if not self.dirty and os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        for shard in self.shards:
+            with shard.lock, shard.read_lock:
+                shard.close()
+        self._opened = False
+
+    def stats(self) -> Dict[str, Any]:
+        """Return write-behind statistics."""
+        return {
+            'shards': len(self.shards),
+            'dirty': len(self.dirty),
+            'marks': self.marks,
+            'flushes': self.flushes,
+            'rows_written': self.rows_written,
+        }
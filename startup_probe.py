@@ -0,0 +1,36 @@
+"""
+Startup-time probe: reports the time from process import to the first handled update
+"""
+
+import logging
+import time
+from typing import List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Taken when this module is first imported; main.py imports it before anything else
+IMPORT_STARTED = time.perf_counter()
+
+_phases: List[Tuple[str, float]] = []
+_first_update_reported = False
+
+
+def mark(phase: str):
+    """Record that a startup phase has completed."""
+    _phases.append((phase, time.perf_counter() - IMPORT_STARTED))
+
+
+def report_first_update():
+    """Log the startup timeline once, when the first update has been handled."""
+    global _first_update_reported
+    if _first_update_reported:
+        return
+    _first_update_reported = True
+    mark('first_update_handled')
+    timeline = ', '.join(f"{phase} {elapsed:.3f}s" for phase, elapsed in _phases)
+    logger.info(f"Startup probe: {timeline}")
+
+
+def phases() -> List[Tuple[str, float]]:
+    """Return the recorded (phase, seconds since import) pairs."""
+    return list(_phases)
@@ -0,0 +1,121 @@
+"""
+Pluggable codecs for serializing user state blobs stored in SQLite
+"""
+
+import json
+import logging
+import zlib
+from abc import ABC, abstractmethod
+from typing import Dict, Any, Union
+
+logger = logging.getLogger(__name__)
+
+# Every blob written by a codec starts with a one-byte tag so that rows
+# written with different codecs (and legacy plain-text JSON rows) can live
+# side by side in the same table and be decoded transparently.
+TAG_JSON = b'J'
+TAG_ZLIB = b'Z'
+
+
+class StateCodec(ABC):
+    """Base class for state codecs; a codec missing either method cannot be instantiated."""
+
+    name = 'base'
+    tag = b''
+
+    @abstractmethod
+    def encode(self, state_data: Dict[str, Any]) -> bytes:
+        """Serialize a state to a blob starting with the codec's tag."""
+
+    @abstractmethod
+    def decode_payload(self, payload: bytes) -> Dict[str, Any]:
+        """Deserialize a blob with its tag already stripped."""
+
+
+def _compact_json(state_data: Dict[str, Any]) -> bytes:
+    """Serialize to compact UTF-8 JSON without escaping non-ASCII text."""
+    return json.dumps(state_data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class CompactJsonCodec(StateCodec):
+    """Compact UTF-8 JSON: no \\uXXXX escapes, no whitespace."""
+
+    name = 'json'
+    tag = TAG_JSON
+
+    def encode(self, state_data: Dict[str, Any]) -> bytes:
+        return self.tag + _compact_json(state_data)
+
+    def decode_payload(self, payload: bytes) -> Dict[str, Any]:
+        return json.loads(payload.decode('utf-8'))
+
+
+class ZlibJsonCodec(StateCodec):
+    """Compact UTF-8 JSON compressed with zlib."""
+
+    name = 'zlib'
+    tag = TAG_ZLIB
+
+    def __init__(self, level: int = 6):
+        self.level = level
+
+    def encode(self, state_data: Dict[str, Any]) -> bytes:
+        return self.tag + zlib.compress(_compact_json(state_data), self.level)
+
+    def decode_payload(self, payload: bytes) -> Dict[str, Any]:
+        return json.loads(zlib.decompress(payload).decode('utf-8'))
+
+
+CODECS: Dict[str, StateCodec] = {
+    CompactJsonCodec.name: CompactJsonCodec(),
+    ZlibJsonCodec.name: ZlibJsonCodec(),
+}
+
+_CODECS_BY_TAG: Dict[bytes, StateCodec] = {codec.tag: codec for codec in CODECS.values()}
+
+
+def get_codec(name: str) -> StateCodec:
+    """
+    Look up a codec by name, falling back to zlib for unknown names.
+
+    Args:
+        name (str): Codec name ('json' or 'zlib')
+
+    Returns:
+        StateCodec: The codec instance
+    """
+    codec = CODECS.get(name)
+    if codec is None:
+        logger.warning(f"Unknown state codec '{name}', falling back to 'zlib'")
+        codec = CODECS[ZlibJsonCodec.name]
+    return codec
+
+
+def decode_state(raw: Union[str, bytes, None]) -> Dict[str, Any]:
+    """
+    Decode a stored state blob written by any codec.
+
+    Legacy rows are plain ``json.dumps`` text (stored as TEXT) and are
+    recognised by their leading ``{``.
+
+    Args:
+        raw (Union[str, bytes, None]): Value of the state_data column
+
+    Returns:
+        Dict[str, Any]: The decoded state (empty dict for empty input)
+    """
+    if not raw:
+        return {}
+
+    if isinstance(raw, str):
+        # Legacy plain-text JSON row
+        return json.loads(raw)
+
+    raw = bytes(raw)
+    if raw[:1] == b'{':
+        return json.loads(raw.decode('utf-8'))
+
+    codec = _CODECS_BY_TAG.get(raw[:1])
+    if codec is None:
+        raise ValueError(f"Unknown state blob tag: {raw[:1]!r}")
+    return codec.decode_payload(raw[1:])
@@ -0,0 +1,74 @@
+"""
+Rolling, token-capped summary of the path a child has taken through a quest
+"""
+
+import re
+from typing import List
+
+# Rough characters-per-token ratio for Russian and English text
+CHARS_PER_TOKEN = 3
+# Longest fragment of a step's text or a choice kept in one summary entry
+MAX_STEP_CHARS = 160
+# Entry standing in for trimmed middle parts of the story
+ELISION = "…"
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the token count of a text without a tokenizer."""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def _shorten(text: str) -> str:
+    """Return the first sentence of a text, shortened to MAX_STEP_CHARS."""
+    text = ' '.join(text.split())
+    match = re.search(r'[.!?…](\s|$)', text)
+    sentence = text[:match.end()].strip() if match else text
+    if len(sentence) > MAX_STEP_CHARS:
+        sentence = sentence[:MAX_STEP_CHARS - 1].rstrip() + ELISION
+    return sentence
+
+
+def add_entry(summary: List[str], step_text: str, choice_text: str, token_budget: int) -> List[str]:
+    """
+    Record a step taken and keep the summary within the token budget.
+
+    Each entry is the first sentence of the step followed by the child's choice.
+    When the budget is exceeded, the oldest entries after the opening one are
+    replaced by a single elision, so the start of the story and the most recent
+    steps are always kept. Cost is proportional to the (bounded) summary size.
+
+    Args:
+        summary (List[str]): Current summary entries (not modified)
+        step_text (str): Text of the step the choice was made at
+        choice_text (str): The chosen option or free-text choice
+        token_budget (int): Maximum estimated tokens of the rendered summary
+
+    Returns:
+        List[str]: The new summary entries
+    """
+    entries = summary + [f"{_shorten(step_text)} → {_shorten(choice_text)}"]
+    while estimate_tokens(render(entries)) > token_budget:
+        # Drop the oldest entry after the opening one, keeping one elision marker
+        if entries[1:2] == [ELISION] and len(entries) > 3:
+            del entries[2]
+        elif len(entries) > 2 and entries[1] != ELISION:
+            entries[1] = ELISION
+        else:
+            break
+    if estimate_tokens(render(entries)) > token_budget and len(entries) > 1:
+        # Even the opening and latest entries do not fit: keep only the latest
+        entries = entries[-1:]
+    return entries
+
+
+def remove_last_entry(summary: List[str]) -> List[str]:
+    """Forget the most recent step, e.g. when the child goes back."""
+    entries = summary[:-1]
+    if entries and entries[-1] == ELISION:
+        entries.pop()
+    return entries
+
+
+def render(summary: List[str]) -> str:
+    """Render summary entries for a prompt."""
+    return "\n".join(summary)
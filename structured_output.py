@@ -0,0 +1,72 @@
+"""
+Schema-constrained structured output for LLM calls, with parse-failure accounting
+"""
+
+from collections import defaultdict
+from typing import Dict, Any
+
+# Words in an API error that mean the backend rejected the response_format parameter
+UNSUPPORTED_MARKERS = ('response_format', 'json_schema', 'structured output', 'structured_output')
+
+
+def response_format(name: str, schema: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Build the response_format parameter constraining a completion to a JSON schema.
+
+    The schema is not strict: strict mode would require every object in it to
+    forbid additional properties and list every property as required.
+    """
+    return {
+        'type': 'json_schema',
+        'json_schema': {'name': name, 'schema': schema, 'strict': False},
+    }
+
+
+def is_unsupported_error(error: Exception) -> bool:
+    """Tell whether an API error is a backend rejecting structured output, rather than a real failure."""
+    if getattr(error, 'status_code', None) not in (400, 404, 422):
+        return False
+    message = str(error).lower()
+    return any(marker in message for marker in UNSUPPORTED_MARKERS)
+
+
+class ParseStats:
+    """
+    Parse-failure and retry rates per schema, split by output mode: 'constrained'
+    (JSON with a response_format schema), 'free' (JSON asked for in the prompt)
+    or 'wire' (the compact line format of quest_wire).
+
+    Comparing the rows shows what each mode buys on the configured backends.
+    """
+
+    def __init__(self):
+        self.answers: Dict[tuple, int] = defaultdict(int)
+        self.failures: Dict[tuple, int] = defaultdict(int)
+        self.requests: Dict[str, int] = defaultdict(int)
+        self.retries: Dict[str, int] = defaultdict(int)
+
+    def record_answer(self, schema_name: str, mode: str, parsed: bool):
+        """Record whether a backend's answer in the given output mode parsed and validated."""
+        key = (schema_name, mode)
+        self.answers[key] += 1
+        if not parsed:
+            self.failures[key] += 1
+
+    def record_request(self, schema_name: str):
+        """Record a top-level request (e.g. one generate_quest call)."""
+        self.requests[schema_name] += 1
+
+    def record_retry(self, schema_name: str):
+        """Record a retry of a top-level request."""
+        self.retries[schema_name] += 1
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        result: Dict[str, Dict[str, Any]] = {}
+        for (schema_name, mode), answers in self.answers.items():
+            result.setdefault(schema_name, {})[mode] = {
+                'answers': answers,
+                'parse_failure_rate': self.failures[(schema_name, mode)] / answers,
+            }
+        for schema_name, requests in self.requests.items():
+            result.setdefault(schema_name, {})['retries_per_request'] = self.retries[schema_name] / requests
+        return result
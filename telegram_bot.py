@@ -1,16 +1,42 @@
+import asyncio
 import logging
-import sqlite3
-from typing import Dict, Any
+import math
+import time
+from typing import Dict, Any, List, Optional
 
 # Import detect_language function from utils
 from utils import detect_language
+import startup_probe
+import memory_probe
+import story_summary
+import tracing
+from state_codec import get_codec
+from session_store import SessionStore
+from retry_policy import CircuitOpenError
+from quest_pool import QuestPool
+from quest_library import QuestLibrary
+from send_queue import OutboundDispatcher, MAX_MESSAGE_LENGTH
+from user_quota import QuotaPolicy, OP_GENERATION, OP_BRANCH, OP_CHOICE
 
 # Import telegram bot components
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import (
+    Application, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, filters, ContextTypes
+)
 
 # Import configuration
-from config import TELEGRAM_BOT_TOKEN
+from config import (
+    TELEGRAM_BOT_TOKEN, STATE_CODEC, STATE_FLUSH_INTERVAL, STATE_JOURNAL_PATH, STATE_SHARDS,
+    QUEST_POOL_ENABLED, QUEST_POOL_SIZE, QUEST_POOL_HOURLY_BUDGET,
+    QUEST_POOL_IDLE_SECONDS, QUEST_POOL_MAX_WORDS,
+    GENERATION_TIMEOUT, BRANCH_TIMEOUT, CHOICE_TIMEOUT,
+    STREAM_BRANCHES, STREAM_EDIT_INTERVAL, WARM_UP_STATES,
+    TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_INTERVAL,
+    ADMIN_USER_IDS, TRACEMALLOC_ENABLED, MEMORY_REPORT_INTERVAL,
+    STORY_SUMMARY_TOKENS, TRACE_SAMPLE_RATE, TRACE_EXPORT_PATH,
+    QUOTA_ENABLED, QUOTA_CAPACITY, QUOTA_REFILL_PER_MINUTE,
+    QUOTA_COST_GENERATION, QUOTA_COST_BRANCH, QUOTA_COST_CHOICE
+)
 
 # Configure logging
 logging.basicConfig(
@@ -19,80 +45,121 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+
+# Prefix of inline keyboard choice callbacks: "c:<quest version>:<step index>:<option index>"
+CHOICE_CALLBACK_PREFIX = 'c'
+
+
+class RequestAbandoned(Exception):
+    """Raised in a handler whose engine request was cancelled by a newer command."""
+
+
+def make_choice_callback(quest_version: int, step_index: int, option_index: int) -> str:
+    """Encode a choice as compact callback data (well under Telegram's 64-byte limit)."""
+    return f"{CHOICE_CALLBACK_PREFIX}:{quest_version}:{step_index}:{option_index}"
+
+
+def parse_choice_callback(data: str):
+    """Decode choice callback data into (quest version, step index, option index), or None."""
+    parts = (data or '').split(':')
+    if len(parts) != 4 or parts[0] != CHOICE_CALLBACK_PREFIX:
+        return None
+    try:
+        return int(parts[1]), int(parts[2]), int(parts[3])
+    except ValueError:
+        return None
+
+
 class KidQuestBot:
     def __init__(self):
         self.user_states: Dict[int, Dict[str, Any]] = {}
-        self.db_path = 'kidquest_bot.db'
-        self.init_database()
+        self.session_store = SessionStore(
+            'kidquest_bot.db',
+            get_codec(STATE_CODEC),
+            flush_interval=STATE_FLUSH_INTERVAL,
+            journal_path=STATE_JOURNAL_PATH,
+            shards=STATE_SHARDS
+        )
+        # Quests are interned and shared; sessions hold a quest id and their own branch steps
+        self.quest_library = QuestLibrary(self.session_store.load_quest, self.session_store.save_quest)
+        self.quest_engine = None
+        self.background_tasks = []
+        # In-flight engine requests per user, cancelled by /new, /start and /back
+        self.active_requests: Dict[int, asyncio.Task] = {}
+        self.quest_pool = QuestPool(
+            target_size=QUEST_POOL_SIZE,
+            hourly_budget=QUEST_POOL_HOURLY_BUDGET,
+            idle_seconds=QUEST_POOL_IDLE_SECONDS,
+            max_words=QUEST_POOL_MAX_WORDS
+        ) if QUEST_POOL_ENABLED else None
+        # All outgoing messages go through one paced queue per chat
+        self.dispatcher = OutboundDispatcher(
+            global_rate=TELEGRAM_GLOBAL_RATE,
+            chat_interval=TELEGRAM_CHAT_INTERVAL
+        )
+        # Per-user budgets for model calls, weighted by each operation's cost
+        self.quota = QuotaPolicy(
+            capacity=QUOTA_CAPACITY,
+            refill_per_minute=QUOTA_REFILL_PER_MINUTE,
+            costs={OP_GENERATION: QUOTA_COST_GENERATION, OP_BRANCH: QUOTA_COST_BRANCH, OP_CHOICE: QUOTA_COST_CHOICE}
+        ) if QUOTA_ENABLED else None
+        # Sampled per-phase latency traces of the handlers
+        tracing.configure(TRACE_SAMPLE_RATE, TRACE_EXPORT_PATH)
+
+    def get_quest_engine(self):
+        """Return the shared QuestEngine, creating it on first use."""
+        if self.quest_engine is None:
+            from quest_engine import QuestEngine
+            self.quest_engine = QuestEngine()
+        return self.quest_engine
         
-    def init_database(self):
-        """Initialize the SQLite database and create required tables."""
+    async def run_cancellable(self, user_id: int, coro):
+        """
+        Run an engine request as the user's single in-flight request.
+        Raises RequestAbandoned if the request is cancelled by a newer command.
+        """
+        self.cancel_active_request(user_id)
+        task = asyncio.ensure_future(coro)
+        self.active_requests[user_id] = task
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # Create users table to store user states
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS user_states (
-                    user_id INTEGER PRIMARY KEY,
-                    state_data TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            conn.commit()
-            conn.close()
-        except Exception as e:
-            logger.error(f"Error initializing database: {e}")
-    
+            await asyncio.wait({task})
+        finally:
+            if not task.done():
+                task.cancel()
+            if self.active_requests.get(user_id) is task:
+                del self.active_requests[user_id]
+        if task.cancelled():
+            raise RequestAbandoned()
+        return task.result()
+
+    def cancel_active_request(self, user_id: int):
+        """Cancel the user's in-flight engine request, if any."""
+        task = self.active_requests.pop(user_id, None)
+        if task is not None and not task.done():
+            logger.info(f"Cancelling abandoned request for user {user_id}")
+            task.cancel()
+        
+    async def reply(self, update, text: str, **kwargs):
+        """Send a message to the update's chat through the outbound dispatcher."""
+        with tracing.span('telegram_send'):
+            return await self.dispatcher.send(update.get_bot(), update.effective_chat.id, text, **kwargs)
+        
     def save_user_state(self, user_id: int, state_data: Dict[str, Any]):
-        """Save user state to SQLite database."""
-        try:
-            import json
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # Serialize the state data to JSON
-            serialized_data = json.dumps(state_data)
-            
-            # Insert or update user state
-            cursor.execute('''
-                INSERT OR REPLACE INTO user_states
-                (user_id, state_data, updated_at)
-                VALUES (?, ?, CURRENT_TIMESTAMP)
-            ''', (user_id, serialized_data))
-            
-            conn.commit()
-            conn.close()
-        except Exception as e:
-            logger.error(f"Error saving user state for user {user_id}: {e}")
+        """Save user state; the session store writes it behind in batches."""
+        with tracing.span('state_save'):
+            self.session_store.save(user_id, state_data)
     
     def load_user_state(self, user_id: int) -> Dict[str, Any]:
-        """Load user state from SQLite database."""
-        try:
-            import json
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # Retrieve user state
-            cursor.execute('SELECT state_data FROM user_states WHERE user_id = ?', (user_id,))
-            result = cursor.fetchone()
-            
-            conn.close()
-            
-            if result:
-                return json.loads(result[0])
-            else:
-                return {}
-        except Exception as e:
-            logger.error(f"Error loading user state for user {user_id}: {e}")
-            return {}
+        """Load user state from the session store."""
+        with tracing.span('state_load'):
+            return self.quest_library.migrate_state(self.session_store.load(user_id))
         
+    @tracing.traced
     async def start(self, update, context):
         """Send welcome message when /start command is issued."""
         user = update.effective_user
         user_id = user.id
+        self.cancel_active_request(user_id)
         
         # Load existing state from database or create new one
         self.user_states[user_id] = self.load_user_state(user_id)
@@ -112,11 +179,15 @@ class KidQuestBot:
         # Set initial state with language detection
         self.user_states[user_id] = {
             'quest_requirements': None,
-            'current_quest': None,
+            'quest_id': None,
+            'quest_branches': [],
+            'story_summary': [],
             'current_step_id': None,
             'step_history': [],
             'quest_started': False,
-            'user_language': detected_language
+            'user_language': detected_language,
+            # The quota outlives quests, so that /start cannot reset it
+            'quota': self.user_states[user_id].get('quota')
         }
         
         if detected_language == 'en':
@@ -133,12 +204,14 @@ class KidQuestBot:
                 f"Ваш язык: {telegram_language}\n\n"
                 "Напиши /new, чтобы начать новый квест!"
             )
-        await update.message.reply_text(welcome_text)
+        await self.reply(update, welcome_text)
         
+    @tracing.traced
     async def new_quest(self, update, context):
         """Initiate a new quest by asking for requirements."""
         user_id = update.effective_user.id
         user = update.effective_user
+        self.cancel_active_request(user_id)
         
         # Load existing state from database or create new one
         self.user_states[user_id] = self.load_user_state(user_id)
@@ -153,11 +226,15 @@ class KidQuestBot:
         # Clear any existing state for this user (but keep the loaded state structure)
         self.user_states[user_id] = {
             'quest_requirements': None,
-            'current_quest': None,
+            'quest_id': None,
+            'quest_branches': [],
+            'story_summary': [],
             'current_step_id': None,
             'step_history': [],
             'quest_started': False,
-            'user_language': detected_language  # Use newly detected language
+            'user_language': detected_language,  # Use newly detected language
+            # The quota outlives quests, so that /new cannot reset it
+            'quota': self.user_states[user_id].get('quota')
         }
         
         if detected_language == 'en':
@@ -181,14 +258,15 @@ class KidQuestBot:
                 "Пиши всё свободным текстом - я сделаю из этого отличную историю!"
             )
         
-        await update.message.reply_text(welcome_text)
+        await self.reply(update, welcome_text)
         
+    @tracing.traced
     async def handle_requirements(self, update, context):
         """Handle user's requirements description for the quest."""
         user_id = update.effective_user.id
         user = update.effective_user
         
-        if user_id not in self.user_states:
+        if not self.ensure_user_state(user_id):
             # If no state exists, start a new quest
             await self.new_quest(update, context)
             return
@@ -210,32 +288,81 @@ class KidQuestBot:
         
         # If we couldn't determine language from Telegram, fall back to text detection
         if detected_language == 'ru':
-            fallback_detected_language = detect_language(requirements)
+            with tracing.span('language_detection'):
+                fallback_detected_language = detect_language(requirements)
             if fallback_detected_language in ['en', 'ru']:
                 detected_language = fallback_detected_language
         
         self.user_states[user_id]['user_language'] = detected_language
         
         try:
-            logger.info(f"Generating quest for user {user_id} with requirements: {requirements}")
-            
-            from quest_engine import QuestEngine
-            quest_engine = QuestEngine()
-            
-            # Create a temporary quest object to store in state
-            quest_data = await quest_engine.generate_quest(requirements, self.user_states[user_id]['user_language'])
+            # Serve vague or common requirements from the warm pool when possible
+            quest_data = None
+            charged = False
+            if self.quest_pool is not None:
+                self.quest_pool.note_activity()
+                with tracing.span('quest_pool'):
+                    quest_data = self.quest_pool.take(requirements, detected_language)
+                if quest_data is not None:
+                    logger.info(f"Serving pooled quest to user {user_id} for requirements: {requirements}")
+            
+            if quest_data is None:
+                charged = self.spend_quota(user_id, OP_GENERATION)
+                if not charged:
+                    # Over quota: serve any ready quest instead of generating one, or ask to wait
+                    if self.quest_pool is not None:
+                        quest_data = self.quest_pool.take_any(detected_language)
+                    if quest_data is None:
+                        await self.reply(update, self.over_quota_text(user_id, OP_GENERATION, detected_language))
+                        return
+            
+            if quest_data is None:
+                logger.info(f"Generating quest for user {user_id} with requirements: {requirements}")
+                
+                quest_engine = self.get_quest_engine()
+                
+                # Create a temporary quest object to store in state
+                deadline = time.monotonic() + GENERATION_TIMEOUT
+                try:
+                    with tracing.span('llm_generate'):
+                        quest_data = await self.run_cancellable(
+                            user_id,
+                            quest_engine.generate_quest(requirements, self.user_states[user_id]['user_language'],
+                                                        deadline=deadline)
+                        )
+                except CircuitOpenError as e:
+                    # Generation is unavailable: serve any ready quest instead, or ask to come back later
+                    logger.warning(f"Quest generation unavailable for user {user_id}: {e}")
+                    self.refund_quota(user_id, OP_GENERATION)
+                    charged = False
+                    if self.quest_pool is not None:
+                        quest_data = self.quest_pool.take_any(detected_language)
+                    if quest_data is None:
+                        await self.reply(update, self.try_later_text(detected_language))
+                        return
             
             if not quest_data:
+                # Failed or timed-out generations are not charged
+                if charged:
+                    self.refund_quota(user_id, OP_GENERATION)
                 error_msg = "Извини, не удалось создать квест. Попробуй ещё раз с другими словами."
-                await update.message.reply_text(error_msg)
+                await self.reply(update, error_msg)
                 return
                 
-            # Store the generated quest in user state
+            # Share one read-only copy of the quest and vectorize its options for local choice matching
+            with tracing.span('intern_quest'):
+                quest = self.quest_library.intern(quest_data)
+                self.get_quest_engine().index_quest(quest.quest)
+            
+            # Store the quest reference in user state; the version invalidates keyboards of earlier quests
             self.user_states[user_id]['quest_requirements'] = requirements
-            self.user_states[user_id]['current_quest'] = quest_data
+            self.user_states[user_id]['quest_id'] = quest.quest_id
+            self.user_states[user_id]['quest_branches'] = []
+            self.user_states[user_id]['story_summary'] = []
+            self.user_states[user_id]['quest_version'] = self.user_states[user_id].get('quest_version', 0) + 1
             
             # Start the quest from beginning
-            start_step = quest_data['quest']['startStepId']
+            start_step = quest.start_step_id
             self.user_states[user_id]['current_step_id'] = start_step
             self.user_states[user_id]['step_history'] = [start_step]
             self.user_states[user_id]['quest_started'] = True
@@ -246,56 +373,153 @@ class KidQuestBot:
             # Display first step
             await self.display_current_step(update, context)
             
+        except RequestAbandoned:
+            logger.info(f"Quest generation for user {user_id} was abandoned")
         except Exception as e:
             logger.error(f"Error generating quest for user {user_id}: {str(e)}")
             if self.user_states[user_id]['user_language'] == 'en':
                 error_msg = "An error occurred while creating the quest. Please try again."
             else:
                 error_msg = "Произошла ошибка при создании квеста. Попробуй ещё раз."
-            await update.message.reply_text(error_msg)
+            await self.reply(update, error_msg)
             
+    @tracing.traced
     async def display_current_step(self, update, context):
         """Display the current step of the quest."""
         user_id = update.effective_user.id
-        if user_id not in self.user_states:
+        if not self.ensure_user_state(user_id):
             return
             
         state = self.user_states[user_id]
-        if not state['quest_started'] or not state['current_quest']:
+        quest = self.quest_library.session_quest(state)
+        if not state['quest_started'] or quest is None:
             return
             
         # Get current step data
-        quest_data = state['current_quest']
-        steps_dict = {step['id']: step for step in quest_data['quest']['steps']}
-        current_step = steps_dict.get(state['current_step_id'])
+        current_step = quest.get_step(state['current_step_id'])
         
         if not current_step:
-            await update.message.reply_text("Ошибка: не удалось найти текущий шаг квеста.")
+            await self.reply(update, "Ошибка: не удалось найти текущий шаг квеста.")
             return
             
-        # Format the message with options
-        text = current_step['text']
+        await self.reply(update, self.format_step_text(current_step, state.get('user_language')),
+                         reply_markup=self.step_keyboard(state, quest, current_step))
+        
+    def try_later_text(self, language: str) -> str:
+        """Fast reply used when the LLM backends are unavailable."""
+        if language == 'en':
+            return "I'm a little busy right now. Please try again in a minute!"
+        return "Я сейчас немного занят. Попробуй ещё раз через минутку!"
+        
+    def spend_quota(self, user_id: int, operation: str) -> bool:
+        """Charge an expensive operation to the user's quota; returns False if the user is over it."""
+        if self.quota is None:
+            return True
+        state = self.user_states[user_id]
+        if not self.quota.try_spend(state, operation):
+            logger.info(f"User {user_id} is over quota for {operation}")
+            return False
+        self.save_user_state(user_id, state)
+        return True
+        
+    def refund_quota(self, user_id: int, operation: str):
+        """Give back a charged operation that failed without a result, e.g. during a backend outage."""
+        if self.quota is None or user_id not in self.user_states:
+            return
+        state = self.user_states[user_id]
+        self.quota.refund(state, operation)
+        self.save_user_state(user_id, state)
+        self.save_user_state(user_id, state)
+        
+    def over_quota_text(self, user_id: int, operation: str, language: str) -> str:
+        """Cheap reply for a user who is over quota, with the wait until the operation is affordable."""
+        wait = self.quota.retry_in(self.user_states[user_id], operation)
+        minutes = max(1, math.ceil(wait / 60)) if math.isfinite(wait) else None
+        if language == 'en':
+            when = f"in {minutes} min" if minutes else "later"
+            if operation == OP_GENERATION:
+                return f"That's a lot of new quests! Let's take a little break - try again {when}."
+            return f"Let's slow down a little! Pick one of the options above, or try your own idea again {when}."
+        when = f"через {minutes} мин." if minutes else "попозже"
+        if operation == OP_GENERATION:
+            return f"Как много новых квестов! Давай немного отдохнём - попробуй снова {when}"
+        return f"Давай чуть помедленнее! Выбери один из вариантов выше или попробуй свой вариант снова {when}"
+        
+    def step_keyboard(self, state: Dict[str, Any], quest, step: Dict[str, Any]):
+        """Build inline buttons for a step's options, or None if it has none."""
+        if not step.get('options'):
+            return None
+        step_index = quest.step_index(step['id'])
+        buttons = [
+            [InlineKeyboardButton(f"{option.get('emoji', '')} {option['text']}".strip(),
+                                  callback_data=make_choice_callback(state.get('quest_version', 0), step_index, i))]
+            for i, option in enumerate(step['options'])
+        ]
+        return InlineKeyboardMarkup(buttons)
+        
+    def format_step_text(self, step: Dict[str, Any], language: str) -> str:
+        """Format a step's text followed by its numbered emoji options."""
+        text = step['text']
         
         # Add emoji options for each choice
-        if 'options' in current_step and len(current_step['options']) > 0:
+        if 'options' in step and len(step['options']) > 0:
             options_text = "\n"
-            for i, option in enumerate(current_step['options'], 1):
-                options_text += f"{i}. {option['emoji']} {option['text']}\n"
+            for i, option in enumerate(step['options'], 1):
+                options_text += f"{i}. {option.get('emoji', '')} {option['text']}\n"
             
             # Use appropriate language for the prompt
-            if state.get('user_language') == 'en':
+            if language == 'en':
                 text += f"\n\nChoose an action:\n{options_text}"
             else:
                 text += f"\n\nВыбери действие:\n{options_text}"
         
-        await update.message.reply_text(text)
+        return text
+        
+    def stream_placeholder_text(self, language: str) -> str:
+        """Text of the message a streamed branch is progressively written into."""
+        if language == 'en':
+            return "✨ Thinking up what happens next..."
+        return "✨ Придумываю, что будет дальше..."
+        
+    def abandoned_text(self, language: str) -> str:
+        """Final text of a streamed message whose branch was abandoned for a newer command."""
+        if language == 'en':
+            return "⏹ Skipped - moving on to your new request."
+        return "⏹ Пропускаю - перехожу к твоему новому запросу."
+        
+    async def stream_new_branch(self, message, quest_engine, current_step: Dict[str, Any], user_choice: str,
+                                all_steps: List[Dict], language: str, deadline: float, quest_id: str,
+                                story_so_far: str):
+        """
+        Create a new branch while progressively editing the already sent placeholder message with its text.
+        Returns the new step (or None); the caller finalizes the message.
+        """
+        last_edit = 0.0
         
+        async def on_text(text: str):
+            nonlocal last_edit
+            now = time.monotonic()
+            if now - last_edit < STREAM_EDIT_INTERVAL:
+                return
+            last_edit = now
+            try:
+                # Progress edits stay within one message; the final edit splits a long step
+                await self.dispatcher.edit(message, f"{text[:MAX_MESSAGE_LENGTH - 2]} ✍️")
+            except Exception as e:
+                logger.debug(f"Skipping streaming edit: {e}")
+        
+        new_step = await quest_engine.create_new_branch_streaming(current_step, user_choice, all_steps, language,
+                                                                  deadline=deadline, on_text=on_text, quest_id=quest_id,
+                                                                  story_so_far=story_so_far)
+        return new_step
+        
+    @tracing.traced
     async def handle_choice(self, update, context):
         """Handle user's choice and proceed to next step."""
         user_id = update.effective_user.id
         user = update.effective_user
         
-        if user_id not in self.user_states:
+        if not self.ensure_user_state(user_id):
             await self.new_quest(update, context)
             return
             
@@ -305,21 +529,22 @@ class KidQuestBot:
             return
             
         user_choice = update.message.text
+        branch_charged = False
+        stream_message = None
         
         try:
             state = self.user_states[user_id]
-            quest_data = state['current_quest']
+            quest = self.quest_library.session_quest(state)
             
-            if not quest_data:
-                await update.message.reply_text("Ошибка: квест не загружен.")
+            if quest is None:
+                await self.reply(update, "Ошибка: квест не загружен.")
                 return
                 
             # Get current step data
-            steps_dict = {step['id']: step for step in quest_data['quest']['steps']}
-            current_step = steps_dict.get(state['current_step_id'])
+            current_step = quest.get_step(state['current_step_id'])
             
             if not current_step:
-                await update.message.reply_text("Ошибка: текущий шаг не найден.")
+                await self.reply(update, "Ошибка: текущий шаг не найден.")
                 return
                 
             # Detect language from Telegram's built-in language_code first
@@ -331,7 +556,8 @@ class KidQuestBot:
             
             # If we couldn't determine language from Telegram, fall back to text detection
             if detected_language == 'ru':
-                fallback_detected_language = detect_language(user_choice)
+                with tracing.span('language_detection'):
+                    fallback_detected_language = detect_language(user_choice)
                 if fallback_detected_language in ['en', 'ru']:
                     detected_language = fallback_detected_language
             
@@ -354,82 +580,247 @@ class KidQuestBot:
                 user_choice_text = user_choice
             
             # Process the choice using QuestEngine
-            from quest_engine import QuestEngine
-            quest_engine = QuestEngine()
-            
-            next_step_id = await quest_engine.process_choice(current_step, user_choice_text, quest_data['quest']['steps'], state['user_language'])
+            if self.quest_pool is not None:
+                self.quest_pool.note_activity()
+            quest_engine = self.get_quest_engine()
+            
+            # An off-script choice made here before reuses its branch without any matching or generation:
+            # the session's own step first (the memo may have lost it to a restart or eviction), then the memo
+            from quest_engine import branch_step_id, ChoiceMatchError
+            new_step = quest.get_step(branch_step_id(current_step['id'], user_choice_text))
+            if new_step is None:
+                new_step = quest_engine.find_branch(quest.base.quest_id, current_step, user_choice_text)
+            next_step_id = None
+            if new_step is None:
+                with tracing.span('choice_matching'):
+                    # Typed option numbers and most free text are matched locally; only the rest costs a model call
+                    next_step_id = quest_engine.match_choice_locally(current_step, user_choice_text)
+                    if next_step_id is None:
+                        if not self.spend_quota(user_id, OP_CHOICE):
+                            await self.reply(update, self.over_quota_text(user_id, OP_CHOICE, detected_language))
+                            return
+                        try:
+                            next_step_id = await self.run_cancellable(
+                                user_id,
+                                quest_engine.process_choice(current_step, user_choice_text, quest.steps,
+                                                            state['user_language'],
+                                                            deadline=time.monotonic() + CHOICE_TIMEOUT)
+                            )
+                        except ChoiceMatchError:
+                            # The model could not judge the choice: don't charge it, and treat it as off-script
+                            self.refund_quota(user_id, OP_CHOICE)
             
             if next_step_id:
                 # Valid option found - proceed to next step
-                state['current_step_id'] = next_step_id
-                state['step_history'].append(next_step_id)
-                
-                # Check if the quest is finished
-                steps_dict = {step['id']: step for step in quest_data['quest']['steps']}
-                next_step = steps_dict.get(next_step_id)
-                
-                if next_step and quest_engine.is_quest_finished(next_step, quest_data['quest']['steps']):
-                    # Quest is finished - display completion message and start new quest
-                    if state['user_language'] == 'en':
-                        finish_message = "🎉 Congratulations! You've completed the quest!\n\n"
-                        finish_message += "Would you like to create a new quest? Just type /new!"
-                    else:
-                        finish_message = "🎉 Поздравляем! Ты завершил квест!\n\n"
-                        finish_message += "Хочешь создать новый квест? Просто напиши /new!"
-                    
-                    await update.message.reply_text(finish_message)
-                    
-                    # Reset quest state to allow starting a new one
-                    self.user_states[user_id]['current_quest'] = None
-                    self.user_states[user_id]['current_step_id'] = None
-                    self.user_states[user_id]['step_history'] = []
-                    self.user_states[user_id]['quest_started'] = False
-                    
-                    # Save the updated state
-                    self.save_user_state(user_id, self.user_states[user_id])
-                else:
-                    # Save state to database before displaying new step
-                    self.save_user_state(user_id, state)
-                    
-                    # Display the new step
-                    await self.display_current_step(update, context)
+                chosen_text = next((option['text'] for option in current_step.get('options', [])
+                                    if option['nextStepId'] == next_step_id), user_choice_text)
+                self.record_story_step(state, current_step, chosen_text)
+                await self.advance_to_step(update, context, user_id, next_step_id)
             else:
                 # No matching option - create a new branch
-                logger.info(f"No matching option for user {user_id}, creating new branch...")
-                new_step = await quest_engine.create_new_branch(current_step, user_choice_text, quest_data['quest']['steps'], state['user_language'])
+                if new_step is None:
+                    branch_charged = self.spend_quota(user_id, OP_BRANCH)
+                    if not branch_charged:
+                        await self.reply(update, self.over_quota_text(user_id, OP_BRANCH, detected_language))
+                        return
+                if new_step is not None:
+                    logger.info(f"Reusing branch {new_step['id']} for user {user_id}")
+                elif STREAM_BRANCHES:
+                    logger.info(f"No matching option for user {user_id}, creating new branch...")
+                    deadline = time.monotonic() + BRANCH_TIMEOUT
+                    # Sent before the call so every failure below can finalize it instead of leaving it behind
+                    stream_message = await self.reply(update, self.stream_placeholder_text(state['user_language']),
+                                                      coalesce=False)
+                    with tracing.span('llm_branch'):
+                        new_step = await self.run_cancellable(
+                            user_id,
+                            self.stream_new_branch(stream_message, quest_engine, current_step, user_choice_text,
+                                                   quest.steps, state['user_language'], deadline, quest.base.quest_id,
+                                                   story_summary.render(state.get('story_summary') or []))
+                        )
+                else:
+                    logger.info(f"No matching option for user {user_id}, creating new branch...")
+                    with tracing.span('llm_branch'):
+                        new_step = await self.run_cancellable(
+                            user_id,
+                            quest_engine.create_new_branch(current_step, user_choice_text, quest.steps,
+                                                           state['user_language'],
+                                                           deadline=time.monotonic() + BRANCH_TIMEOUT,
+                                                           quest_id=quest.base.quest_id,
+                                                           story_so_far=story_summary.render(state.get('story_summary') or []))
+                        )
                 
                 if new_step:
-                    # Add the new step to the quest data and proceed
-                    quest_data['quest']['steps'].append(new_step)
+                    # The branch was produced, so its charge stands
+                    branch_charged = False
+                    # Add the new step to this session's overlay (the shared quest is never modified) and proceed
+                    if quest.get_step(new_step['id']) is None:
+                        quest.branches = quest.branches + [new_step]
+                        state['quest_branches'] = quest.branches
+                        quest_engine.index_step(new_step)
+                    self.record_story_step(state, current_step, user_choice_text)
                     state['current_step_id'] = new_step['id']
                     state['step_history'].append(new_step['id'])
                     
                     # Save state to database before displaying new step
                     self.save_user_state(user_id, state)
                     
-                    await self.display_current_step(update, context)
+                    if stream_message is not None:
+                        # Complete the streamed message with the final text and options
+                        with tracing.span('telegram_send'):
+                            await self.dispatcher.edit(stream_message,
+                                                       self.format_step_text(new_step, state['user_language']),
+                                                       reply_markup=self.step_keyboard(state, quest, new_step))
+                    else:
+                        await self.display_current_step(update, context)
                 else:
                     # If we can't create a new branch, just show an error
                     if detected_language == 'en':
-                        await update.message.reply_text("Sorry, I didn't understand your choice. Try again!")
+                        error_msg = "Sorry, I didn't understand your choice. Try again!"
                     else:
-                        await update.message.reply_text("Извини, я не понял твой выбор. Попробуй ещё раз!")
-            
+                        error_msg = "Извини, я не понял твой выбор. Попробуй ещё раз!"
+                    await self.reply_or_finish(update, stream_message, error_msg)
+            
+        except RequestAbandoned:
+            logger.info(f"Choice processing for user {user_id} was abandoned")
+            # Like an abandoned generation, a branch cancelled by the user's newer command stays charged
+            branch_charged = False
+            if stream_message is not None:
+                await self.dispatcher.edit(stream_message, self.abandoned_text(state.get('user_language')))
+        except CircuitOpenError as e:
+            logger.warning(f"Branch creation unavailable for user {user_id}: {e}")
+            await self.reply_or_finish(update, stream_message, self.try_later_text(state.get('user_language')))
         except Exception as e:
             logger.error(f"Error processing choice for user {user_id}: {str(e)}")
             if state.get('user_language') == 'en':
                 error_msg = "An error occurred while processing your choice. Please try again."
             else:
                 error_msg = "Произошла ошибка при обработке твоего выбора. Попробуй ещё раз."
-            await update.message.reply_text(error_msg)
+            await self.reply_or_finish(update, stream_message, error_msg)
+        finally:
+            # A branch that failed, timed out or crashed without producing a step is not charged
+            if branch_charged:
+                self.refund_quota(user_id, OP_BRANCH)
+            
+    async def reply_or_finish(self, update, stream_message, text: str):
+        """Show text in place of a streamed message's placeholder if one was sent, otherwise as a new reply."""
+        if stream_message is not None:
+            await self.dispatcher.edit(stream_message, text)
+        else:
+            await self.reply(update, text)
+
+    def record_story_step(self, state: Dict[str, Any], step: Dict[str, Any], choice_text: str):
+        """Add a step taken to the session's rolling story summary, capped to STORY_SUMMARY_TOKENS."""
+        state['story_summary'] = story_summary.add_entry(state.get('story_summary') or [], step.get('text', ''),
+                                                         choice_text, STORY_SUMMARY_TOKENS)
+        
+    async def advance_to_step(self, update, context, user_id: int, next_step_id: str):
+        """Move the quest to a chosen step, finishing the quest if that step ends it."""
+        state = self.user_states[user_id]
+        quest = self.quest_library.session_quest(state)
+        state['current_step_id'] = next_step_id
+        state['step_history'].append(next_step_id)
+        
+        # Check if the quest is finished
+        next_step = quest.get_step(next_step_id) if quest is not None else None
+        
+        if next_step and self.get_quest_engine().is_quest_finished(next_step, quest.steps):
+            # Quest is finished - display completion message and start new quest
+            if state['user_language'] == 'en':
+                finish_message = "🎉 Congratulations! You've completed the quest!\n\n"
+                finish_message += "Would you like to create a new quest? Just type /new!"
+            else:
+                finish_message = "🎉 Поздравляем! Ты завершил квест!\n\n"
+                finish_message += "Хочешь создать новый квест? Просто напиши /new!"
+            
+            await self.reply(update, finish_message)
+            
+            # Reset quest state to allow starting a new one
+            state['quest_id'] = None
+            state['quest_branches'] = []
+            state['story_summary'] = []
+            state['current_step_id'] = None
+            state['step_history'] = []
+            state['quest_started'] = False
+            
+            # Save the updated state
+            self.save_user_state(user_id, state)
+        else:
+            # Save state to database before displaying new step
+            self.save_user_state(user_id, state)
+            
+            # Display the new step
+            await self.display_current_step(update, context)
+            
+    def choice_button_step(self, state: Dict[str, Any], choice) -> Optional[Dict[str, Any]]:
+        """Return the step a button choice was made at, or None if the button is stale or out of range."""
+        quest_version, step_index, option_index = choice
+        quest = self.quest_library.session_quest(state)
+        step = quest.step_at(step_index) if quest is not None else None
+        if (not state.get('quest_started') or quest_version != state.get('quest_version', 0)
+                or step is None or step['id'] != state['current_step_id']
+                or not 0 <= option_index < len(step.get('options', []))):
+            return None
+        return step
+        
+    @tracing.traced
+    async def handle_choice_button(self, update, context):
+        """Handle a tap on an inline option button: proceed directly, without any choice matching."""
+        query = update.callback_query
+        user_id = update.effective_user.id
+        choice = parse_choice_callback(query.data)
+        
+        if choice is None or not self.ensure_user_state(user_id):
+            await query.answer()
+            return
+            
+        state = self.user_states[user_id]
+        step = self.choice_button_step(state, choice)
+        
+        # Ignore buttons of an earlier quest or of a step the user has already left
+        if step is None:
+            if state.get('user_language') == 'en':
+                await query.answer("This choice is no longer available.")
+            else:
+                await query.answer("Этот выбор уже недоступен.")
+            return
+            
+        await query.answer()
+        
+        # Another tap, /back or /new may have moved the session on while the query was answered
+        state = self.user_states.get(user_id)
+        step = self.choice_button_step(state, choice) if state is not None else None
+        if step is None:
+            return
+        option_index = choice[2]
+        
+        # A tap replaces any free-text choice still being processed
+        self.cancel_active_request(user_id)
+        if self.quest_pool is not None:
+            self.quest_pool.note_activity()
+        
+        try:
+            option = step['options'][option_index]
+            self.record_story_step(state, step, option['text'])
+            next_step_id = option['nextStepId']
+            await self.advance_to_step(update, context, user_id, next_step_id)
+        except Exception as e:
+            logger.error(f"Error processing choice button for user {user_id}: {str(e)}")
+            if state.get('user_language') == 'en':
+                error_msg = "An error occurred while processing your choice. Please try again."
+            else:
+                error_msg = "Произошла ошибка при обработке твоего выбора. Попробуй ещё раз."
+            await self.reply(update, error_msg)
 
+    @tracing.traced
     async def go_back(self, update, context):
         """Go back to the previous step."""
         user_id = update.effective_user.id
         
-        if user_id not in self.user_states:
+        if not self.ensure_user_state(user_id):
             return
             
+        self.cancel_active_request(user_id)
         state = self.user_states[user_id]
         
         # Check if we have a history
@@ -438,6 +829,7 @@ class KidQuestBot:
             state['step_history'].pop()  # Remove current step
             prev_step_id = state['step_history'][-1]  # Get the previous step
             state['current_step_id'] = prev_step_id
+            state['story_summary'] = story_summary.remove_last_entry(state.get('story_summary') or [])
             
             # Save state to database before displaying new step
             self.save_user_state(user_id, state)
@@ -445,49 +837,153 @@ class KidQuestBot:
             await self.display_current_step(update, context)
         else:
             if state.get('user_language') == 'en':
-                await update.message.reply_text("You're already at the first step of the quest!")
+                await self.reply(update, "You're already at the first step of the quest!")
             else:
-                await update.message.reply_text("Ты уже на первом шаге квеста!")
+                await self.reply(update, "Ты уже на первом шаге квеста!")
+
+    async def session_size_report(self, top_n: int = 5) -> Dict[str, Any]:
+        """Measure session sizes in a worker thread, on a snapshot of the in-memory sessions."""
+        # Copying each session's top level is cheap and keeps handlers from changing it mid-encode
+        snapshot = {user_id: dict(state) for user_id, state in self.user_states.items()}
+        return await asyncio.to_thread(memory_probe.session_size_report, snapshot, self.session_store.codec, top_n)
+        
+    async def show_stats(self, update, context):
+        """Report session count, state sizes and allocation growth to admins."""
+        if update.effective_user.id not in ADMIN_USER_IDS:
+            return
+        report = await self.session_size_report()
+        text = memory_probe.format_report(report, memory_probe.tracemalloc_diff())
+        store_stats = self.session_store.stats()
+        text += f"\nDirty sessions: {store_stats['dirty']}, flushes: {store_stats['flushes']}"
+        library_stats = self.quest_library.stats()
+        text += (f"\nShared quests in memory: {library_stats['cached']}, "
+                 f"interned: {library_stats['interned']}, reused: {library_stats['shared']}")
+        if self.quota is not None:
+            quota_stats = self.quota.stats()
+            text += (f"\nQuota granted: {quota_stats['granted']}, denied: {quota_stats['denied']}, "
+                     f"refunded: {quota_stats['refunded']}")
+        if self.quest_engine is not None:
+            for schema_name, modes in self.quest_engine.parse_stats.stats().items():
+                rates = ', '.join(f"{mode} {modes[mode]['parse_failure_rate']:.0%} (n={modes[mode]['answers']})"
+                                  for mode in ('constrained', 'free', 'wire') if mode in modes)
+                retries = modes.get('retries_per_request')
+                text += f"\nParse failures {schema_name}: {rates or 'no answers'}"
+                if retries is not None:
+                    text += f", retries/request {retries:.2f}"
+            race = self.quest_engine.race.stats()
+            text += f"\nGeneration failure rate {race['failure_rate']:.0%}, next race width {race['next_k']}"
+            if race['races']:
+                text += (f"\nGeneration races: {race['races']} (won {race['races_won']}), "
+                         f"mean width {race['mean_k']:.2f}, cancelled {race['candidates_cancelled']}, "
+                         f"tokens {race['winner_tokens']} winning / {race['wasted_tokens']} extra")
+        text += "\n" + tracing.format_stats()
+        await self.reply(update, text)
+        
+    async def log_memory_reports(self):
+        """Background worker: log a session-size summary every MEMORY_REPORT_INTERVAL seconds."""
+        while True:
+            await asyncio.sleep(MEMORY_REPORT_INTERVAL)
+            report = await self.session_size_report(top_n=0)
+            logger.info(
+                f"Sessions: {report['sessions']}, state JSON total {report['json_bytes_total']} B, "
+                f"p99 {report['json_bytes_p99']} B, max {report['json_bytes_max']} B, "
+                f"peak RSS {memory_probe.peak_rss_bytes() / 1048576:.1f} MiB"
+            )
 
     def run(self):
         """Run the bot."""
         logger.info("KidQuestBot started.")
-        
-        # Load all user states from database
-        self.load_all_user_states()
+        # Refuse to start on session files laid out for a different STATE_SHARDS
+        self.session_store.check_layout()
         
         # Create the Application and pass it your bot's token
-        application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+        application = (
+            Application.builder()
+            .token(TELEGRAM_BOT_TOKEN)
+            .post_init(self.post_init)
+            .post_stop(self.post_stop)
+            # Process updates concurrently so that /new can cancel a generation in progress
+            # and one user's slow request does not hold up everyone else
+            .concurrent_updates(True)
+            .build()
+        )
 
         # Register command handlers
         application.add_handler(CommandHandler("start", self.start))
         application.add_handler(CommandHandler("new", self.new_quest))
         application.add_handler(CommandHandler("back", self.go_back))
+        application.add_handler(CommandHandler("stats", self.show_stats))
 
         # Register message handler for text input
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_choice))
+        
+        # Register handler for inline option buttons
+        application.add_handler(CallbackQueryHandler(self.handle_choice_button, pattern=f"^{CHOICE_CALLBACK_PREFIX}:"))
+
+        # Report startup time once the first update has gone through the handlers above
+        application.add_handler(TypeHandler(Update, self.on_update_handled), group=1)
+        startup_probe.mark('application_built')
 
         # Run the bot until the user presses Ctrl-C
         logger.info("Starting polling...")
         application.run_polling()
     
-    def load_all_user_states(self):
-        """Load all user states from database at startup (optional enhancement)."""
-        try:
-            import json
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('SELECT user_id, state_data FROM user_states')
-            rows = cursor.fetchall()
-            
-            for row in rows:
-                user_id, state_data = row
-                self.user_states[user_id] = json.loads(state_data)
-                
-            conn.close()
-        except Exception as e:
-            logger.error(f"Error loading all user states: {e}")
+    async def post_init(self, application):
+        """
+        Start background workers once the application is initialized.
+        Nothing here blocks: polling starts right after, while optional
+        warm-up (loading stored sessions, the LLM client) happens in the background.
+        """
+        startup_probe.mark('initialized')
+        if TRACEMALLOC_ENABLED:
+            memory_probe.start_tracemalloc()
+        if MEMORY_REPORT_INTERVAL > 0:
+            self.background_tasks.append(asyncio.create_task(self.log_memory_reports()))
+        self.background_tasks.append(asyncio.create_task(self.session_store.run()))
+        if TRACE_EXPORT_PATH:
+            self.background_tasks.append(asyncio.create_task(tracing.run()))
+        if WARM_UP_STATES:
+            self.background_tasks.append(asyncio.create_task(self.warm_up_user_states()))
+        if self.quest_pool is not None:
+            self.background_tasks.append(asyncio.create_task(self.load_pooled_quests()))
+            self.background_tasks.append(asyncio.create_task(self.quest_pool.run(self.get_quest_engine)))
+
+    async def on_update_handled(self, update, context):
+        """Report the startup timeline after the first update is handled."""
+        startup_probe.report_first_update()
+
+    async def warm_up_user_states(self):
+        """Load stored sessions in a worker thread without replacing ones already in memory."""
+        states = await asyncio.to_thread(self.session_store.load_all)
+        for user_id, state in states.items():
+            if user_id not in self.user_states:
+                self.user_states[user_id] = self.quest_library.migrate_state(state)
+        logger.info(f"Warmed up {len(states)} user states")
+
+    async def load_pooled_quests(self):
+        """Add the quests pre-built into the session store (bulk_generate.py --store) to the warm pool."""
+        quests = await asyncio.to_thread(self.session_store.load_pooled_quests)
+        added = sum(self.quest_pool.add(language, theme, quest_data) for language, theme, quest_data in quests)
+        if added:
+            logger.info(f"Added {added} stored quests to the quest pool")
+
+    async def post_stop(self, application):
+        """Cancel background workers when the application stops."""
+        for task in self.background_tasks:
+            task.cancel()
+        await asyncio.gather(*self.background_tasks, return_exceptions=True)
+        self.background_tasks = []
+        
+        # Write out sessions that are still dirty, and traces not yet exported
+        self.session_store.close()
+        tracing.flush_exports()
 
-# Create a global instance of the bot
-bot = KidQuestBot()
\ No newline at end of file
+    def ensure_user_state(self, user_id: int) -> bool:
+        """Make sure the user's stored session is in memory; returns False if there is none."""
+        if user_id in self.user_states:
+            return True
+        state = self.load_user_state(user_id)
+        if not state:
+            return False
+        self.user_states[user_id] = state
+        return True
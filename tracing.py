@@ -0,0 +1,196 @@
+"""
+Lightweight, sampled tracing spans for bot handlers
+"""
+
+import asyncio
+import functools
+import json
+import logging
+import random
+import time
+import uuid
+from collections import defaultdict, deque
+from contextvars import ContextVar
+from contextlib import contextmanager
+from typing import Deque, Dict, Any, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Durations kept per (handler, phase) for percentiles
+WINDOW_SIZE = 1000
+# Exported trace records buffered between writes (the oldest are dropped beyond this)
+EXPORT_BUFFER_SIZE = 10000
+# Seconds between writes of buffered trace records
+EXPORT_INTERVAL = 5.0
+
+_sample_rate = 0.0
+_export_path = ''
+_durations: Dict[Tuple[str, str], Deque[float]] = defaultdict(lambda: deque(maxlen=WINDOW_SIZE))
+_traces_sampled = 0
+_export_buffer: Deque[str] = deque(maxlen=EXPORT_BUFFER_SIZE)
+
+
+class Trace:
+    """One sampled handler invocation and the phases it spent time in."""
+
+    def __init__(self, handler: str):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.handler = handler
+        self.started = time.perf_counter()
+        self.wall_started = time.time()
+        self.spans: List[Tuple[str, float, float]] = []
+        self.finished = False
+
+    def add_span(self, phase: str, start: float, duration: float):
+        # Background tasks started by the handler inherit its trace and may outlive it
+        if not self.finished:
+            self.spans.append((phase, start - self.started, duration))
+
+
+# Trace of the handler running in the current task (None when not sampled)
+_current_trace: ContextVar[Optional[Trace]] = ContextVar('current_trace', default=None)
+
+
+def configure(sample_rate: float, export_path: str = ''):
+    """
+    Set the fraction of handler calls that are traced and where traces are written.
+
+    Args:
+        sample_rate (float): Fraction of handler invocations to trace (0 disables tracing)
+        export_path (str): JSON-lines file traces are appended to ('' keeps only in-memory percentiles)
+    """
+    global _sample_rate, _export_path
+    _sample_rate = max(0.0, min(1.0, sample_rate))
+    _export_path = export_path
+
+
+@contextmanager
+def span(phase: str):
+    """Time a phase of the current trace; does nothing when the handler is not sampled."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_span(phase, start, time.perf_counter() - start)
+
+
+def traced(handler):
+    """
+    Trace a sample of an async handler's invocations.
+
+    A handler called from inside another traced handler is recorded as a span
+    of the outer trace rather than as a trace of its own.
+    """
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        if _current_trace.get() is not None:
+            with span(name):
+                return await handler(*args, **kwargs)
+        if _sample_rate <= 0 or random.random() >= _sample_rate:
+            return await handler(*args, **kwargs)
+        trace = Trace(name)
+        token = _current_trace.set(trace)
+        try:
+            return await handler(*args, **kwargs)
+        finally:
+            _current_trace.reset(token)
+            _finish(trace, time.perf_counter() - trace.started)
+
+    return wrapper
+
+
+def _finish(trace: Trace, total: float):
+    """Aggregate a finished trace and buffer it for the export file."""
+    global _traces_sampled
+    trace.finished = True
+    _traces_sampled += 1
+    _durations[(trace.handler, 'total')].append(total)
+    for phase, _, duration in trace.spans:
+        _durations[(trace.handler, phase)].append(duration)
+    if not _export_path:
+        return
+    record = {
+        'trace_id': trace.trace_id,
+        'handler': trace.handler,
+        'ts': round(trace.wall_started, 3),
+        'duration_ms': round(total * 1000, 2),
+        'spans': [
+            {'phase': phase, 'start_ms': round(start * 1000, 2), 'duration_ms': round(duration * 1000, 2)}
+            for phase, start, duration in trace.spans
+        ],
+    }
+    # Written by the run() worker, off the event loop
+    _export_buffer.append(json.dumps(record) + '\n')
+
+
+def _take_exports() -> List[str]:
+    lines = list(_export_buffer)
+    _export_buffer.clear()
+    return lines
+
+
+def _write_exports(lines: List[str]):
+    try:
+        with open(_export_path, 'a', encoding='utf-8') as export:
+            export.writelines(lines)
+    except OSError as e:
+        logger.error(f"Error exporting {len(lines)} traces: {e}")
+
+
+async def run(interval: float = EXPORT_INTERVAL):
+    """Background worker: append buffered trace records to the export file every interval until cancelled."""
+    while True:
+        await asyncio.sleep(interval)
+        if _export_buffer and _export_path:
+            await asyncio.to_thread(_write_exports, _take_exports())
+
+
+def flush_exports():
+    """Write the remaining buffered trace records (at shutdown)."""
+    if _export_buffer and _export_path:
+        _write_exports(_take_exports())
+
+
+def _percentile(sorted_values: List[float], fraction: float) -> float:
+    return sorted_values[int(fraction * (len(sorted_values) - 1))]
+
+
+def phase_stats() -> Dict[str, Dict[str, Dict[str, Any]]]:
+    """
+    Aggregate recent traces into per-phase percentiles.
+
+    Returns:
+        Dict[str, Dict[str, Dict[str, Any]]]: For each handler and phase, the number
+        of recent samples and their p50/p95/p99 durations in milliseconds
+    """
+    stats: Dict[str, Dict[str, Dict[str, Any]]] = {}
+    for (handler, phase), durations in list(_durations.items()):
+        values = sorted(durations)
+        stats.setdefault(handler, {})[phase] = {
+            'count': len(values),
+            'p50_ms': _percentile(values, 0.5) * 1000,
+            'p95_ms': _percentile(values, 0.95) * 1000,
+            'p99_ms': _percentile(values, 0.99) * 1000,
+        }
+    return stats
+
+
+def format_stats() -> str:
+    """Render per-phase percentiles as a chat message."""
+    if _sample_rate <= 0:
+        return "Tracing: off"
+    lines = [f"Tracing: {_traces_sampled} traces sampled at {_sample_rate:.0%}"]
+    for handler, phases in sorted(phase_stats().items()):
+        lines.append(f"{handler}:")
+        # Total first, then phases from slowest to fastest
+        ordered = sorted(phases.items(), key=lambda item: (item[0] != 'total', -item[1]['p95_ms']))
+        for phase, stat in ordered:
+            lines.append(f"  {phase}: p50 {stat['p50_ms']:.1f} / p95 {stat['p95_ms']:.1f} / "
+                         f"p99 {stat['p99_ms']:.1f} ms (n={stat['count']})")
+    return "\n".join(lines)
@@ -0,0 +1,79 @@
+"""
+Cost-weighted per-user token buckets for expensive model calls
+"""
+
+import time
+from collections import Counter
+from typing import Dict, Any, Optional
+
+# Operations with a quota cost
+OP_GENERATION = 'generation'
+OP_BRANCH = 'branch'
+OP_CHOICE = 'choice'
+
+
+class QuotaPolicy:
+    """
+    Per-user token buckets, charged by the cost of each operation.
+
+    The bucket lives in the user's session state under 'quota' as
+    {'tokens': float, 'updated': unix time}, so it is saved with the session
+    and survives restarts. A user without a bucket starts with a full one.
+    """
+
+    def __init__(self, capacity: float, refill_per_minute: float, costs: Dict[str, float]):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_minute / 60
+        self.costs = costs
+        self.granted: Counter = Counter()
+        self.denied: Counter = Counter()
+        self.refunded: Counter = Counter()
+
+    def _refilled(self, state: Dict[str, Any], now: float) -> float:
+        quota = state.get('quota')
+        if not quota:
+            return self.capacity
+        elapsed = max(now - quota.get('updated', now), 0)
+        return min(self.capacity, quota.get('tokens', self.capacity) + elapsed * self.refill_per_second)
+
+    def try_spend(self, state: Dict[str, Any], operation: str, now: Optional[float] = None) -> bool:
+        """
+        Charge an operation to the user's bucket if it can afford it.
+
+        Args:
+            state (Dict[str, Any]): The user's session state (updated in place)
+            operation (str): One of the OP_* operations
+            now (Optional[float]): Current unix time
+
+        Returns:
+            bool: True if the operation may run, False if the user is over quota
+        """
+        now = time.time() if now is None else now
+        tokens = self._refilled(state, now)
+        cost = self.costs.get(operation, 0)
+        if tokens < cost:
+            self.denied[operation] += 1
+            return False
+        state['quota'] = {'tokens': tokens - cost, 'updated': now}
+        self.granted[operation] += 1
+        return True
+
+    def refund(self, state: Dict[str, Any], operation: str, now: Optional[float] = None):
+        """Give back the cost of an operation that failed through no fault of the user (e.g. a backend outage)."""
+        now = time.time() if now is None else now
+        tokens = self._refilled(state, now) + self.costs.get(operation, 0)
+        state['quota'] = {'tokens': min(self.capacity, tokens), 'updated': now}
+        self.refunded[operation] += 1
+
+    def retry_in(self, state: Dict[str, Any], operation: str, now: Optional[float] = None) -> float:
+        """Return the seconds until the user can afford an operation."""
+        now = time.time() if now is None else now
+        missing = self.costs.get(operation, 0) - self._refilled(state, now)
+        if missing <= 0:
+            return 0.0
+        if self.refill_per_second <= 0:
+            return float('inf')
+        return missing / self.refill_per_second
+
+    def stats(self) -> Dict[str, Any]:
+        return {'granted': dict(self.granted), 'denied': dict(self.denied), 'refunded': dict(self.refunded)}